@@ -7,6 +7,7 @@ Commandline input for running SV
 from SVclone import run_filter
 from SVclone import run_clus
 from SVclone import post_assign
+from SVclone import germline_index
 from SVclone.SVprocess import annotate
 from SVclone.SVprocess import count
 
@@ -45,10 +46,53 @@ annotate_parser.add_argument("--blacklist", dest="blist", default="",
                     help='''Takes a file in BED format as an argument. Skip processing of any break-pairs
                     where either SV break-end overlaps an interval specified in the supplied bed file.''')
 
+annotate_parser.add_argument("--regions", dest="regions", default="",
+                    help='''Comma-separated regions (chrom or chrom:start-end) to load SVs from. Requires
+                    a bgzipped, tabix-indexed VCF input. Both break-ends of an SV must be in the regions.''')
+
+annotate_parser.add_argument("--threads",dest="threads",default=1,type=int,
+                    help="Number of processes used to fetch reads and infer directions/positions per SV.")
+
 annotate_parser.set_defaults(func=annotate.preproc_svs)
 
 ##########################################################################################################
 
+annotate_count_parser = subparsers.add_parser('annotate_count', help='Run annotate and count, fetching reads once per breakend')
+
+annotate_count_parser.add_argument("-cfg","--config",dest="cfg",default="svclone_config.ini",
+                    help="Config file.")
+
+annotate_count_parser.add_argument("-i","--input",dest="svin",required=True,
+                    help="Structural variants input file. See README for input format")
+
+annotate_count_parser.add_argument("-b","--bam",dest="bam",required=True,
+                    help="Corresponding indexed BAM file")
+
+annotate_count_parser.add_argument("-s","--sample",dest="sample",required=True,
+                    help='''Sample name. Output is written to <out_dir>/<sample>_svin.txt and
+                    <out_dir>/<sample>_svinfo.txt.''')
+
+annotate_count_parser.add_argument("-o","--out",dest="out",default="",
+                    help='''Output directory. Sample name by default.''')
+
+annotate_count_parser.add_argument("--sv_format",dest="sv_format",choices=['vcf','simple','socrates'],default='vcf',
+                    help="Possible SV input formats: vcf, simple, socrates")
+
+annotate_count_parser.add_argument("--blacklist", dest="blist", default="",
+                    help='''Takes a file in BED format as an argument. Skip processing of any break-pairs
+                    where either SV break-end overlaps an interval specified in the supplied bed file.''')
+
+annotate_count_parser.add_argument("--regions", dest="regions", default="",
+                    help='''Comma-separated regions (chrom or chrom:start-end) to load SVs from. Requires
+                    a bgzipped, tabix-indexed VCF input. Both break-ends of an SV must be in the regions.''')
+
+annotate_count_parser.add_argument("--threads",dest="threads",default=1,type=int,
+                    help="Number of processes used to fetch reads, infer directions/positions and count reads per SV.")
+
+annotate_count_parser.set_defaults(func=annotate.preproc_count_svs)
+
+##########################################################################################################
+
 count_parser = subparsers.add_parser('count', help='Count reads from called structural variations')
 
 count_parser.add_argument("-cfg","--config",dest="cfg",default="svclone_config.ini",
@@ -70,6 +114,24 @@ count_parser.set_defaults(func=count.proc_svs)
 
 ##########################################################################################################
 
+germline_panel_parser = subparsers.add_parser('germline_panel', help='Build a germline SV panel from the count output of normal samples')
+
+germline_panel_parser.add_argument("-i","--input",dest="germline_svs",nargs="+",required=True,
+                    help="Germline SVs (<sample>_svinfo.txt output of the count step) of one or more normals.")
+
+germline_panel_parser.add_argument("-o","--out",dest="out",required=True,
+                    help="Output panel file (.npz), to be passed to filter or post_assign via --germline.")
+
+germline_panel_parser.add_argument("--min_support",dest="min_support",default=1,type=int,
+                    help="Minimum supporting reads for a germline SV to be included (default: 1).")
+
+germline_panel_parser.add_argument("--min_samples",dest="min_samples",default=1,type=int,
+                    help="Minimum number of normals an SV must be found in to be included (default: 1).")
+
+germline_panel_parser.set_defaults(func=germline_index.build_panel)
+
+##########################################################################################################
+
 filter_parser = subparsers.add_parser('filter', help='Filter output from process step')
 
 filter_parser.add_argument("-cfg","--config",dest="cfg",default="svclone_config.ini",
@@ -84,8 +146,8 @@ filter_parser.add_argument("-i","--input",default="",dest="procd_svs",
                     help="Required: Processed structural variation input (comma separated if multiple).")
 
 filter_parser.add_argument("-g","--germline",dest="germline",default="",
-                    help='''Germline SVs in output format from process step. If not provided, will
-                    assume all SVs are somatic.''')
+                    help='''Germline SVs in output format from process step, or a germline panel (.npz) built
+                    with germline_panel. If not provided, will assume all SVs are somatic.''')
 
 filter_parser.add_argument("-c","--cnvs",dest="cnvs",default="",
                     help='''Phased copy-number states from Battenberg. If not provided, all SVs assumed copy-neutral.''')
@@ -114,6 +176,12 @@ filter_parser.add_argument("--blacklist", dest="blist", default="",
                     help='''Takes a file in BED format as an argument. Filter out any break-pairs where
                     either SV break-end overlaps an interval specified in the supplied bed file.''')
 
+filter_parser.add_argument("--threads",dest="threads",default=1,type=int,
+                    help="Number of processes used to load a bgzipped, tabix-indexed SNV VCF (one contig per task).")
+
+filter_parser.add_argument("--refresh_cache",dest="refresh_cache",action="store_true",
+                    help="Ignore and overwrite cached parsed inputs in <out>/input_cache.")
+
 filter_parser.set_defaults(func=run_filter.run)
 
 ##########################################################################################################
@@ -199,8 +267,8 @@ post_assign_parser.add_argument("-r","--run",dest="run",default="best",
                     Will use the best run by default.''')
 
 post_assign_parser.add_argument("-g","--germline",dest="germline",default="",
-                    help='''Germline SVs in output format from process step. If not provided, will
-                    assume all SVs are somatic.''')
+                    help='''Germline SVs in output format from process step, or a germline panel (.npz) built
+                    with germline_panel. If not provided, will assume all SVs are somatic.''')
 
 post_assign_parser.add_argument("--XX",dest="XX",action="store_true",
                     help="Specify XX genotype. (Overwrites config file, sets male to False.)")
@@ -208,6 +276,12 @@ post_assign_parser.add_argument("--XX",dest="XX",action="store_true",
 post_assign_parser.add_argument("--XY",dest="XY",action="store_true",
                     help="Specify XY genotype. (Overwrites config file, sets male to True.)")
 
+post_assign_parser.add_argument("--threads",dest="threads",default=1,type=int,
+                    help="Number of processes used to load a bgzipped, tabix-indexed SNV VCF (one contig per task).")
+
+post_assign_parser.add_argument("--refresh_cache",dest="refresh_cache",action="store_true",
+                    help="Ignore and overwrite cached parsed inputs in <out>/input_cache.")
+
 post_assign_parser.set_defaults(func=post_assign.run_post_assign)
 
 ##########################################################################################################
@@ -6,21 +6,18 @@ import vcf
 import pysam
 import os
 import re
+import multiprocessing
+
+from collections import OrderedDict
+from functools import partial
 
 from . import svp_load_data
 from . import count
 from . import svDetectFuncs as svd
-from . import bamtools
+from . import lib_stats
 from . import svp_dtypes as dtypes
-
-def classify_event(sv, sv_id, svd_prev_result, prev_sv):
-    svd_result = svd.detect(prev_sv, svd_prev_result, sv)
-    svd_prev_result, prev_sv = svd_result, sv
-
-    classification = svd.getResultType(svd_result)
-    sv_id = sv_id if svd_result[0] == svd.SVtypes.interspersedDuplication else sv_id+1
-
-    return classification, sv_id, svd_prev_result, prev_sv
+from .bp_index import BreakpointIndex
+from .bed_index import load_blacklist_index
 
 def has_mixed_evidence(loc_reads, pos, sc_len, threshold):
     split_reads = [count.is_supporting_split_read_lenient(x, pos, threshold*2) for x in loc_reads]
@@ -91,7 +88,7 @@ def get_bp_dir(sv, loc_reads, pos, sc_len, threshold, bp_num):
 
     return sv, ca_right, ca_left
 
-def retrieve_loc_reads(sv, bam, max_dep, threshold):
+def retrieve_loc_reads(sv, bam, max_dep, threshold, read_cache=None):
     bp_dtype = [('chrom', 'S20'), ('start', int), ('end', int), ('dir', 'S1')]
 
     sv_id, chr1, pos1, dir1, chr2, pos2, dir2, \
@@ -101,10 +98,14 @@ def retrieve_loc_reads(sv, bam, max_dep, threshold):
     bp2 = np.array((sv[chr2], sv[pos2]-(threshold*2), \
                     sv[pos2]+(threshold*2), sv[dir2]), dtype=bp_dtype)
 
-    bamf = pysam.AlignmentFile(bam, "rb")
-    loc1_reads, err_code1 = count.get_loc_reads(bp1, bamf, max_dep)
-    loc2_reads, err_code2 = count.get_loc_reads(bp2, bamf, max_dep)
-    bamf.close()
+    if read_cache is None:
+        bamf = pysam.AlignmentFile(bam, "rb")
+        loc1_reads, err_code1 = count.get_loc_reads(bp1, bamf, max_dep)
+        loc2_reads, err_code2 = count.get_loc_reads(bp2, bamf, max_dep)
+        bamf.close()
+    else:
+        loc1_reads, err_code1 = read_cache.get_loc_reads(bp1, max_dep)
+        loc2_reads, err_code2 = read_cache.get_loc_reads(bp2, max_dep)
 
     sv_class = str(sv['classification'])
     if err_code1 == 1 or err_code2 == 1:
@@ -115,9 +116,10 @@ def retrieve_loc_reads(sv, bam, max_dep, threshold):
 
     return sv, loc1_reads, loc2_reads, err_code1, err_code2
 
-def get_dir_info(row, bam, max_dep, sc_len, threshold):
+def get_dir_info(row, bam, max_dep, sc_len, threshold, read_cache=None):
 
-    sv, loc1_reads, loc2_reads, err_code1, err_code2 = retrieve_loc_reads(row.copy(), bam, max_dep, threshold)
+    sv, loc1_reads, loc2_reads, err_code1, err_code2 = \
+        retrieve_loc_reads(row.copy(), bam, max_dep, threshold, read_cache)
     if err_code1 != 0 or err_code2 != 0:
         return sv, (0, 0, 0, 0)
 
@@ -127,6 +129,45 @@ def get_dir_info(row, bam, max_dep, sc_len, threshold):
 
     return sv, consens_aligns
 
+def recalibrate_sv_pos(row, bam, max_dep, threshold, read_cache=None):
+    '''
+    set the SV's break positions to the consensus soft-clip alignments
+    '''
+    sv = row.copy()
+    sv_tmp, loc1_reads, loc2_reads, err_code1, err_code2 = \
+        retrieve_loc_reads(row.copy(), bam, max_dep, threshold, read_cache)
+
+    if err_code1 != 0 or err_code2 != 0:
+        return sv
+
+    ca_right, ca_left = get_consensus_align(loc1_reads, row['pos1'], threshold)
+    new_align = ca_right if row['dir1'] == '+' else ca_left
+    if new_align != 0:
+        sv['pos1'] = new_align
+
+    ca_right, ca_left = get_consensus_align(loc2_reads, row['pos2'], threshold)
+    new_align = ca_right if row['dir2'] == '+' else ca_left
+    if new_align != 0:
+        sv['pos2'] = new_align
+
+    return sv
+
+def map_svs(func, svs, threads):
+    '''
+    apply func to each SV, spread over a pool of worker processes if
+    threads > 1. Results are returned in SV order.
+    '''
+    if threads <= 1 or len(svs) <= 1:
+        return [func(sv) for sv in svs]
+
+    pool = multiprocessing.Pool(min(threads, len(svs)))
+    try:
+        chunksize = max(1, len(svs) / (threads * 4))
+        return pool.map(func, svs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
 def num_mixed_svs(svs):
     sv_classes = map(lambda x: x.split(';'), svs['classification'])
     sv_classes = np.array([sv for svc in sv_classes for sv in svc])
@@ -136,31 +177,25 @@ def num_mixed_svs(svs):
 def does_break_match(chr1, pos1, chr2, pos2, threshold):
     return chr1 == chr2 and (pos1 + threshold) > pos2 and (pos1 - threshold) < pos2
 
-def get_matching_svs(idx, sv, bp_chr, bp_pos, svs, threshold, mixed=False):
-    sv_matches = np.empty(0, dtype=dtypes.sv_dtype)
-    which_matches = []
+def get_matching_svs(idx, sv, bp_chr, bp_pos, svs, threshold, mixed=False, bp_index=None):
+    '''
+    returns SVs with a break-end matching the given break-end, the matching
+    break-end numbers per SV, and the index of each matching SV in svs
+    '''
+    bp_index = BreakpointIndex(svs) if bp_index is None else bp_index
 
-    for i,row in enumerate(svs):
-        if mixed and row['classification'] != 'MIXED;MIXED':
+    which_matches = OrderedDict()
+    for i, bp_num in bp_index.query(bp_chr, bp_pos, threshold):
+        if i == idx:
             continue
-        if i==idx:
+        if mixed and svs[i]['classification'] != 'MIXED;MIXED':
             continue
-        matches = []
-
-        if does_break_match(bp_chr, bp_pos, row['chr1'], row['pos1'], threshold):
-            match_sv = np.array(row, dtype=dtypes.sv_dtype)
-            sv_matches = np.append(sv_matches, match_sv)
-            matches.append(1)
+        which_matches.setdefault(i, []).append(bp_num)
 
-        if does_break_match(bp_chr, bp_pos, row['chr2'], row['pos2'], threshold):
-            match_sv = np.array(row, dtype=dtypes.sv_dtype)
-            sv_matches = np.append(sv_matches, match_sv)
-            matches.append(2)
+    match_idxs = [i for i in which_matches for bp_num in which_matches[i]]
+    sv_matches = np.array(svs[match_idxs], dtype=dtypes.sv_dtype)
 
-        if len(matches) > 0:
-            which_matches.append(matches)
-
-    return sv_matches, which_matches
+    return sv_matches, which_matches.values(), match_idxs
 
 def set_dir_class(sv, dir1, dir2, sv_class, new_pos1, new_pos2):
     sv['dir1'] = dir1
@@ -189,12 +224,24 @@ def is_same_sv(sv1, sv2, threshold):
             return True
     return False
 
+def get_sv_keys(svs):
+    '''
+    numeric (chrom-coded) breakpoint keys per SV, for sorting and uniquing
+    '''
+    chroms, chr_codes = np.unique(np.concatenate([svs['chr1'], svs['chr2']]), return_inverse=True)
+    keys = np.zeros(len(svs), dtype=[('chr1', int), ('pos1', 'int64'), ('dir1', 'S1'),
+                                     ('chr2', int), ('pos2', 'int64'), ('dir2', 'S1')])
+    keys['chr1'], keys['chr2'] = chr_codes[:len(svs)], chr_codes[len(svs):]
+    for field in ['pos1', 'dir1', 'pos2', 'dir2']:
+        keys[field] = svs[field]
+    return keys
+
 def remove_duplicates(svs):
-    sv_ids = zip(svs['chr1'], svs['pos1'], svs['dir1'], svs['chr2'], svs['pos2'], svs['dir2'])
-    sv_ids = ['%s:%d:%s:%s:%d:%s:' % (c1, p1, d1, c2, p2, d2) for c1, p1, d1, c2, p2, d2 in sv_ids]
-    sv_ids, idxs = np.unique(sv_ids, return_index=True)
+    if len(svs) == 0:
+        return svs
+    keys, idxs = np.unique(get_sv_keys(svs), return_index=True)
     #svs['ID'] = range(0,len(svs)) #re-index
-    return svs[idxs]
+    return svs[np.sort(idxs)]
 
 def get_sv_pos_ranks(sv_list, threshold):
     '''
@@ -221,34 +268,37 @@ def get_sv_pos_ranks(sv_list, threshold):
 
     return ranks
 
-def set_svs_as_complex(svs, svmatch):
-    # ensure that svs are of the correct dtype
-    svs = np.array(svs, dtype=dtypes.sv_dtype)
-    svmatch = np.array(svmatch, dtype=dtypes.sv_dtype)
-    for match in svmatch:
-        for tmp_id in np.where(svs==match)[0]:
-            svs[tmp_id]['classification'] = 'COMPLEX'
+def set_svs_as_complex(svs, sv_idxs):
+    for tmp_id in sv_idxs:
+        svs[tmp_id]['classification'] = 'COMPLEX'
     return svs
 
-def split_dirs_dual_mixed_sv(svs, row, idx, ca, threshold):
+def add_inversion_partner(svs, n_svs, new_sv, bp_index):
+    '''
+    write new_sv into the next free slot of the preallocated svs array
+    '''
+    new_sv['ID'] = svs[n_svs-1]['ID']+1
+    svs[n_svs] = new_sv
+    bp_index.add(n_svs, new_sv)
+    return n_svs + 1
+
+def split_dirs_dual_mixed_sv(svs, n_svs, row, idx, ca, threshold, bp_index):
 
-    svmatch1, which1 = get_matching_svs(idx, svs[idx], svs[idx]['chr1'], \
-                                svs[idx]['pos1'], svs, threshold, mixed=True)
-    svmatch2, which2 = get_matching_svs(idx, svs[idx], svs[idx]['chr2'], \
-                                svs[idx]['pos2'], svs, threshold, mixed=True)
+    svmatch1, which1, idxs1 = get_matching_svs(idx, svs[idx], svs[idx]['chr1'], \
+                                svs[idx]['pos1'], svs, threshold, mixed=True, bp_index=bp_index)
+    svmatch2, which2, idxs2 = get_matching_svs(idx, svs[idx], svs[idx]['chr2'], \
+                                svs[idx]['pos2'], svs, threshold, mixed=True, bp_index=bp_index)
 
     if len(svmatch1) > 0 and len(svmatch2) > 0:
 
         if len(svmatch1) > 1 or len(svmatch2) > 1:
 
-            svs = set_svs_as_complex(svs, svmatch1)
-            svs = set_svs_as_complex(svs, svmatch2)
-            return svs
+            svs = set_svs_as_complex(svs, idxs1)
+            svs = set_svs_as_complex(svs, idxs2)
+            return n_svs
 
-        # ensure that svs are of the correct dtype
-        svs = np.array(svs, dtype=dtypes.sv_dtype)
-        other_idx1 = np.where(svs==svmatch1)[0][0]
-        other_idx2 = np.where(svs==svmatch2)[0][0]
+        other_idx1 = idxs1[0]
+        other_idx2 = idxs2[0]
 
         if svmatch1[0] == svmatch2[0]:
             # likely an inversion - both sides match same break
@@ -261,6 +311,9 @@ def split_dirs_dual_mixed_sv(svs, row, idx, ca, threshold):
             new_pos1, new_pos2 = ca[idx]['ca_left1'], ca[idx]['ca_left2']
             svs[other_idx1] = set_dir_class(svs[idx], '-', '-', '', new_pos1, new_pos2)
 
+            bp_index.update(idx, svs[idx])
+            bp_index.update(other_idx1, svs[other_idx1])
+
         elif len(which1[0]) == 1 and len(which2[0]) == 1:
             # break partners differ, 1 side matched - check for translocation
 
@@ -285,93 +338,177 @@ def split_dirs_dual_mixed_sv(svs, row, idx, ca, threshold):
                     new_pos2 = ca[idxs]['ca_right2'] if \
                                 dirs[1] == '+' else ca[idxs]['ca_left2']
                     svs[idxs] = set_dir_class(sv, dirs[0], dirs[1], '', new_pos1, new_pos2)
+                    bp_index.update(idxs, svs[idxs])
             else:
-                svs = set_svs_as_complex(svs, svmatch1)
-                svs = set_svs_as_complex(svs, svmatch2)
-                return svs
+                svs = set_svs_as_complex(svs, idxs1)
+                svs = set_svs_as_complex(svs, idxs2)
+                return n_svs
 
     elif len(svmatch1) == 0 and len(svmatch2) == 0:
         # probably an inversion that has no partner - not called by SV caller?
         new_pos1, new_pos2 = ca[idx]['ca_left1'], ca[idx]['ca_left2']
         svs[idx] = set_dir_class(svs[idx], '-', '-', '', new_pos1, new_pos2)
+        bp_index.update(idx, svs[idx])
 
         # create a new entry for the inversion partner
         new_sv = svs[idx].copy()
         new_pos1, new_pos2 = ca[idx]['ca_right1'], ca[idx]['ca_right2']
         new_sv = set_dir_class(new_sv, '+', '+', '', new_pos1, new_pos2)
-        new_sv['ID'] = svs[len(svs)-1]['ID']+1
-        svs = np.append(svs, new_sv)
+        n_svs = add_inversion_partner(svs, n_svs, new_sv, bp_index)
 
     else:
         # multiple matching events or only one matched - don't know how to deal with this
         svs[idx]['classification'] = 'UNKNOWN_DIR'
 
-    return svs
-
-def split_mixed_svs(svs, ca, threshold):
-    new_svs = []
-    for idx, row in enumerate(svs):
-
-        sv_class = np.array(row['classification'].split(';'))
-        if 'MIXED' in sv_class:
+    return n_svs
 
-            if 'UNKNOWN_DIR' in sv_class:
-                svs[idx]['classification'] = 'UNKNOWN_DIR'
-                break #can't fix this if one direction is unknown
-
-            elif len(sv_class) > 1 and sv_class[0] == 'MIXED' and sv_class[1] == 'MIXED':
-                new_svs = split_dirs_dual_mixed_sv(svs, row, idx, ca, threshold)
+def split_mixed_sv(svs, n_svs, idx, ca, threshold, bp_index):
+    '''
+    fix the directions of the MIXED SV at idx, returns the new SV count
+    '''
+    row = svs[idx]
+    sv_class = np.array(row['classification'].split(';'))
 
-            elif row['dir1'] in ['-','+']:
-                #set dir to -, create new sv with dir set to +
-                new_sv = svs[idx].copy()
-                new_pos2 = ca[idx]['ca_right2']
-                new_sv = set_dir_class(new_sv, row['dir1'], '+', '', 0, new_pos2)
-                new_sv['ID'] = svs[len(svs)-1]['ID']+1
-                svs[idx] = set_dir_class(svs[idx], row['dir1'], '-', '', 0, new_pos2)
+    if 'UNKNOWN_DIR' in sv_class:
+        svs[idx]['classification'] = 'UNKNOWN_DIR' #can't fix this if one direction is unknown
 
-                new_svs = np.append(svs, new_sv)
+    elif len(sv_class) > 1 and sv_class[0] == 'MIXED' and sv_class[1] == 'MIXED':
+        n_svs = split_dirs_dual_mixed_sv(svs, n_svs, row, idx, ca, threshold, bp_index)
 
-            elif row['dir2'] in ['-','+']:
-                #set dir to -, create new sv with dir set to +
-                new_sv = svs[idx].copy()
-                new_pos1 = ca[idx]['ca_right1']
-                new_sv = set_dir_class(new_sv, '+', row['dir2'], '', new_pos1, 0)
-                new_sv['ID'] = svs[len(svs)-1]['ID']+1
-                svs[idx] = set_dir_class(svs[idx], '-', row['dir2'], '', new_pos1, 0)
+    elif row['dir1'] in ['-','+']:
+        #set dir to -, create new sv with dir set to +
+        new_sv = svs[idx].copy()
+        new_pos2 = ca[idx]['ca_right2']
+        new_sv = set_dir_class(new_sv, row['dir1'], '+', '', 0, new_pos2)
+        svs[idx] = set_dir_class(svs[idx], row['dir1'], '-', '', 0, new_pos2)
+        bp_index.update(idx, svs[idx])
+        n_svs = add_inversion_partner(svs, n_svs, new_sv, bp_index)
+
+    elif row['dir2'] in ['-','+']:
+        #set dir to -, create new sv with dir set to +
+        new_sv = svs[idx].copy()
+        new_pos1 = ca[idx]['ca_right1']
+        new_sv = set_dir_class(new_sv, '+', row['dir2'], '', new_pos1, 0)
+        svs[idx] = set_dir_class(svs[idx], '-', row['dir2'], '', new_pos1, 0)
+        bp_index.update(idx, svs[idx])
+        n_svs = add_inversion_partner(svs, n_svs, new_sv, bp_index)
 
-                new_svs = np.append(svs, new_sv)
+    else:
+        svs[idx]['classification'] = 'UNKNOWN_DIR'
 
-            else:
-                svs[idx]['classification'] = 'UNKNOWN_DIR'
+    return n_svs
 
-            break #can only fix one set at a time
+def is_mixed(sv):
+    return 'MIXED' in sv['classification'].split(';')
 
-    if len(new_svs)>0:
-        return new_svs
-    else:
+def resolve_mixed_svs(svs, ca, threshold):
+    '''
+    Fix the directions of all MIXED SVs in one pass over the SV array.
+    SVs are fixed in array order: a fix only ever touches the current SV,
+    its (later) MIXED partners or newly added inversion partners, so an SV
+    is revisited until it is no longer MIXED (i.e. after its partners were
+    set as complex). Each MIXED SV adds at most one inversion partner, so
+    the output array is allocated once up front.
+    '''
+    mixed = [idx for idx, sv in enumerate(svs) if is_mixed(sv)]
+    if len(mixed) == 0:
         return svs
 
-def sv_in_blacklist(sv, blist):
+    n_svs = len(svs)
+    svs = np.concatenate([np.array(svs, dtype=dtypes.sv_dtype),
+                          np.zeros(len(mixed), dtype=dtypes.sv_dtype)])
+    bp_index = BreakpointIndex(svs[:n_svs])
 
-    for row in blist:
-        if sv['chr1'] == row[0]:
-            if sv['pos1'] >= row[1] and row[2] >= sv['pos1']:
-                return True
-        if sv['chr2'] == row[0]:
-            if sv['pos2'] >= row[1] and row[2] >= sv['pos2']:
-                return True
+    for idx in mixed:
+        while is_mixed(svs[idx]):
+            n_svs = split_mixed_sv(svs, n_svs, idx, ca, threshold, bp_index)
 
-    return False
+    svs = svs[:n_svs]
+    print('Resolved %d mixed direction SVs, %d mixed classifications remain' % \
+            (len(mixed), num_mixed_svs(svs)))
+    return svs
+
+def svs_in_blacklist(svs, blist):
+    '''
+    returns a boolean array, True for SVs with either break-end blacklisted
+    '''
+    if len(blist) == 0:
+        return np.zeros(len(svs), dtype=bool)
+    return blist.query_breakpoints(svs['chr1'], svs['pos1'], svs['chr2'], svs['pos2'])
 
-def infer_sv_dirs(svs, ca, bam, max_dep, sc_len, threshold, blist):
+def count_annotated_sv(sv, bam, rparams, read_cache):
+    '''
+    count the reads of an annotated SV from the reads fetched to annotate it,
+    returns its count key and counts, or None if the SV is not counted
+    '''
+    sv_classes = str(sv['classification']).split(';')
+    if any([svc in count.skip_classes for svc in sv_classes]) or \
+            sv['dir1'] not in ['+', '-'] or sv['dir2'] not in ['+', '-']:
+        return None
+
+    # count in the break-end order of the svin output, with only the count's
+    # own read fetch errors as classification
+    sv = sort_breakend_order(np.array([sv], dtype=sv.dtype))[0]
+    sv['classification'] = ''
+    empty = np.empty([0, len(dtypes.read_dtype)], dtype=dtypes.read_dtype)
+    sv_count = count.get_sv_read_counts(sv, bam, rparams, '', empty, empty, empty, read_cache)
+    return count.get_sv_key(sv), sv_count
+
+def annotate_count_sv(row, annotate, bam, rparams):
+    '''
+    annotate an SV, then count its reads from the same fetch per break-end.
+    The count windows lie within +/- 2*threshold of the annotate windows'
+    (re-)centred positions, so each break-end is fetched +/- max_ins +
+    2*threshold around its input position.
+    '''
+    read_cache = count.ReadCache(bam, rparams['max_ins'] + rparams['threshold'] * 2)
+    try:
+        result = annotate(row, read_cache=read_cache)
+        sv = result[0] if type(result) == tuple else result
+        return result, count_annotated_sv(sv, bam, rparams, read_cache)
+    finally:
+        read_cache.close()
+
+class SVCounts(object):
+    '''
+    read counts of SVs, taken during annotation from the reads fetched to
+    annotate each SV, keyed by count.get_sv_key
+    '''
+    def __init__(self, bam, rparams):
+        self.bam = bam
+        self.rparams = rparams
+        self.counts = {}
+
+    def map_annotate(self, annotate, svs, threads):
+        '''
+        map_svs(annotate, svs, threads), counting each SV after annotating it
+        '''
+        annotate_count = partial(annotate_count_sv, annotate=annotate,
+                                 bam=self.bam, rparams=self.rparams)
+        results = []
+        for result, sv_count in map_svs(annotate_count, svs, threads):
+            if sv_count is not None:
+                key, counts = sv_count
+                self.counts[key] = counts
+            results.append(result)
+        return results
+
+def map_annotate(annotate, svs, threads, sv_counts=None):
+    if sv_counts is None:
+        return map_svs(annotate, svs, threads)
+    return sv_counts.map_annotate(annotate, svs, threads)
+
+def infer_sv_dirs(svs, ca, bam, max_dep, sc_len, threshold, blist, threads=1, sv_counts=None):
 
     print('Inferring SV directions...')
-    for idx, sv in enumerate(svs):
-        if len(blist) > 0 and sv_in_blacklist(sv, blist):
-            svs[idx]['classification'] = 'BLACKLIST'
-            continue
-        svs[idx], ca[idx] = get_dir_info(sv, bam, max_dep, sc_len, threshold)
+    blacklisted = svs_in_blacklist(svs, blist)
+    svs['classification'][blacklisted] = 'BLACKLIST'
+
+    idxs = np.where(~blacklisted)[0]
+    get_dirs = partial(get_dir_info, bam=bam, max_dep=max_dep, sc_len=sc_len,
+                       threshold=threshold)
+    for idx, (sv, consens_aligns) in zip(idxs, map_annotate(get_dirs, svs[idxs], threads, sv_counts)):
+        svs[idx], ca[idx] = sv, consens_aligns
 
 #        tmp_out = '%s_dirout.txt' % out
 #        svs = np.genfromtxt(tmp_out, delimiter='\t', names=True, dtype=None, invalid_raise=False)
@@ -383,101 +520,116 @@ def infer_sv_dirs(svs, ca, bam, max_dep, sc_len, threshold, blist):
 #            for sv_out in svs:
 #                writer.writerow(sv_out)
 
-    while num_mixed_svs(svs)>0:
-
-        before = num_mixed_svs(svs)
-        svs = split_mixed_svs(svs, ca, threshold)
-        after = num_mixed_svs(svs)
-        print('%d mixed classifications remain' % after)
-
-        # to prevent infinite loops...
-        if before == after:
-            print('Failed to fix mixed direction SVs. Skipping...')
-            break
+    svs = resolve_mixed_svs(svs, ca, threshold)
 
     return svs, ca
 
-def nice_sort(ids):
+def natural_key(text):
     # takes into account characters and numbers to sort data intuitively
-    convert = lambda text: int(text) if text.isdigit() else text
-    alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
-    return sorted(ids, key = alphanum_key)
+    return [int(c) if c.isdigit() else c for c in re.split('([0-9]+)', text)]
+
+def nice_sort(ids):
+    return sorted(ids, key = natural_key)
+
+def natural_ranks(values, suffix=''):
+    '''
+    rank of each string in natural sort order (of string + suffix),
+    strings with equal keys get equal ranks
+    '''
+    uniq, inverse = np.unique(values, return_inverse=True)
+    keys = [natural_key(str(u) + suffix) for u in uniq]
+    ranks = np.zeros(len(uniq), dtype=int)
+    rank, prev_key = -1, None
+    for idx in sorted(range(len(uniq)), key = lambda i: keys[i]):
+        if keys[idx] != prev_key:
+            rank, prev_key = rank + 1, keys[idx]
+        ranks[idx] = rank
+    return ranks[inverse]
 
 def sort_breakend_order(svs):
     '''
     per sv, ensure chrom1, chrom2 and pos1, pos2 are ordered
     '''
     svs = svs.copy()
-    for sv in np.nditer(svs, op_flags=['readwrite']):
-        if sv['chr1'] == sv['chr2']:
-            if sv['pos1'] > sv['pos2']:
-                ts = sv.copy()
-                sv['pos1'], sv['dir1'] = ts['pos2'], ts['dir2']
-                sv['pos2'], sv['dir2'] = ts['pos1'], ts['dir1']
-        else:
-            chrs = [str(sv['chr1']), str(sv['chr2'])]
-            if not np.all(np.array(chrs) == np.array(nice_sort(chrs))):
-                ts = sv.copy()
-                sv['chr1'], sv['pos1'], sv['dir1'] = ts['chr2'], ts['pos2'], ts['dir2']
-                sv['chr2'], sv['pos2'], sv['dir2'] = ts['chr1'], ts['pos1'], ts['dir1']
+    if len(svs) == 0:
+        return svs
+
+    ranks = natural_ranks(np.concatenate([svs['chr1'], svs['chr2']]))
+    rank1, rank2 = ranks[:len(svs)], ranks[len(svs):]
+    same_chr = svs['chr1'] == svs['chr2']
+    swap = np.logical_or(np.logical_and(same_chr, svs['pos1'] > svs['pos2']),
+                         np.logical_and(~same_chr, rank2 < rank1))
+
+    for field1, field2 in [('chr1', 'chr2'), ('pos1', 'pos2'), ('dir1', 'dir2')]:
+        tmp = svs[field1][swap]
+        svs[field1][swap] = svs[field2][swap]
+        svs[field2][swap] = tmp
     return svs
 
 def sort_svs(svs):
-    sv_ids = zip(svs['chr1'], svs['pos1'], svs['dir1'], svs['chr2'], svs['pos2'], svs['dir2'])
-    sv_ids = ['%s:%d:%s:%s:%d:%s:' % (c1, p1, d1, c2, p2, d2) for c1, p1, d1, c2, p2, d2 in sv_ids]
-    sv_ids_sorted = nice_sort(sv_ids)
-    sv_idx = [np.where(sid == np.array(sv_ids))[0][0] for sid in sv_ids_sorted]
-    svs = np.array(svs)[sv_idx]
-    return svs
+    '''
+    natural sort of svs by chr1, pos1, dir1, chr2, pos2, dir2, giving the
+    same order as natural sorting 'chr1:pos1:dir1:chr2:pos2:dir2:' strings
+    '''
+    svs = np.array(svs)
+    if len(svs) == 0:
+        return svs
+
+    # the ':' field separators take part in the string comparisons
+    ranks = natural_ranks(np.concatenate([svs['chr1'], svs['chr2']]), suffix=':')
+    rank1, rank2 = ranks[:len(svs)], ranks[len(svs):]
+    dir1 = np.where(svs['dir1'] == '', ':', svs['dir1'])
+    dir2 = np.where(svs['dir2'] == '', ':', svs['dir2'])
+    order = np.lexsort((dir2, svs['pos2'], rank2, dir1, svs['pos1'], rank1))
+
+    # SVs with identical breakpoints all take the values of the first one
+    keys, first_idxs, key_idxs = np.unique(get_sv_keys(svs), return_index=True, return_inverse=True)
+    return svs[first_idxs[key_idxs[order]]]
 
 def classify_svs(svs, threshold):
     svs = sort_breakend_order(svs)
 
     # classify inter-chromosomal translocations in chroms don't match
-    inter_svs = np.array(filter(lambda sv: sv['chr1'] != sv['chr2'], svs))
-    if len(inter_svs) > 0:
-        for sv in np.nditer(inter_svs, op_flags=['readwrite']):
-            sv['classification'] = 'INTRX'
+    is_intra = svs['chr1'] == svs['chr2']
+    inter_svs = svs[~is_intra]
+    inter_svs['classification'] = 'INTRX'
 
     # extract only rearrangements from same chromosomes for classifying
-    intra_svs = np.array(filter(lambda sv: sv['chr1'] == sv['chr2'], svs))
+    intra_svs = svs[is_intra]
     if len(intra_svs) > 0:
         intra_svs = sort_svs(intra_svs)
 
-        sv_id = 0
-        svd_prev_result, prev_sv = None, None
         trx_label = svd.getResultType([svd.SVtypes.translocation])
         intins_label = svd.getResultType([svd.SVtypes.interspersedDuplication])
 
-        for idx in range(len(intra_svs)):
-            sv = intra_svs[idx]
-            if sv['classification'] == '':
-                sv_class, sv_id, svd_prev_result, prev_sv = \
-                    classify_event(sv, sv_id, svd_prev_result, prev_sv)
-                sv['classification'] = sv_class
-            else:
-                sv_id += 1
-            sv['ID'] = sv_id
+        to_classify = intra_svs['classification'] == ''
+        results = svd.detectAll(intra_svs, to_classify)
+        labels = dict([(r, svd.getResultType([r])) for r in np.unique(results)])
+        intra_svs['classification'][to_classify] = [labels[r] for r in results[to_classify]]
+
+        # each event gets a new ID, interspersed duplications share the previous ID
+        is_intins = np.logical_and(to_classify, results == svd.SVtypes.interspersedDuplication)
+        intra_svs['ID'] = np.cumsum(~is_intins)
 
         # reclassify once all have been processed
-        for idx in range(len(intra_svs)):
+        del_index = svd.buildDeletionIndex(intra_svs)
+        intins_idxs = list(np.where(intra_svs['classification'] == intins_label)[0])
+        if len(intins_idxs) > 0 and intins_idxs[0] == 0 and intins_idxs[-1] != len(intra_svs) - 1:
+            # the first SV's predecessor wraps around to the last SV
+            intins_idxs.append(len(intra_svs) - 1)
+
+        for idx in intins_idxs:
             sv = intra_svs[idx]
             if sv['classification'] == intins_label:
                 intra_svs[idx-1]['classification'] = intins_label
-                translocs = svd.detectTransloc(idx, intra_svs, threshold)
+                translocs = svd.detectTranslocIndexed(idx, intra_svs, threshold, del_index)
                 if len(translocs) > 0:
                     new_idx = idx-1
                     for i in translocs:
                         intra_svs[i]['classification'] = trx_label
                         intra_svs[i]['ID'] = new_idx
 
-    if len(intra_svs) > 0 and len(inter_svs) > 0:
-        svs = np.concatenate([intra_svs, inter_svs])
-    elif len(intra_svs) > 0:
-        svs = intra_svs
-    elif len(inter_svs) > 0:
-        svs = inter_svs
-
+    svs = np.concatenate([intra_svs, inter_svs])
     svs = remove_duplicates(svs)
     svs = sort_svs(svs)
     return svs
@@ -493,7 +645,11 @@ def write_svs(svs, outname):
 def string_to_bool(v):
   return v.lower() in ("yes", "true", "t", "1")
 
-def preproc_svs(args):
+def preproc_svs(args, sv_counts=None):
+    '''
+    annotate the SVs, if sv_counts (an SVCounts) is given, the SVs whose reads
+    are fetched for annotation are also counted
+    '''
 
     svin         = args.svin
     bam          = args.bam
@@ -501,6 +657,8 @@ def preproc_svs(args):
     sample       = args.sample
     sv_format    = args.sv_format
     blist_file   = args.blist
+    regions      = args.regions
+    threads      = args.threads
 
     cfg = args.cfg
     Config = ConfigParser.ConfigParser()
@@ -535,10 +693,13 @@ def preproc_svs(args):
     if out!='' and not os.path.exists(out):
         os.makedirs(out)
 
+    if regions != '' and sv_format != 'vcf':
+        raise ValueError('Restricting SVs to regions is only supported for VCF input.')
+
     svs = np.empty(0)
     print('Loading SV calls...')
     if sv_format == 'vcf':
-        svs = svp_load_data.load_input_vcf(svin, class_field, use_dir)
+        svs = svp_load_data.load_input_vcf(svin, class_field, use_dir, regions)
     elif sv_format == 'simple':
         svs = svp_load_data.load_input_simple(svin, use_dir, class_field)
     elif sv_format == 'socrates':
@@ -546,25 +707,14 @@ def preproc_svs(args):
     else:
         raise ValueError('Valid input format not specified.')
 
-    blist = np.empty(0)
-    if blist_file != '':
-        blist = svp_load_data.load_blacklist(blist_file)
+    blist = load_blacklist_index(blist_file)
 
     consens_dtype = [('ca_right1', int), ('ca_left1', int), \
                         ('ca_right2', int), ('ca_left2', int)]
     ca = np.zeros(len(svs), dtype=consens_dtype)
 
-    if rlen < 0:
-        rlen = bamtools.estimateTagSize(bam)
-
-    inserts = [insert_mean, insert_std]
-    if rlen < 0:
-        rlen = bamtools.estimateTagSize(bam)
-    if inserts[0] < 0 or inserts[1] < 0:
-        inserts = bamtools.estimateInsertSizeDistribution(bam)
-        inserts = (max(rlen*2,inserts[0]),inserts[1])
-    else:
-        inserts[0] = inserts[0]
+    rlen, inserts, mean_cov = lib_stats.get_lib_params(bam, sample, out, rlen, insert_mean,
+                                                       insert_std, mean_cov)
 
     max_ins = inserts[0]+(3*inserts[1]) #max fragment size = mean fragment len + (fragment std * 3)
     max_dep = ((mean_cov*(max_ins*2))/rlen)*max_cn
@@ -576,33 +726,36 @@ def preproc_svs(args):
             outp.write('%s\t%d\t%f\t%f\n\n'%(sample,rlen,inserts[0],inserts[1]))
 
     if not use_dir:
-        svs, ca = infer_sv_dirs(svs, ca, bam, max_dep, sc_len, threshold, blist)
+        svs, ca = infer_sv_dirs(svs, ca, bam, max_dep, sc_len, threshold, blist, threads, sv_counts)
     elif not trust_sc_pos:
         print('Recalibrating consensus alignments...')
         # set BP pos to softclip position
-        for idx, sv in enumerate(svs):
-            if len(blist) > 0 and sv_in_blacklist(sv, blist):
-                svs[idx]['classification'] = 'BLACKLIST'
-                continue
-
-            sv_tmp, loc1_reads, loc2_reads, err_code1, err_code2 = \
-                retrieve_loc_reads(sv.copy(), bam, max_dep, threshold)
-
-            if err_code1 != 0 or err_code2 != 0:
-                continue
-
-            ca_right, ca_left = get_consensus_align(loc1_reads, sv['pos1'], threshold)
-            new_align = ca_right if sv['dir1'] == '+' else ca_left
-            if new_align != 0:
-                svs[idx]['pos1'] = new_align
-
-            ca_right, ca_left = get_consensus_align(loc2_reads, sv['pos2'], threshold)
-            new_align = ca_right if sv['dir2'] == '+' else ca_left
-            if new_align != 0:
-                svs[idx]['pos2'] = new_align
+        blacklisted = svs_in_blacklist(svs, blist)
+        svs['classification'][blacklisted] = 'BLACKLIST'
 
+        idxs = np.where(~blacklisted)[0]
+        recalibrate = partial(recalibrate_sv_pos, bam=bam, max_dep=max_dep, threshold=threshold)
+        for idx, sv in zip(idxs, map_annotate(recalibrate, svs[idxs], threads, sv_counts)):
+            svs[idx] = sv
 
     print('Classifying SVs...')
     svs = classify_svs(svs, threshold)
     print('Writing SV output...')
     write_svs(svs, outname)
+
+    return outname
+
+def preproc_count_svs(args):
+    '''
+    run annotate then count. SVs are counted as they are annotated, from the
+    reads fetched to annotate them (one fetch per break-end), SVs whose reads
+    were not fetched for annotation are counted by count as usual.
+    '''
+    out = args.sample if args.out == "" else args.out
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    sv_counts = SVCounts(args.bam, count.get_params(args.cfg, args.bam, args.sample, out))
+    svin = preproc_svs(args, sv_counts)
+    print('Counting reads...')
+    count.count_svs(svin, args.bam, args.sample, out, args.cfg, sv_counts.counts)
@@ -0,0 +1,81 @@
+'''
+Per-chromosome interval index of BED regions (i.e. blacklists)
+'''
+import numpy as np
+
+from . import svp_load_data
+
+class IntervalIndex(object):
+    '''
+    Merged, sorted intervals per chromosome from a BED array as returned by
+    svp_load_data.load_blacklist. Intervals are treated as closed, matching
+    the original start <= pos <= end blacklist checks. Lookups are done by
+    bisection (searchsorted) on the sorted interval starts.
+    '''
+    def __init__(self, blist=None):
+        self.starts = {}
+        self.ends = {}
+        if blist is not None and len(blist) > 0:
+            self.build(blist)
+
+    def build(self, blist):
+        self.starts, self.ends = {}, {}
+        names = blist.dtype.names
+        chroms = np.array(blist[names[0]]).astype(str)
+        starts = np.array(blist[names[1]], dtype=int)
+        ends = np.array(blist[names[2]], dtype=int)
+
+        for chrom in np.unique(chroms):
+            is_chr = chroms == chrom
+            self.starts[chrom], self.ends[chrom] = \
+                merge_intervals(starts[is_chr], ends[is_chr])
+
+    def __len__(self):
+        return sum([len(s) for s in self.starts.values()])
+
+    def query_points(self, chroms, positions):
+        '''
+        returns a boolean array, True where the position lies in an interval
+        '''
+        chroms = np.atleast_1d(np.asarray(chroms)).astype(str)
+        positions = np.atleast_1d(np.asarray(positions)).astype(int)
+        hits = np.zeros(len(positions), dtype=bool)
+
+        for chrom in np.unique(chroms):
+            if chrom not in self.starts:
+                continue
+            is_chr = chroms == chrom
+            pos = positions[is_chr]
+            starts, ends = self.starts[chrom], self.ends[chrom]
+            idxs = np.searchsorted(starts, pos, side='right') - 1
+            hits[is_chr] = np.logical_and(idxs >= 0, pos <= ends[np.maximum(idxs, 0)])
+
+        return hits
+
+    def query_breakpoints(self, chr1, pos1, chr2, pos2):
+        '''
+        returns a boolean array, True where either break-end lies in an interval
+        '''
+        return np.logical_or(self.query_points(chr1, pos1), self.query_points(chr2, pos2))
+
+def merge_intervals(starts, ends):
+    '''
+    sort and merge overlapping closed intervals
+    '''
+    order = np.argsort(starts, kind='mergesort')
+    starts, ends = starts[order], ends[order]
+
+    # a new merged interval begins where the start lies past all previous ends
+    prev_max_end = np.maximum.accumulate(ends)
+    new_block = np.ones(len(starts), dtype=bool)
+    new_block[1:] = starts[1:] > prev_max_end[:-1]
+    block_last = np.append(new_block[1:], True)
+    return starts[new_block], prev_max_end[block_last]
+
+def load_blacklist_index(blist_file):
+    '''
+    load a BED blacklist into an IntervalIndex, empty if no file is given
+    '''
+    if blist_file == '' or blist_file.lower() == 'none':
+        return IntervalIndex()
+    return IntervalIndex(svp_load_data.load_blacklist(blist_file))
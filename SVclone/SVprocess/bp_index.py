@@ -0,0 +1,57 @@
+'''
+Per-chromosome sorted index of SV break-ends
+'''
+import bisect
+
+class BreakpointIndex(object):
+    '''
+    Sorted index of the break-ends of an SV array. Each chromosome holds
+    a sorted list of (pos, sv_idx, bp_num) entries, where bp_num is 1 or 2,
+    allowing +/- threshold range queries by bisection. Entries must be kept
+    in sync with the SV array via add/update when SVs are appended or moved.
+    '''
+    def __init__(self, svs=None):
+        self.bps = {}
+        self.locs = {}
+        if svs is not None:
+            self.build(svs)
+
+    def build(self, svs):
+        self.bps, self.locs = {}, {}
+        for idx, sv in enumerate(svs):
+            self.locs[idx] = []
+            for bp_num, chrom, pos in get_break_ends(sv):
+                self.bps.setdefault(chrom, []).append((pos, idx, bp_num))
+                self.locs[idx].append((chrom, pos, bp_num))
+        for chrom in self.bps:
+            self.bps[chrom].sort()
+
+    def add(self, idx, sv):
+        self.locs[idx] = []
+        for bp_num, chrom, pos in get_break_ends(sv):
+            bisect.insort(self.bps.setdefault(chrom, []), (pos, idx, bp_num))
+            self.locs[idx].append((chrom, pos, bp_num))
+
+    def remove(self, idx):
+        for chrom, pos, bp_num in self.locs.pop(idx, []):
+            entries = self.bps[chrom]
+            i = bisect.bisect_left(entries, (pos, idx, bp_num))
+            if i < len(entries) and entries[i] == (pos, idx, bp_num):
+                del entries[i]
+
+    def update(self, idx, sv):
+        self.remove(idx)
+        self.add(idx, sv)
+
+    def query(self, chrom, pos, threshold):
+        '''
+        returns (sv_idx, bp_num) of all break-ends on chrom lying strictly
+        within (pos - threshold, pos + threshold), ordered by sv_idx, bp_num
+        '''
+        entries = self.bps.get(str(chrom), [])
+        lo = bisect.bisect_left(entries, (int(pos) - threshold + 1,))
+        hi = bisect.bisect_left(entries, (int(pos) + threshold,))
+        return sorted([(idx, bp_num) for p, idx, bp_num in entries[lo:hi]])
+
+def get_break_ends(sv):
+    return [(1, str(sv['chr1']), int(sv['pos1'])), (2, str(sv['chr2']), int(sv['pos2']))]
@@ -8,11 +8,12 @@ import numpy as np
 import pysam
 import csv
 import vcf
+import bisect
 
 from collections import OrderedDict
 from operator import methodcaller
 
-from . import bamtools
+from . import lib_stats
 from . import svDetectFuncs as svd
 from . import svp_dtypes as dtypes
 
@@ -175,6 +176,75 @@ def get_loc_reads(bp,bamf,max_dp):
         err_code = 2
         return np.empty(0), err_code
 
+# default maximum number of reads held by a ReadCache
+read_cache_max_reads = 2000000
+
+class ReadCache(object):
+    '''
+    Reads fetched around an SV's break-ends, for annotating and counting
+    the SV from one fetch per break-end. A window not covered by the cache
+    is fetched +/- span around its centre, later windows within that range
+    are cut from memory with the same overlap rule as a BAM fetch. Holds at
+    most max_reads reads, evicting the oldest fetches first.
+    '''
+    def __init__(self,bam,span,max_reads=read_cache_max_reads):
+        self.bamf = pysam.AlignmentFile(bam, "rb")
+        self.span = span
+        self.max_reads = max_reads
+        self.n_reads = 0
+        self.windows = OrderedDict()
+        self.centres = {}
+
+    def close(self):
+        self.bamf.close()
+
+    def find_window(self,chrom,start,end):
+        centres = self.centres.get(chrom,[])
+        i = bisect.bisect_left(centres,(start+end)/2)
+        for centre in centres[max(0,i-1):i+1]:
+            w_start, w_end, reads = self.windows[(chrom,centre)]
+            if w_start <= start and end <= w_end:
+                return reads
+        return None
+
+    def add_window(self,chrom,centre,w_start,w_end,reads):
+        key = (chrom,centre)
+        if key in self.windows:
+            return
+        self.windows[key] = (w_start,w_end,reads)
+        bisect.insort(self.centres.setdefault(chrom,[]),centre)
+        self.n_reads += len(reads)
+        while self.n_reads > self.max_reads and len(self.windows) > 1:
+            (old_chrom,old_centre),(w_start,w_end,old_reads) = self.windows.popitem(last=False)
+            self.centres[old_chrom].remove(old_centre)
+            self.n_reads -= len(old_reads)
+
+    def get_loc_reads(self,bp,max_dp):
+        '''
+        same output as get_loc_reads for the bp window
+        '''
+        chrom, start, end = str(bp['chrom']), max(0,int(bp['start'])), int(bp['end'])
+        reads = self.find_window(chrom,start,end)
+
+        if reads is None:
+            centre = (start+end)/2
+            w_start, w_end = min(start,max(0,centre-self.span)), max(end,centre+self.span)
+            # allow the same read depth per base as for the requested window
+            w_max_dp = max_dp * (w_end-w_start) / float(max(1,end-start))
+            w_bp = np.array((chrom,w_start,w_end,bp['dir']),dtype=dtypes.bp_dtype)
+            reads, err_code = get_loc_reads(w_bp,self.bamf,w_max_dp)
+            if err_code != 0:
+                return get_loc_reads(bp,self.bamf,max_dp)
+            self.add_window(chrom,centre,w_start,w_end,reads)
+
+        if len(reads) > 0:
+            # reads overlapping the (1-based, inclusive) region, as fetched
+            reads = reads[np.logical_and(reads['ref_start'] < end, reads['ref_end'] > start-1)]
+        if len(reads) > max_dp:
+            print('Read depth too high at %s:%d:%d' % (chrom,start,end))
+            return np.empty(0), 1
+        return reads, 0
+
 def reads_to_sam(reads,bam,bp1,bp2,dirout,name):
     '''
     For testing read assignemnts.
@@ -324,7 +394,7 @@ def get_spanning_counts(reproc,rc,bp1,bp2,inserts,min_ins,max_ins,threshold):
             anomalous = np.append(anomalous,r2)
     return rc,span_bp1,span_bp2,anomalous
 
-def get_sv_read_counts(row,bam,rparams,out,split_reads,span_reads,anom_reads):
+def get_sv_read_counts(row,bam,rparams,out,split_reads,span_reads,anom_reads,read_cache=None):
     inserts, min_ins, max_ins, max_dp = rparams['insert'], rparams['min_ins'], rparams['max_ins'], rparams['max_dp']
     threshold, sc_len, norm_overlap = rparams['threshold'], rparams['threshold'], rparams['norm_overlap']
 
@@ -348,10 +418,14 @@ def get_sv_read_counts(row,bam,rparams,out,split_reads,span_reads,anom_reads):
         #one or both breaks don't have a valid direction
         return rc, split_reads, span_reads, anom_reads
 
-    bamf = pysam.AlignmentFile(bam, "rb")
-    loc1_reads, err_code1 = get_loc_reads(bp1,bamf,max_dp)
-    loc2_reads, err_code2 = get_loc_reads(bp2,bamf,max_dp)
-    bamf.close()
+    if read_cache is None:
+        bamf = pysam.AlignmentFile(bam, "rb")
+        loc1_reads, err_code1 = get_loc_reads(bp1,bamf,max_dp)
+        loc2_reads, err_code2 = get_loc_reads(bp2,bamf,max_dp)
+        bamf.close()
+    else:
+        loc1_reads, err_code1 = read_cache.get_loc_reads(bp1,max_dp)
+        loc2_reads, err_code2 = read_cache.get_loc_reads(bp2,max_dp)
 
     if not (err_code1==0 and err_code2==0) or (len(loc1_reads)==0 or len(loc2_reads)==0):
         sv_class = str(row['classification'])
@@ -417,14 +491,8 @@ def get_params(cfg,bam,sample,out):
     insert_std   = float(Config.get('BamParameters', 'insert_std'))
     write_anom   = string_to_bool(Config.get('DebugParameters', 'write_anomalous'))
 
-    inserts = [insert_mean,insert_std]
-    if rlen<0:
-        rlen = bamtools.estimateTagSize(bam)
-    if inserts[0]<0 or inserts[1]<0:
-        inserts = bamtools.estimateInsertSizeDistribution(bam)
-        inserts = (max(rlen*2,inserts[0]),inserts[1])
-    else:
-        inserts[0] = inserts[0]
+    rlen, inserts, mean_cov = lib_stats.get_lib_params(bam, sample, out, rlen, insert_mean,
+                                                       insert_std, mean_cov)
 
     max_ins = inserts[0]+(3*inserts[1]) #max fragment size = mean fragment len + (fragment std * 3)
     min_ins = rlen*2
@@ -496,7 +564,27 @@ def recount_anomalous_reads(bam,outname,anom_reads,max_dp,max_ins):
             writer = csv.writer(outf,delimiter='\t',quoting=csv.QUOTE_NONE)
             writer.writerow(row)
 
-def extract_sv_info(svin, bam, rparams, outname):
+# SVs of these classes are not counted
+skip_classes = ['BLACKLIST', 'UNKNOWN_DIR', 'HIDEP', 'MIXED', 'READ_FETCH_FAILED']
+
+def get_sv_key(row):
+    return (str(row['chr1']), int(row['pos1']), str(row['dir1']),
+            str(row['chr2']), int(row['pos2']), str(row['dir2']))
+
+def get_counted_sv(row, sv_count):
+    '''
+    the counts of an SV counted during annotation, with the row's ID and
+    classification (and any read fetch error of the count)
+    '''
+    rc, split, span, anom = sv_count
+    rc = rc.copy()
+    sv_class, err_class = str(row['classification']), str(rc['classification'])
+    rc['ID'] = row['ID']
+    rc['classification'] = err_class if sv_class == '' else \
+                           sv_class if err_class == '' else sv_class+';'+err_class
+    return rc, split, span, anom
+
+def extract_sv_info(svin, bam, rparams, outname, sv_counts=None):
     out = os.path.dirname(outname)
     header_out = [h[0] for idx,h in enumerate(dtypes.sv_out_dtype)] # write header output
     with open(outname,'w') as outf:
@@ -523,7 +611,7 @@ def extract_sv_info(svin, bam, rparams, outname):
 
         skip = False
         for svc in row[sv_class].split(';'):
-            if svc in ['BLACKLIST', 'UNKNOWN_DIR', 'HIDEP', 'MIXED', 'READ_FETCH_FAILED']:
+            if svc in skip_classes:
                 skip = True
                 break
         if skip:
@@ -531,8 +619,15 @@ def extract_sv_info(svin, bam, rparams, outname):
             continue
 
         #print('processing %s'%sv_str)
-        sv_rc, split_reads, span_reads, anom_reads = \
-                get_sv_read_counts(row,bam,rparams,out,split_reads,span_reads,anom_reads)
+        sv_key = get_sv_key(row)
+        if sv_counts is not None and sv_key in sv_counts:
+            sv_rc, split, span, anom = get_counted_sv(row, sv_counts[sv_key])
+            split_reads = np.append(split_reads,split)
+            span_reads = np.append(span_reads,span)
+            anom_reads = np.append(anom_reads,anom)
+        else:
+            sv_rc, split_reads, span_reads, anom_reads = \
+                    get_sv_read_counts(row,bam,rparams,out,split_reads,span_reads,anom_reads)
 
         norm1 = int(sv_rc['split_norm1'] + sv_rc['span_norm1'])
         norm2 = int(sv_rc['split_norm2'] + sv_rc['span_norm2'])
@@ -564,6 +659,9 @@ def proc_svs(args):
     out          = args.out
     cfg          = args.cfg
 
+    count_svs(svin, bam, sample, out, cfg)
+
+def count_svs(svin, bam, sample, out, cfg, sv_counts=None):
     out = sample if out == "" else out
     outname = '%s/%s_svinfo.txt' % (out, sample)
 
@@ -571,7 +669,7 @@ def proc_svs(args):
         os.makedirs(out)
 
     rparams = get_params(cfg, bam, sample, out)
-    split_reads, span_reads, anom_reads = extract_sv_info(svin, bam, rparams, outname)
+    split_reads, span_reads, anom_reads = extract_sv_info(svin, bam, rparams, outname, sv_counts)
 
     if rparams['write_anom']:
         write_anomalous_read_to_bam(bam,split_reads,span_reads,anom_reads,out)
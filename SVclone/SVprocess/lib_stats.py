@@ -0,0 +1,184 @@
+'''
+Library statistics (read length, insert size distribution and mean coverage)
+estimated from alignments sampled across the genome. Results are cached in
+a sidecar file in the output directory, keyed by the BAM's fingerprint.
+'''
+from __future__ import print_function
+
+import os
+import numpy as np
+import pysam
+
+stats_fields = ['read_len', 'insert_mean', 'insert_std', 'mean_cov', 'paired']
+
+def get_bam_fingerprint(bam):
+    '''
+    (path, size, mtime) of the BAM; hashing the content of a BAM
+    would cost more than re-estimating the statistics
+    '''
+    stat = os.stat(bam)
+    return [os.path.abspath(bam), str(stat.st_size), repr(stat.st_mtime)]
+
+def select_regions(samfile, n_regions, region_len):
+    '''
+    n_regions evenly spaced along the genome (the concatenated contigs with
+    mapped reads in the index), so contigs are sampled by their length
+    '''
+    mapped = dict([(s.contig, s.mapped) for s in samfile.get_index_statistics()])
+    contigs = [(c, l) for c, l in zip(samfile.references, samfile.lengths) if mapped.get(c, 0) > 0]
+    if len(contigs) == 0:
+        return []
+
+    ends = np.cumsum([l for c, l in contigs])
+    offsets = (np.arange(n_regions) + 0.5) * (ends[-1] / float(n_regions))
+    idxs = np.searchsorted(ends, offsets, side='right')
+
+    regions = []
+    for offset, idx in zip(offsets, idxs):
+        contig, length = contigs[idx]
+        start = int(offset - (ends[idx] - length))
+        regions.append((contig, start, min(start + region_len, length)))
+    return regions
+
+def is_primary(read):
+    return not (read.is_unmapped or read.is_secondary or read.is_supplementary or \
+                read.is_duplicate or read.is_qcfail)
+
+def sample_reads(samfile, regions, reads_per_region):
+    '''
+    iterate up to reads_per_region primary alignments from each region,
+    or from the start of the file if the BAM is not indexed
+    '''
+    if regions is None:
+        for read in samfile.head(reads_per_region):
+            yield read
+        return
+
+    for contig, start, end in regions:
+        n = 0
+        for read in samfile.fetch(contig, start, end):
+            if not is_primary(read):
+                continue
+            yield read
+            n += 1
+            if n == reads_per_region:
+                break
+
+def estimate_coverage(samfile, rlen):
+    '''
+    mean coverage from the index's mapped read counts over the contigs
+    that have mapped reads
+    '''
+    stats = [s for s in samfile.get_index_statistics() if s.mapped > 0]
+    lengths = dict(zip(samfile.references, samfile.lengths))
+    genome_len = sum([lengths[s.contig] for s in stats])
+    if genome_len == 0:
+        return 0.
+    return sum([s.mapped for s in stats]) * rlen / float(genome_len)
+
+def estimate_lib_stats(bam, n_regions=200, reads_per_region=500, region_len=100000):
+    samfile = pysam.AlignmentFile(bam)
+    indexed = samfile.has_index()
+    regions = select_regions(samfile, n_regions, region_len) if indexed else None
+    if not indexed:
+        print('WARNING: BAM is not indexed, estimating library statistics from the first alignments only.')
+        reads_per_region = n_regions * reads_per_region
+
+    lens, inserts, paired = [], [], False
+    for read in sample_reads(samfile, regions, reads_per_region):
+        rlen = read.query_length if read.query_length > 0 else read.infer_query_length()
+        if rlen > 0:
+            lens.append(rlen)
+        if read.is_paired:
+            paired = True
+            # only take positive lengths to avoid double counting
+            if read.is_proper_pair and read.tlen > 0:
+                inserts.append(read.tlen)
+
+    if len(lens) == 0:
+        samfile.close()
+        raise ValueError('No aligned reads found in %s to estimate library statistics' % bam)
+
+    # the most common length, as reads may be trimmed
+    sizes, counts = np.unique(lens, return_counts=True)
+    rlen = int(sizes[np.argmax(counts)])
+    insert_mean = float(np.mean(inserts)) if len(inserts) > 0 else float('nan')
+    insert_std = float(np.std(inserts)) if len(inserts) > 0 else float('nan')
+    mean_cov = estimate_coverage(samfile, rlen) if indexed else float('nan')
+    samfile.close()
+
+    return {'read_len': rlen, 'insert_mean': insert_mean, 'insert_std': insert_std,
+            'mean_cov': mean_cov, 'paired': paired}
+
+def read_stats_file(stats_file, bam):
+    '''
+    cached statistics if the sidecar's fingerprint matches the BAM
+    '''
+    if not os.path.exists(stats_file):
+        return None
+    try:
+        with open(stats_file) as f:
+            header = f.readline().rstrip('\n').split('\t')
+            values = dict(zip(header, f.readline().rstrip('\n').split('\t')))
+        if [values['bam'], values['size'], values['mtime']] != get_bam_fingerprint(bam):
+            return None
+        stats = dict([(field, float(values[field])) for field in stats_fields])
+    except (KeyError, ValueError):
+        return None
+    stats['read_len'] = int(stats['read_len'])
+    stats['paired'] = bool(stats['paired'])
+    return stats
+
+def write_stats_file(stats_file, bam, stats):
+    header = ['bam', 'size', 'mtime'] + stats_fields
+    values = get_bam_fingerprint(bam) + [str(stats['read_len']), repr(stats['insert_mean']),
+                repr(stats['insert_std']), repr(stats['mean_cov']), str(int(stats['paired']))]
+    with open(stats_file, 'w') as outp:
+        outp.write('\t'.join(header) + '\n')
+        outp.write('\t'.join(values) + '\n')
+
+def get_lib_stats(bam, sample, out):
+    stats_file = '%s/%s_lib_stats.txt' % (out, sample)
+    stats = read_stats_file(stats_file, bam)
+    if stats is not None:
+        print('Using library statistics from %s' % stats_file)
+        return stats
+
+    print('Estimating library statistics from alignments sampled across the genome...')
+    stats = estimate_lib_stats(bam)
+    if out != '' and os.path.exists(out):
+        write_stats_file(stats_file, bam, stats)
+    return stats
+
+def get_lib_params(bam, sample, out, rlen, insert_mean, insert_std, mean_cov):
+    '''
+    returns read length, (insert mean, insert std) and mean coverage, where
+    the parameters set to < 0 are replaced by values estimated from the BAM
+    '''
+    inserts = (insert_mean, insert_std)
+    if rlen >= 0 and insert_mean >= 0 and insert_std >= 0 and mean_cov >= 0:
+        return rlen, inserts, mean_cov
+
+    stats = get_lib_stats(bam, sample, out)
+    if rlen < 0:
+        rlen = stats['read_len']
+
+    if insert_mean < 0 or insert_std < 0:
+        if not stats['paired']:
+            raise ValueError('can only estimate insert size from paired bam files')
+        insert_mean, insert_std = stats['insert_mean'], stats['insert_std']
+        print('Insert mean of %f, with standard deviation of %f inferred' %
+                (insert_mean, insert_std))
+        if not (insert_mean <= 10000 and insert_std <= 1000 and \
+                insert_mean >= 1 and insert_std >= 1):
+            print('''WARNING: anomalous insert sizes detected. Please
+              double check or consider setting values manually.''')
+        inserts = (max(rlen*2, insert_mean), insert_std)
+
+    if mean_cov < 0:
+        mean_cov = stats['mean_cov']
+        print('Mean coverage of %f inferred' % mean_cov)
+        if not mean_cov > 0:
+            raise ValueError('Could not infer mean coverage, please set mean_cov in the config file.')
+
+    return rlen, inserts, mean_cov
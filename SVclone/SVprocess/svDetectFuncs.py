@@ -5,6 +5,7 @@ Created on Jan 8, 2014
 
 @author: HELE
 '''
+import numpy as np
 
 blurbp1=15 #for difference of breakpoint loci between c1 and c2. 10pb
 blurbp2=100 #for difference of breakpoint loci between two continuous lines. 150bp
@@ -118,102 +119,66 @@ def printResultWithLine(result,content):
     print string+bpstr
 #     print string+":"+content[l].split("\t")[0].split(":")[1]
 
-def detect (prevSV,prevResult,sv):
-    if prevResult:
-        prevResult=prevResult[0]
-    result=-1
-    #anchor_chrom,c1_anchor,c1_anchor_dir,realign_chrom,c1_realign,c1_realign_dir = sv
-    anchor_chrom,c1_anchor,c1_anchor_dir = sv['chr1'],sv['pos1'],sv['dir1']
-    realign_chrom,c1_realign,c1_realign_dir = sv['chr2'],sv['pos2'],sv['dir2']
+def detectAll(sv_info,to_detect):
+    '''
+    classify a position-sorted array of intra-chromosomal SVs by their
+    break-end orientations (tandem duplication, deletion, insertion or
+    inversion). An SV flagged in to_detect that lies near the previous
+    flagged SV, with which it forms a deletion plus tandem duplication, is
+    an interspersed duplication. Returns the result type per SV.
+    '''
+    swap = sv_info['pos2'] < sv_info['pos1']
+    anchor = np.where(swap,sv_info['pos2'],sv_info['pos1']).astype(int)
+    realign = np.where(swap,sv_info['pos1'],sv_info['pos2']).astype(int)
+    anchor_dir = np.where(swap,sv_info['dir2'],sv_info['dir1'])
+    realign_dir = np.where(swap,sv_info['dir1'],sv_info['dir2'])
 
-    if realign_chrom == anchor_chrom:
-        if c1_realign < c1_anchor:
-            anchor_chrom,c1_anchor,c1_anchor_dir = sv['chr2'],sv['pos2'],sv['dir2']
-            realign_chrom,c1_realign,c1_realign_dir = sv['chr1'],sv['pos1'],sv['dir1']
+    not_inv = anchor_dir!=realign_dir
+    ordered = np.logical_and(not_inv,anchor<realign)
+    is_tandem = ordered & (anchor_dir=="-") & (realign_dir=="+")
+    is_deletion = ordered & (anchor_dir=="+") & (realign_dir=="-")
+    is_insertion = not_inv & ~is_tandem & ~is_deletion & (abs(anchor-realign)<blurbp3)
 
-#    line=line.strip().split(delimeter)
-#    c1_realign=line[0].split(':')[1]
-#    c1_realign_dir=line[1]
-#    c1_realign_consensus=line[2]
-#    c1_anchor=line[3].split(':')[1]
-#    c1_anchor_dir=line[4]
-#    c1_anchor_consensus=line[5]
-#    c1_long_support=line[6]
-#    c1_long_support_bases=line[7]
-#    c1_short_support=line[8]
-#    c1_short_support_bases=line[9]
-#    c1_short_support_max_len=line[10]
-#    c1_avg_realign_mapq=line[11]
-#    c2_realign=line[12].split(':')[1]
-#    c2_realign_dir=line[13]
-#    c2_realign_consensus=line[14]
-#    c2_anchor=line[15].split(':')[1]
-#    c2_anchor_dir=line[16]
-#    c2_anchor_consensus=line[17]
-#    c2_long_support=line[18]
-#    c2_long_support_bases=line[19]
-#    c2_short_support=line[20]
-#    c2_short_support_bases=line[21]
-#    c2_short_support_max_len=line[22]
-#    c2_avg_realign_mapq=line[23]
-#    otherInfo=line[24]
+    result = np.zeros(len(sv_info),dtype=int)+SVtypes.error
+    result[is_tandem] = SVtypes.tandem
+    result[is_deletion] = SVtypes.deletion
+    result[is_insertion] = SVtypes.novelInsertion
+    result[~not_inv] = SVtypes.inversion
 
-    if realign_chrom != anchor_chrom:
-        result=SVtypes.interchromosomal
-#    elif c1_realign_dir!=c1_anchor_dir and c2_realign_dir!=c2_anchor_dir:
-    elif c1_realign_dir!=c1_anchor_dir:
-#         not inversion
+    #if two lines, interspersed duplication = del + tandem
+    idxs = np.where(to_detect)[0]
+    res = result[idxs]
+    nearby = np.zeros(len(idxs),dtype=bool)
+    nearby[1:] = (abs(realign[idxs][:-1]-realign[idxs][1:])<blurbp2) | \
+                 (abs(anchor[idxs][:-1]-anchor[idxs][1:])<blurbp2)
+    nearby = nearby & not_inv[idxs] & (res<SVtypes.interspersedDuplication)
 
-        #if +anchor_loci>-realign_loci and -anchor_loci<+realign_loci, is tandem
-        #if +anchor_loci<-realign_loci and -anchor_loci>+realign_loci, is deletion
-        if int(c1_anchor)<int(c1_realign) and c1_anchor_dir=="-" and c1_realign_dir=="+":
-            result=SVtypes.tandem
-        elif int(c1_anchor)<int(c1_realign) and c1_anchor_dir=="+" and c1_realign_dir=="-":
-            result=SVtypes.deletion
-#        if (int(c1_anchor)>int(c1_realign) and c1_anchor_dir=="+") and (int(c2_anchor)<int(c2_realign) and c2_anchor_dir=="-"):
-#            result=SVtypes.tandem
-#        elif (int(c2_anchor)>int(c2_realign) and c2_anchor_dir=="+") and (int(c1_anchor)<int(c1_realign) and c1_anchor_dir=="-"):
-#            result=SVtypes.tandem
-#        elif (int(c2_anchor)>int(c2_realign) and c2_anchor_dir=="-") and (int(c1_anchor)<int(c1_realign) and c1_anchor_dir=="+"):
-#            result=SVtypes.deletion
-#        elif (int(c1_anchor)>int(c1_realign) and c1_anchor_dir=="-") and (int(c2_anchor)<int(c2_realign) and c2_anchor_dir=="+"):
-#            result=SVtypes.deletion
-        elif abs(int(c1_anchor)-int(c1_realign))<blurbp3:
-            result=SVtypes.novelInsertion
-        else:
-            result=SVtypes.error
-
-        #if two lines, interspersed duplication = del + tandem
-        if prevSV:
-            panchor_chrom,pc1_anchor,pc1_anchor_dir = prevSV['chr1'],prevSV['pos1'],prevSV['dir1']
-            prealign_chrom,pc1_realign,pc1_realign_dir = prevSV['chr2'],prevSV['pos2'],prevSV['dir2']
-            if prealign_chrom == anchor_chrom:
-                if pc1_realign < pc1_anchor:
-                    anchor_chrom,pc1_anchor,pc1_anchor_dir = prevSV['chr2'],prevSV['pos2'],prevSV['dir2']
-                    prealign_chrom,pc1_realign,pc1_realign_dir = prevSV['chr1'],prevSV['pos1'],prevSV['dir1']
-            distance1 = pc1_realign-int(c1_realign)
-            distance2 = pc1_anchor-int(c1_anchor)
-            if abs(distance1)<blurbp2 or abs(distance2)<blurbp2:#if this two events are nearby.
-                if result+prevResult==SVtypes.interspersedDuplication:
-                    result=SVtypes.interspersedDuplication
-
-#    elif c1_realign_dir==c1_anchor_dir and c2_realign_dir==c2_anchor_dir:
-    elif c1_realign_dir==c1_anchor_dir and c1_anchor_dir==c1_realign_dir:
-#         inversion
-        result=SVtypes.inversion
-    else:
-        result=SVtypes.error
+    # chained, as the previous SV's result may itself have become an INTDUP
+    for i in np.where(nearby)[0]:
+        if res[i]+res[i-1]==SVtypes.interspersedDuplication:
+            res[i]=SVtypes.interspersedDuplication
+    result[idxs] = res
+    return result
 
-#    startPoint=min(c1_realign,c1_anchor,c2_realign,c2_anchor)
-#    endPoint=max(c1_realign,c1_anchor,c2_realign,c2_anchor)
-    startPoint=min(c1_realign,c1_anchor,c1_anchor,c1_realign)
-    endPoint=max(c1_realign,c1_anchor,c1_anchor,c1_realign)
-#    if "nserted sequence" in otherInfo and abs(int(startPoint)-int(endPoint))<5:
-#        result=SVtypes.novelInsertion
-    return [result,[startPoint,endPoint]]
+def buildDeletionIndex(sv_info):
+    '''
+    per chromosome, the SVs with deletion orientation sorted by pos1,
+    to look up the deleted mobile parts in detectTranslocIndexed
+    '''
+    is_del = (sv_info['chr1']==sv_info['chr2']) & (sv_info['dir1']=='+') & (sv_info['dir2']=='-')
+    del_index = {}
+    for chrom in np.unique(sv_info['chr1'][is_del]):
+        idxs = np.where(is_del & (sv_info['chr1']==chrom))[0]
+        idxs = idxs[np.argsort(sv_info['pos1'][idxs],kind='mergesort')]
+        del_index[str(chrom)] = (sv_info['pos1'][idxs],idxs)
+    return del_index
 
-def detectTransloc(idx,sv_info,tolerance):
-    #find the mobile part. r:[interInserType,[p1,p2,p3,p4]]
+def detectTranslocIndexed(idx,sv_info,tolerance,del_index):
+    '''
+    translocation formed by the SVs idx-1 and idx: find the mobile part
+    (r:[interInserType,[p1,p2,p3,p4]]) and look up whether it was deleted,
+    in the buildDeletionIndex index. Returns [idx-1, idx, deletion idx] or []
+    '''
     if idx-1 < 0:
         return []
     sv1 = sv_info[idx-1]
@@ -227,24 +192,20 @@ def detectTransloc(idx,sv_info,tolerance):
     # flip coords if loc1 > loc2
     mobilePart = mobilePart if mobilePart[0]<mobilePart[1] else [mobilePart[1],mobilePart[0]]
 
-    # try to find if the mobile part is deleted. If so, it is translocation.
-    translocs = []
-    del_lbl = getResultType([SVtypes.deletion])
-    for i,sv in enumerate(sv_info):
+    if chrom not in del_index:
+        return []
+    pos1s,idxs = del_index[chrom]
+    lo = np.searchsorted(pos1s,mobilePart[0]-tolerance,side='right')
+    hi = np.searchsorted(pos1s,mobilePart[0]+tolerance,side='left')
+    cands = idxs[lo:hi]
+    cands = cands[abs(mobilePart[1]-sv_info['pos2'][cands].astype(int)) < tolerance]
+
+    for i in np.sort(cands):
+        sv = sv_info[i]
         if sv1 == sv or sv2 == sv:
             continue
-        if not (sv['chr1'] == chrom and sv['chr2'] == chrom):
-            continue
-        if not (sv['dir1'] == '+' and sv['dir2'] == '-'):
-            continue
-        #if sv['classification'] != del_lbl:
-        #    continue
-        p1_dist = abs(mobilePart[0] - int(sv['pos1']))
-        p2_dist = abs(mobilePart[1] - int(sv['pos2']))
-        if p1_dist < tolerance and p2_dist < tolerance:
-            translocs = [idx-1,idx,i]
-            break
-    return translocs
+        return [idx-1,idx,i]
+    return []
 
 def realignLoci(line):
     return int(line.strip().split(delimeter)[0].split(":")[1])
@@ -1,76 +1,145 @@
 import vcf
 import numpy as np
+import pandas as pd
 import os
 from collections import OrderedDict
 from . import svp_dtypes as dtypes
 
+sv_chunk_size = 100000
+
+# marks an INFO field absent from a VCF record
+missing = object()
+
 def remove_duplicates(svs):
-    for idx,row in enumerate(svs):
-        #reorder breakpoints based on position or chromosomes
-        sv_id, chr1, pos1, dir1, chr2, pos2, dir2, sv_class, oid, opos1, opos2 = row
-        if (chr1!=chr2 and chr1>chr2) or (chr1==chr2 and pos1 > pos2):
-            svs[idx] = (sv_id, chr2, pos2, dir2, chr1, pos1, dir1, sv_class, oid, opos1, opos2)
+    #reorder breakpoints based on position or chromosomes
+    swap = np.logical_or(np.logical_and(svs['chr1'] != svs['chr2'], svs['chr1'] > svs['chr2']),
+                         np.logical_and(svs['chr1'] == svs['chr2'], svs['pos1'] > svs['pos2']))
+    if np.any(swap):
+        swapped = svs[swap].copy()
+        for field1, field2 in [('chr1', 'chr2'), ('pos1', 'pos2'), ('dir1', 'dir2')]:
+            svs[field1][swap], svs[field2][swap] = swapped[field2], swapped[field1]
     return np.unique(svs)
 
-def load_input_vcf(svin,class_field,use_dir):
-    sv_dtype = [s for i,s in enumerate(dtypes.sv_dtype)]
+def parse_regions(regions):
+    '''
+    parse comma-separated 'chrom' or 'chrom:start-end' (1-based, inclusive)
+    regions into (chrom, start, end) with 0-based, half-open coordinates
+    '''
+    parsed = []
+    for region in [r.strip() for r in regions.split(',') if r.strip() != '']:
+        if ':' not in region:
+            parsed.append((region, None, None))
+            continue
+        chrom, interval = region.rsplit(':', 1)
+        start, end = interval.split('-')
+        parsed.append((chrom, int(start) - 1, int(end)))
+    return parsed
 
+def read_vcf_records(svin, regions=''):
+    '''
+    iterate VCF records, optionally only those in the given regions
+    (which requires a bgzipped and tabix-indexed VCF)
+    '''
     sv_vcf = vcf.Reader(filename=svin)
+    if regions == '':
+        for record in sv_vcf:
+            yield record
+    else:
+        for chrom, start, end in parse_regions(regions):
+            for record in sv_vcf.fetch(chrom, start, end):
+                yield record
+
+def load_input_vcf(svin,class_field,use_dir,regions=''):
+    sv_dtype = [s for i,s in enumerate(dtypes.sv_dtype)]
+
+    # keep only the fields needed to pair breakends, in order of first appearance
     sv_dict = OrderedDict()
-    for sv in sv_vcf:
+    for sv in read_vcf_records(svin, regions):
 
         if sv.FILTER is not None:
             if len(sv.FILTER)>0:
                 continue
 
-        sv_dict[sv.ID] = {'CHROM': sv.CHROM, 'POS': sv.POS, 'INFO': sv.INFO,
-                          'REF': str(sv.REF[0]), 'ALT': str(sv.ALT[0])}
+        mate_field = 'PARID' if 'PARID' in sv.INFO else 'MATEID'
+        mate_id = sv.INFO.get(mate_field, missing)
+        if type(mate_id) == type([]):
+            mate_id = mate_id[0]
+        sv_class = sv.INFO.get(class_field, missing) if class_field!='' else ''
 
-    svs = np.empty(0,sv_dtype)
-    procd = np.empty(0,dtype='S50')
+        sv_dict[sv.ID] = (sv.CHROM, sv.POS, str(sv.ALT[0]), mate_id, sv_class)
+
+    cols = OrderedDict([(field, []) for field, dtype in sv_dtype])
+    procd = set()
 
     for sv_id in sv_dict:
-        try:
-            sv = sv_dict[sv_id]
-            mate_field = 'PARID' if 'PARID' in sv['INFO'] else 'MATEID'
-            mate_id = sv['INFO'][mate_field]
-            if type(mate_id) == type([]):
-                mate_id = mate_id[0]
-            mate = sv_dict[mate_id]
-
-            if (sv_id in procd) or (mate_id in procd):
-                continue
+        chr1, pos1, alt1, mate_id, sv_class = sv_dict[sv_id]
+        if mate_id is missing or mate_id not in sv_dict:
+            print("SV %s improperly paired or missing attributes"%sv_id)
+            continue
+        chr2, pos2, alt2, mate_mate_id, mate_class = sv_dict[mate_id]
+
+        if (sv_id in procd) or (mate_id in procd):
+            continue
 
-            dir1, dir2 = '?', '?'
-            chr1 = sv['CHROM']
-            pos1 = sv['POS']
-            chr2 = mate['CHROM']
-            pos2 = mate['POS']
-            sv_class = sv['INFO'][class_field] if class_field!='' else ''
-
-            if use_dir:
-                if sv['ALT'].startswith(']') or sv['ALT'].startswith('['): dir1 = '-'
-                if sv['ALT'].endswith('[') or sv['ALT'].endswith(']'): dir1 = '+'
-                if mate['ALT'].startswith(']') or mate['ALT'].startswith('['): dir2 = '-'
-                if mate['ALT'].endswith('[') or mate['ALT'].endswith(']'): dir2 = '+'
-
-            procd = np.append(procd,[sv_id,mate_id])
-            new_id = sv_id.split('_')
-            try:
-                new_id = int(new_id[0])
-            except ValueError:
-                new_id = 0
-            new_sv = np.array([(new_id, chr1, pos1, dir1, chr2, pos2, dir2, sv_class, sv_id, pos1, pos2)], dtype=sv_dtype)
-            svs = np.append(svs,new_sv)
-        except KeyError:
+        if sv_class is missing:
             print("SV %s improperly paired or missing attributes"%sv_id)
             continue
 
+        dir1, dir2 = '?', '?'
+        if use_dir:
+            if alt1.startswith(']') or alt1.startswith('['): dir1 = '-'
+            if alt1.endswith('[') or alt1.endswith(']'): dir1 = '+'
+            if alt2.startswith(']') or alt2.startswith('['): dir2 = '-'
+            if alt2.endswith('[') or alt2.endswith(']'): dir2 = '+'
+
+        procd.update([sv_id, mate_id])
+        for field, value in zip(cols, [0, chr1, pos1, dir1, chr2, pos2, dir2, sv_class, sv_id, pos1, pos2]):
+            cols[field].append(value)
+
+    svs = np.empty(len(cols['ID']), dtype=sv_dtype)
+    for field in cols:
+        svs[field] = cols[field]
     svs['ID'] = range(0,len(svs)) #re-index
     return svs
 
+def read_sv_table(svin, chunksize=sv_chunk_size):
+    '''
+    iterate a headered, tab-delimited SV file in chunks of string columns.
+    As with np.genfromtxt, the header may start with '#', comments and blank
+    lines are skipped, as are lines with the wrong number of fields.
+    '''
+    with open(svin) as f:
+        header = f.readline()
+    names = [name.strip() for name in header.lstrip('#').rstrip('\r\n').split('\t')]
+
+    chunks = pd.read_csv(svin, sep='\t', header=None, names=names, skiprows=1, dtype=str,
+                         na_filter=False, comment='#', error_bad_lines=False,
+                         warn_bad_lines=False, chunksize=chunksize)
+    for chunk in chunks:
+        # short lines are padded with missing values
+        yield names, chunk.dropna()
+
+def check_sv_columns(names, fields, err):
+    if any([field not in names for field in fields]):
+        raise Exception(err)
+
+def to_int(values):
+    return pd.to_numeric(values).astype('int64')
+
+def build_sv_array(chr1, pos1, dir1, chr2, pos2, dir2, sv_class, orig_id):
+    svs = np.empty(len(chr1), dtype=dtypes.sv_dtype)
+    svs['chr1'], svs['pos1'], svs['dir1'] = chr1, pos1, dir1
+    svs['chr2'], svs['pos2'], svs['dir2'] = chr2, pos2, dir2
+    svs['classification'], svs['original_ID'] = sv_class, orig_id
+    svs['original_pos1'], svs['original_pos2'] = pos1, pos2
+    return svs
+
+def concat_svs(sv_chunks):
+    svs = np.concatenate(sv_chunks) if len(sv_chunks) > 0 else np.empty(0, dtype=dtypes.sv_dtype)
+    svs['ID'] = np.arange(len(svs))
+    return svs
+
 def load_input_socrates(svin,use_dir,min_mapq,filt_repeats,Config):
-    sv_dtype = dtypes.sv_dtype
     pos_field1 = Config.get('SocratesOpts', 'pos1')
     pos_field2 = Config.get('SocratesOpts', 'pos2')
     dir_field1 = Config.get('SocratesOpts', 'dir1')
@@ -80,69 +149,64 @@ def load_input_socrates(svin,use_dir,min_mapq,filt_repeats,Config):
     repeat1_field = Config.get('SocratesOpts', 'repeat1')
     repeat2_field = Config.get('SocratesOpts', 'repeat2')
 
-    soc_in = np.genfromtxt(svin,delimiter='\t',names=True,dtype=None,invalid_raise=False)
-    svs = np.empty(0, dtype=sv_dtype)
-    filtered_out = 0
-
-    sv_id = 0
-    for row in soc_in:
-        try:
-            bp1 = row[pos_field1].split(':')
-            bp2 = row[pos_field2].split(':')
-            chr1, pos1 = bp1[0], int(bp1[1])
-            chr2, pos2 = bp2[0], int(bp2[1])
-            #classification = row['classification']
-            if 'normal' in row.dtype.names:
-                # has germline info, filter out
-                if row['normal']=='normal':
-                    continue
-            if row[avg_mapq1_field]<min_mapq or row[avg_mapq2_field]<min_mapq:
-                filtered_out += 1
-                continue
-            if filt_repeats!=[]:
-                if row[repeat1_field] in filt_repeats and row[repeat2_field] in filt_repeats:
-                    filtered_out += 1
-                    continue
-            add_sv = np.empty(0)
-
-            dir1 = row[dir_field1] if use_dir else '?'
-            dir2 = row[dir_field2] if use_dir else '?'
-
-            add_sv = np.array([(sv_id, chr1, pos1, dir1, chr2, pos2, dir2, '', '', pos1, pos2)], dtype=sv_dtype)
-            svs = np.append(svs,add_sv)
-            sv_id += 1
-        except IndexError:
-            raise Exception('Supplied Socrates file does not match column names specified in the parameters.py file')
+    fields = [pos_field1, pos_field2, avg_mapq1_field, avg_mapq2_field]
+    fields += [dir_field1, dir_field2] if use_dir else []
+    fields += [repeat1_field, repeat2_field] if filt_repeats != [] else []
 
+    sv_chunks = []
+    filtered_out = 0
+    for names, soc_in in read_sv_table(svin):
+        check_sv_columns(names, fields, \
+            'Supplied Socrates file does not match column names specified in the parameters.py file')
+
+        if 'normal' in names:
+            # has germline info, filter out
+            soc_in = soc_in[soc_in['normal'].values != 'normal']
+
+        mapq1 = pd.to_numeric(soc_in[avg_mapq1_field], errors='coerce').values
+        mapq2 = pd.to_numeric(soc_in[avg_mapq2_field], errors='coerce').values
+        keep = np.invert(np.logical_or(mapq1 < min_mapq, mapq2 < min_mapq))
+        if filt_repeats != []:
+            repeats = np.logical_and(soc_in[repeat1_field].isin(filt_repeats).values,
+                                     soc_in[repeat2_field].isin(filt_repeats).values)
+            keep = np.logical_and(keep, np.invert(repeats))
+        filtered_out += np.sum(np.invert(keep))
+        soc_in = soc_in[keep]
+
+        bp1 = soc_in[pos_field1].str.split(':')
+        bp2 = soc_in[pos_field2].str.split(':')
+        dir1 = soc_in[dir_field1].values if use_dir else '?'
+        dir2 = soc_in[dir_field2].values if use_dir else '?'
+
+        sv_chunks.append(build_sv_array(bp1.str[0].values, to_int(bp1.str[1]).values, dir1,
+                                        bp2.str[0].values, to_int(bp2.str[1]).values, dir2, '', ''))
+
+    svs = concat_svs(sv_chunks)
     print('Filtered out %d Socrates SVs, keeping %d SVs' % (filtered_out,len(svs)))
     return remove_duplicates(svs)
 
 def load_input_simple(svin,use_dir,class_field):
-    sv_dtype = dtypes.sv_dtype
-
-    sv_tmp = np.genfromtxt(svin,delimiter='\t',names=True,dtype=None,invalid_raise=False)
-    svs = np.empty(0, dtype=sv_dtype)
-    sv_id = 0
-    for row in sv_tmp:
-        chr1 = str(row['chr1'])
-        pos1 = int(row['pos1'])
-        chr2 = str(row['chr2'])
-        pos2 = int(row['pos2'])
-        orig_id = str(row['ID']) if 'ID' in sv_tmp.dtype.names else ''
-        orig_pos1 = pos1
-        orig_pos2 = pos2
-        sv_class = row[class_field] if class_field!='' else ''
-        add_sv = np.empty(0)
+    fields = ['chr1', 'pos1', 'chr2', 'pos2']
+    fields += ['dir1', 'dir2'] if use_dir else []
+    fields += [class_field] if class_field != '' else []
+
+    sv_chunks = []
+    for names, sv_tmp in read_sv_table(svin):
+        check_sv_columns(names, fields, \
+            'Supplied SV file is missing one or more of the columns: %s' % ', '.join(fields))
+
+        orig_id = sv_tmp['ID'].values if 'ID' in names else ''
+        sv_class = sv_tmp[class_field].values if class_field != '' else ''
 
         dir1, dir2 = '?', '?'
         if use_dir:
-            dir1 = str(row['dir1'])
-            dir2 = str(row['dir2'])
+            dir1 = sv_tmp['dir1'].values
+            dir2 = sv_tmp['dir2'].values
 
-        add_sv = np.array([(sv_id, chr1, pos1, dir1, chr2, pos2, dir2, sv_class, orig_id, orig_pos1, orig_pos2)], dtype=sv_dtype)
-        svs = np.append(svs,add_sv)
-        sv_id += 1
-    return remove_duplicates(svs)
+        sv_chunks.append(build_sv_array(sv_tmp['chr1'].values, to_int(sv_tmp['pos1']).values, dir1,
+                                        sv_tmp['chr2'].values, to_int(sv_tmp['pos2']).values, dir2,
+                                        sv_class, orig_id))
+    return remove_duplicates(concat_svs(sv_chunks))
 
 def load_blacklist(blist_file):
     blist = np.genfromtxt(blist_file, delimiter='\t', names=None, dtype=None, invalid_raise=False)
@@ -1,13 +1,25 @@
 import numpy as np
 import pandas as pd
-import pymc as pm
 import math
 import ipdb
 import collections
 
 from sklearn.cluster import KMeans
-from scipy import stats
-from operator import methodcaller
+from scipy.special import gammaln, xlogy, xlog1py, chdtri
+from .cn_states import from_combos
+from .lik_cache import VarLikCache
+from . import gibbs
+from . import vi
+
+try:
+    import pymc as pm
+except ImportError:
+    # only needed by the mcmc engine
+    pm = None
+
+# candidate copy-number states are cached per distinct genotype
+combo_cache_size = 4096
+combo_cache = collections.OrderedDict()
 
 def add_copynumber_combos(combos, var_maj, var_min, ref_cn, frac, cparams):
     '''
@@ -32,35 +44,68 @@ def add_copynumber_combos(combos, var_maj, var_min, ref_cn, frac, cparams):
 
     return combos
 
-def get_allele_combos(cn, cparams):
+def make_allele_combos(clones, restrict_cnss):
+    '''
+    candidate copy-number states of a variant from the
+    (major, minor, frac) of each clone of its genotype
+    '''
     combos = []
+    cparams = {'restrict_cnss': restrict_cnss}
 
-    if len(cn) == 0 or cn[0]=='':
-        return combos
+    if len(clones) == 0:
+        return filter_cns(combos)
 
-    if len(cn)>1:
+    if len(clones)>1:
         # split subclonal copy-numbers
-        c1 = map(float,cn[0].split(','))
-        c2 = map(float,cn[1].split(','))
-        major1, minor1, total1, frac1 = c1[0], c1[1], c1[0]+c1[1], c1[2]
-        major2, minor2, total2, frac2 = c2[0], c2[1], c2[0]+c2[1], c2[2]
+        major1, minor1, frac1 = clones[0]
+        major2, minor2, frac2 = clones[1]
+        total1, total2 = major1 + minor1, major2 + minor2
 
         # generate copynumbers for each subclone being the potential variant pop
         combos = add_copynumber_combos(combos, major1, minor1, total2, frac1, cparams)
         combos = add_copynumber_combos(combos, major2, minor2, total1, frac2, cparams)
     else:
-        c = map(float,cn[0].split(','))
-        major, minor, frac = c[0], c[1], c[2]
+        major, minor, frac = clones[0]
         combos = add_copynumber_combos(combos, major, minor, major + minor, frac, cparams)
 
     return filter_cns(combos)
 
-def get_sv_allele_combos(sv, cparams):
-    cn_tmp = tuple([tuple(sv.gtype1.split('|')),tuple(sv.gtype2.split('|'))])
-    combos_bp1 = get_allele_combos(cn_tmp[0], cparams)
-    combos_bp2 = get_allele_combos(cn_tmp[1], cparams)
+def get_allele_combos(clones, cparams):
+    '''
+    memoized make_allele_combos, returns a read-only (n_states x 4) array
+    of (ref_cn, var_total, mu_v, frac) shared between calls
+    '''
+    key = (tuple(clones), cparams['restrict_cnss'])
+    combos = combo_cache.pop(key, None)
+    if combos is None:
+        combos = make_allele_combos(clones, cparams['restrict_cnss'])
+        combos.flags.writeable = False
+        if len(combo_cache) >= combo_cache_size:
+            combo_cache.popitem(last=False)
+    combo_cache[key] = combos
+    return combos
+
+def get_gtype_combos(gts, cparams):
+    '''
+    candidate copy-number states of each genotype of a GenotypeTable
+    '''
+    uniq, inverse = gts.unique()
+    combos = [get_allele_combos(uniq.clones(i), cparams) for i in range(len(uniq))]
+    return [combos[i] for i in inverse]
+
+def get_cn_states(gts, cparams):
+    '''
+    CNStates of the candidate copy-number states of each genotype of a GenotypeTable
+    '''
+    uniq, inverse = gts.unique()
+    combos = [get_allele_combos(uniq.clones(i), cparams) for i in range(len(uniq))]
+    return from_combos(combos).subset(inverse)
 
-    return tuple([combos_bp1,combos_bp2])
+def get_sv_allele_combos(gts1, gts2, cparams):
+    combos_bp1 = get_gtype_combos(gts1, cparams)
+    combos_bp2 = get_gtype_combos(gts2, cparams)
+
+    return zip(combos_bp1, combos_bp2)
 
 def fit_and_sample(model, iters, burn, thin, use_map):
     if use_map:
@@ -76,45 +121,172 @@ def fit_and_sample(model, iters, burn, thin, use_map):
     else:
         return mcmc, None
 
-def get_pv(phi, combo, pi, ni):
-    cn_r, cn_v, mu, cn_f = combo
+def get_pv_unit(states, pi, norm):
+    '''
+    proportion of the reads coming from the variant population of each
+    copy-number state (the last axis of states holds cn_r, cn_v, mu, cn_f),
+    norm broadcasts against states[..., 0]
+    '''
+    cn_r, cn_v, cn_f = states[..., 0], states[..., 1], states[..., 3]
 
-    pn = (1.0 - pi) * ni        #proportion of normal reads coming from normal cells
-    pr = pi * cn_r * (1. - cn_f) if cn_f < 1 else 0 # incorporate ref population CNV fraction if present
-    pv = pi * cn_v * cn_f       #proportion of variant + normal reads coming from this (the variant) cluster
-    norm_const = pn + pv + pr
-    pv = pv / norm_const
+    with np.errstate(invalid='ignore'):
+        pn = (1.0 - pi) * norm      #proportion of normal reads coming from normal cells
+        pr = np.where(cn_f < 1, pi * cn_r * (1. - cn_f), 0) # incorporate ref population CNV fraction if present
+        pv = pi * cn_v * cn_f       #proportion of variant + normal reads coming from this (the variant) cluster
+        norm_const = pn + pv + pr
+        return pv / norm_const
 
-    return phi * pv * mu
+def get_pv(phi, states, pi, norm):
+    '''
+    expected VAF of each copy-number state, phi and norm broadcast
+    against states[..., 0]
+    '''
+    with np.errstate(invalid='ignore'):
+        return phi * get_pv_unit(states, pi, norm) * states[..., 2]
 
-def filter_cns(cn_states):
-    cn_str = [','.join(map(str,cn)) for cn in cn_states if cn[2]!=0 and cn[1]!=0]
-    cn_str = np.unique(np.array(cn_str))
-    return [map(float,cn) for cn in map(methodcaller('split',','),cn_str)]
+def get_binomial_coef(s, d):
+    '''
+    binomial log-coefficient of the (truncated) counts,
+    and whether the counts are impossible
+    '''
+    s, d = np.trunc(s), np.trunc(d)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return gammaln(d + 1) - gammaln(s + 1) - gammaln(d - s + 1), (s < 0) | (s > d)
 
-def calc_lik_with_clonal(combo, si, di, phi_i, pi, ni):
+def binomial_like_from_coef(s, d, p, log_coef, bad_counts):
+    '''
+    binomial log-likelihood of truncated counts, given their log-coefficient
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ll = log_coef + xlogy(s, p) + xlog1py(d - s, -p)
+        impossible = bad_counts | (p < 0) | (p > 1) | ((p == 0) & (s > 0)) | ((p == 1) & (s < d))
+    return np.where(impossible, -np.finfo(float).max, ll)
 
-    # calculate with given phi
-    # (lls currently uses precision fudge factor to get around 0 probability errors when pv = 1)
-    pvs = np.array([get_pv(phi_i, c, pi, ni) for c in combo])
-    lls = np.array([pm.binomial_like(si, di, pvs[i]) for i,c in enumerate(combo)])-0.00000001
+def binomial_like(s, d, p):
+    '''
+    elementwise binomial log-likelihood, as pm.binomial_like: counts are
+    truncated to integers and impossible values give -DBL_MAX
+    '''
+    log_coef, bad_counts = get_binomial_coef(s, d)
+    return binomial_like_from_coef(np.trunc(s), np.trunc(d), np.asarray(p, dtype=float), log_coef, bad_counts)
 
-    # calculate with clonal phi
-    pvs_cl = np.array([get_pv(np.array(1), c, pi, ni) for c in combo])
-    lls_cl = np.array([pm.binomial_like(si, di, pvs_cl[i]) for i,c in enumerate(combo)])-0.00000001
+class ModelInputs(object):
+    '''
+    Inputs of the binomial likelihood of each variant's candidate copy-number
+    states, with the phi-independent terms computed once per run: pv_unit is
+    the proportion of reads from the variant population of each (NaN-padded)
+    state, so that pv = phi * pv_unit * mu, and log_coef is the binomial
+    log-coefficient of each variant's counts. The likelihoods under the
+    clonal (phi=1) hypothesis are also computed at most once per run.
+    Indexing by a slice, mask or index array selects variants.
+    '''
+    var_fields = ['states', 'is_state', 'n_states', 's', 'd', 'norm', 'pv_unit', 'log_coef', 'bad_counts']
+
+    def __init__(self, cn_states, s, d, pi, norm):
+        self.pi = pi
+        self.states, self.is_state = cn_states.padded()
+        self.n_states = cn_states.lengths
+        s, d, self.norm = [np.asarray(x, dtype=float)[:, np.newaxis] for x in [s, d, norm]]
+        self.s, self.d = np.trunc(s), np.trunc(d)
+        self.pv_unit = get_pv_unit(self.states, pi, self.norm)
+        self.log_coef, self.bad_counts = get_binomial_coef(self.s, self.d)
+        self.clonal_liks = None
+
+    def __len__(self):
+        return len(self.n_states)
+
+    def __getitem__(self, idx):
+        inputs = ModelInputs.__new__(ModelInputs)
+        inputs.pi = self.pi
+        for field in self.var_fields:
+            setattr(inputs, field, getattr(self, field)[idx])
+        inputs.clonal_liks = None
+        if self.clonal_liks is not None:
+            inputs.clonal_liks = tuple([x[idx] for x in self.clonal_liks])
+        return inputs
+
+    @property
+    def mu(self):
+        return self.states[..., 2]
+
+    def get_pvs(self, phi):
+        '''
+        pv of each state, given the phi of each variant (or one phi for all)
+        '''
+        phi = np.asarray(phi, dtype=float)
+        phi = phi[:, np.newaxis] if phi.ndim == 1 else phi
+        with np.errstate(invalid='ignore'):
+            return phi * self.pv_unit * self.mu
+
+    def calc_state_liks(self, phi):
+        '''
+        pvs and log-likelihoods of each state
+        (lls currently uses precision fudge factor to get around 0 probability errors when pv = 1)
+        '''
+        pvs = self.get_pvs(phi)
+        lls = binomial_like_from_coef(self.s, self.d, pvs, self.log_coef, self.bad_counts) - 0.00000001
+        return pvs, lls
+
+    def get_clonal_liks(self):
+        '''
+        index and log-likelihood of the most likely state under the clonal
+        hypothesis, and whether the log-likelihoods are undefined (the
+        log-likelihood is then 0)
+        '''
+        if self.clonal_liks is None:
+            lls = self.calc_state_liks(1.)[1]
+            undefined = np.all(np.isnan(lls), axis=1)
+            max_lls = np.fmax.reduce(np.where(undefined[:, np.newaxis], 0, lls), axis=1) \
+                        if lls.shape[1] > 0 else np.zeros(len(lls))
+            self.clonal_liks = (index_of_max(lls), max_lls, undefined)
+        return self.clonal_liks
+
+    def calc_var_liks(self, pvs):
+        '''
+        log-likelihood of each variant's counts given its pv
+        '''
+        pvs = np.asarray(pvs, dtype=float)[:, np.newaxis]
+        return binomial_like_from_coef(self.s, self.d, pvs, self.log_coef, self.bad_counts)[:, 0]
+
+    def get_max_lls(self, phi):
+        '''
+        log-likelihood of the most likely state of each variant, given phi
+        '''
+        if self.states.shape[1] == 0:
+            return np.full(len(self), -np.inf)
+        lls = self.calc_state_liks(phi)[1]
+        return np.max(np.where(self.is_state, lls, -np.inf), axis=1)
 
-    return np.array([[pvs, lls], [pvs_cl, lls_cl]])
+def filter_cns(cn_states):
+    '''
+    distinct states with a non-zero variant copy-number, sorted
+    '''
+    cn_states = np.array(cn_states, dtype=float).reshape(-1, 4)
+    cn_states = cn_states[np.logical_and(cn_states[:, 2] != 0, cn_states[:, 1] != 0)]
+    if len(cn_states) == 0:
+        return cn_states
+    return np.unique(cn_states, axis=0)
+
+def calc_state_liks(states, s, d, phi, pi, norm):
+    '''
+    pvs and log-likelihoods of each state, with arguments as for get_pv
+    (lls currently uses precision fudge factor to get around 0 probability errors when pv = 1)
+    '''
+    pvs = get_pv(phi, states, pi, norm)
+    lls = binomial_like(s, d, pvs) - 0.00000001
+    return pvs, lls
 
 def calc_lik(combo, si, di, phi_i, pi, ni):
-    pvs = np.array([get_pv(phi_i, c, pi, ni) for c in combo])
-    lls = np.array([pm.binomial_like(si, di, pvs[i]) for i,c in enumerate(combo)])-0.00000001
-    return np.array([pvs, lls])
+    states = np.asarray(combo, dtype=float).reshape(-1, 4)
+    return np.array(calc_state_liks(states, si, di, phi_i, pi, ni))
 
 def get_probs(var_states,s,d,phi,pi,norm):
     llik = calc_lik(var_states,s,d,phi,pi,norm)[1]
     probs = get_probs_from_llik(llik)
-    probs = ','.join(map(lambda x: str(round(x,4)),probs))
-    return probs
+    return format_probs(probs)
+
+def format_probs(probs):
+    return ','.join(map(lambda x: str(round(x,4)),probs))
 
 def get_probs_from_llik(cn_lik):
     probs = np.array([1.])
@@ -123,70 +295,191 @@ def get_probs_from_llik(cn_lik):
         probs = np.array(probs)/sum(probs)
     return probs
 
-def index_of_max(lik_list):
-    result = collections.defaultdict(list)
-    for val, idx in enumerate(lik_list):
-        result[idx] = val
-    return result[np.nanmax(lik_list)]
-
-def get_most_likely_pv(cn_lik):
-    if np.all(np.isnan(cn_lik[0])):
-        return 0.0000001
-    elif len(cn_lik[0]) > 0:
-        return cn_lik[0][index_of_max(cn_lik[1])]
-    else:
-        return 0.0000001
+def index_of_max(lls):
+    '''
+    index of the (last) maximum of each row, ignoring NaNs
+    '''
+    lls = np.where(np.isnan(lls), -np.inf, lls)
+    return lls.shape[1] - 1 - np.argmax(lls[:, ::-1], axis=1)
 
-def get_most_likely_cn(combo, cn_lik, pval_cutoff):
+def get_most_likely_states(inputs, phi):
     '''
-    use the most likely phi state, unless p < cutoff when compared to the
-    most likely clonal (phi=1) case (log likelihood ratio test)
-    - in this case, pick the most CN state with the highest clonal likelihood
+    index and pv of the most likely copy-number state of each variant, given its phi
     '''
-    cn_lik_phi, cn_lik_clonal = cn_lik
-    ll_phi, ll_clonal = cn_lik_phi[1], cn_lik_clonal[1]
-
-    empty_result = [float('nan'), float('nan'), float('nan'), float('nan')]
-    if len(combo) == 0:
-        return empty_result
-    elif len(combo) == 1:
-        return combo[0]
-    elif np.all(np.isnan(ll_phi)) and np.all(np.isnan(ll_clonal)):
-        return empty_result
-    elif np.all(np.isnan(ll_phi)):
-        return combo[index_of_max(ll_clonal)]
-    elif np.all(ll_phi == ll_clonal) or pval_cutoff == 0:
-        return combo[index_of_max(ll_phi)]
-
-    # log likelihood ratio test; null hypothesis = likelihood under phi
-    # use clonal if best clonal solution significantly better than worst phi solution
-    #LLR   = 2 * (np.nanmax(ll_clonal) - np.nanmax(ll_phi))
-    LLR   = 2 * (np.nanmax(ll_clonal) - np.nanmin(ll_phi))
-    p_val = stats.chisqprob(LLR, 1) if not np.isnan(LLR) else 1
-
-    if p_val < pval_cutoff:
-        return combo[index_of_max(ll_clonal)]
-    else:
-        return combo[index_of_max(ll_phi)]
+    best = np.zeros(len(inputs), dtype=int)
+    pvs_ml = np.full(len(inputs), 0.0000001)
+    if inputs.states.shape[1] == 0:
+        return best, pvs_ml
+
+    pvs, lls = inputs.calc_state_liks(phi)
+    best = index_of_max(lls)
+    has_pv = np.invert(np.all(np.isnan(pvs), axis=1))
+    pvs_ml[has_pv] = pvs[np.arange(len(pvs)), best][has_pv]
+    return best, pvs_ml
+
+def get_most_likely_pvs(inputs, phi):
+    '''
+    pv of the most likely copy-number state of each variant, given its phi
+    '''
+    return get_most_likely_states(inputs, phi)[1]
 
-def get_most_likely_cn_states(cn_states, s, d, phi, pi, pval_cutoff, norm):
+def get_model_lls(inputs, phi):
     '''
-    Obtain the copy-number states which maximise the binomial likelihood
-    of observing the supporting read depths at each variant location
+    log-likelihood of each variant's counts under the clustering model
+    (binomial with the pv of its most likely state), and the index of
+    the most likely state
     '''
-    cn_ll_combined = [calc_lik_with_clonal(cn_states[i],s[i],d[i],phi[i],pi,norm[i]) for i in range(len(cn_states))]
-    most_likely_cn = [get_most_likely_cn(cn_states[i],cn_lik,pval_cutoff) for i, cn_lik in enumerate(cn_ll_combined)]
+    best, pvs = get_most_likely_states(inputs, phi)
+    return inputs.calc_var_liks(pvs - 0.00000001), best
 
-    cn_ll = [calc_lik(cn_states[i],s[i],d[i],phi[i],pi,norm[i]) for i in range(len(most_likely_cn))]
-    most_likely_pv = [get_most_likely_pv(cn_lik) for cn_lik in cn_ll]
+class PhiGrid(object):
+    '''
+    Model log-likelihoods of each variant (see get_model_lls) and the index
+    of its most likely state, tabulated once on an evenly spaced grid of phis
+    between lower and upper. The log-likelihood at any phi is approximated
+    by linear interpolation between the grid points, the state by the state
+    at the nearest grid point. Impossible values are floored at the lowest
+    float32, in which the table is stored.
+    '''
+    ll_floor = -np.finfo(np.float32).max
+
+    def __init__(self, inputs, lower, upper, size):
+        if size < 2:
+            raise ValueError('phi grid needs at least 2 points')
+        self.phis = np.linspace(lower, upper, size)
+        self.step = max(self.phis[1] - self.phis[0], np.finfo(float).tiny)
+        self.rows = np.arange(len(inputs))
+        self.lls = np.empty((len(inputs), size), dtype=np.float32)
+        self.states = np.empty((len(inputs), size), dtype=np.int16)
+        for j, phi in enumerate(self.phis):
+            lls, self.states[:, j] = get_model_lls(inputs, phi)
+            self.lls[:, j] = np.maximum(lls, self.ll_floor)
+
+    def get_positions(self, phi):
+        '''
+        index of the grid point below each phi, and the
+        relative position of phi to the grid point above
+        '''
+        pos = (np.asarray(phi, dtype=float) - self.phis[0]) / self.step
+        idx = np.clip(np.floor(pos).astype(int), 0, len(self.phis) - 2)
+        return idx, np.clip(pos - idx, 0, 1)
+
+    def get_lls(self, phi, rows=None):
+        '''
+        interpolated log-likelihood of each variant (or of the
+        variants in rows), given its phi
+        '''
+        rows = self.rows if rows is None else rows
+        idx, w = self.get_positions(phi)
+        ll_lo = self.lls[rows, idx].astype(float)
+        ll_hi = self.lls[rows, idx + 1].astype(float)
+        return ll_lo + w * (ll_hi - ll_lo)
+
+    def get_states(self, phi, rows=None):
+        '''
+        most likely state of each variant (or of the variants in rows)
+        at the grid point nearest to its phi
+        '''
+        rows = self.rows if rows is None else rows
+        idx, w = self.get_positions(phi)
+        return self.states[rows, idx + (w > 0.5)]
+
+    def validate(self, inputs, max_vars=10000):
+        '''
+        maximum and mean absolute error of the interpolated log-likelihoods
+        against the exact kernel, and the fraction of differing most likely
+        states, at the grid midpoints (where interpolation errors peak)
+        for up to max_vars evenly spaced variants
+        '''
+        rows = np.unique(np.linspace(0, len(inputs) - 1, min(len(inputs), max_vars)).astype(int))
+        sub = inputs[rows]
+        max_err, total_err, n_err, n_diff = 0., 0., 0, 0
+        for phi in (self.phis[:-1] + self.phis[1:]) / 2:
+            phis = np.full(len(rows), phi)
+            exact, best = get_model_lls(sub, phi)
+            valid = exact > self.ll_floor
+            err = np.abs(self.get_lls(phis, rows) - exact)[valid]
+            if len(err) > 0:
+                max_err = max(max_err, np.max(err))
+                total_err, n_err = total_err + np.sum(err), n_err + len(err)
+            n_diff += np.sum(self.get_states(phis, rows) != best)
+
+        n_evals = max(len(rows) * (len(self.phis) - 1), 1)
+        return {'max_ll_error': max_err, 'mean_ll_error': total_err / max(n_err, 1),
+                'state_mismatch': n_diff / float(n_evals), 'n_variants': len(rows)}
+
+def get_phi_grid(inputs, lower, upper, size):
+    '''
+    build the PhiGrid and report its error against the exact kernel
+    '''
+    grid = PhiGrid(inputs, lower, upper, size)
+    report = grid.validate(inputs)
+    print('Phi grid of %d points (spacing %f): max log-likelihood error %g, mean %g, '
+          'most likely state differs in %.2f%% of evaluations (%d variants checked)' %
+          (size, grid.step, report['max_ll_error'], report['mean_ll_error'],
+           report['state_mismatch'] * 100, report['n_variants']))
+    return grid
+
+def get_most_likely_cn_states(inputs, phi, pval_cutoff):
+    '''
+    Obtain the copy-number states which maximise the binomial likelihood
+    of observing the supporting read depths at each variant location.
 
+    Uses the most likely phi state, unless p < cutoff when compared to the
+    most likely clonal (phi=1) case (log likelihood ratio test)
+    - in this case, pick the most CN state with the highest clonal likelihood
+    '''
+    states, n, rows = inputs.states, len(inputs), np.arange(len(inputs))
+    most_likely_cn = np.full((n, 4), np.nan)
+    most_likely_pv = np.full(n, 0.0000001)
+    if states.shape[1] == 0:
+        return most_likely_cn, most_likely_pv
+
+    pvs, lls = inputs.calc_state_liks(phi)
+    best = index_of_max(lls)
+    has_pv = np.invert(np.all(np.isnan(pvs), axis=1))
+    most_likely_pv[has_pv] = pvs[rows, best][has_pv]
+
+    n_states = inputs.n_states
+    no_ll = np.all(np.isnan(lls), axis=1)
+    missing = np.zeros(n, dtype=bool)
+
+    # the clonal likelihoods are only needed for the test, or if the phi likelihoods are undefined
+    test = np.logical_and(n_states > 1, no_ll if pval_cutoff == 0 else True)
+    if np.any(test):
+        idx = np.where(test)[0]
+        best_cl, max_cl_ll, no_cl_ll = [x[idx] for x in inputs.get_clonal_liks()]
+
+        clonal = no_ll[idx].copy()
+        if pval_cutoff > 0:
+            # use clonal if best clonal solution significantly better than worst phi solution
+            # (p < cutoff where the LLR exceeds the chi-squared critical value)
+            with np.errstate(invalid='ignore', over='ignore'):
+                LLR = 2 * (max_cl_ll - np.fmin.reduce(np.where(no_ll[idx, np.newaxis], 0, lls[idx]), axis=1))
+                significant = np.logical_and(np.invert(no_cl_ll), LLR > chdtri(1, pval_cutoff))
+            clonal = np.logical_or(clonal, significant)
+
+        best[idx[clonal]] = best_cl[clonal]
+        missing[idx] = np.logical_and(no_ll[idx], no_cl_ll)
+
+    most_likely_cn[:] = states[rows, best]
+    most_likely_cn[n_states == 1] = states[n_states == 1, 0]
+    most_likely_cn[missing] = np.nan
     return most_likely_cn, most_likely_pv
 
+def get_state_probs(inputs, phi):
+    '''
+    probabilities of the copy-number states of each variant, given its phi,
+    as comma-separated strings
+    '''
+    lls = inputs.calc_state_liks(phi)[1]
+    return [format_probs(get_probs_from_llik(ll[:n])) for ll, n in zip(lls, inputs.n_states)]
 
-def get_initialisation(nclus_init, Ndp, sparams, sup, dep, norm, cn_states, sens, phi_limit, pval_cutoff):
+
+def get_initialisation(nclus_init, Ndp, sparams, sup, dep, inputs, sens, phi_limit):
 
     purity, ploidy, mean_cov = sparams['pi'], sparams['ploidy'], sparams['mean_cov']
-    mlcn, mlpv = get_most_likely_cn_states(cn_states, sup, dep, np.ones(len(sup)), purity, pval_cutoff, norm)
+    mlpv = get_most_likely_pvs(inputs, np.ones(len(sup)))
     data = (sup / dep) * (1 / np.array(mlpv))
     data = np.array([d if d < phi_limit else phi_limit for d in data])
     data = np.array([d if d > sens else sens for d in data])
@@ -225,9 +518,50 @@ def get_initialisation(nclus_init, Ndp, sparams, sup, dep, norm, cn_states, sens
 
     return z_init, phi_init
 
-def cluster(sup,dep,cn_states,Nvar,sparams,cparams,phi_limit,norm,recluster=False):
+def get_start_values(nclus_init, Nvar, Ndp, sparams, sup, dep, inputs, sens, phi_limit, recluster):
+    '''
+    starting cluster assignments and phis of the sampler
+    '''
+    z_init = np.zeros(Nvar, dtype=np.int)
+    phi_init = np.random.rand(Ndp) * phi_limit
+
+    # use smart initialisation if nclus_init specified
+    if not nclus_init.lower() in ("no", "false", "f"):
+        try:
+            nclus_init = nclus_init if not recluster else 1
+            nclus_init = int(nclus_init)
+            nclus_init = Ndp if nclus_init > Ndp else nclus_init
+            if nclus_init == 1:
+                phi_init[0] = 1.
+            else:
+                z_init, phi_init = get_initialisation(nclus_init, Ndp, sparams, sup, dep,
+                                                      inputs, sens, phi_limit)
+        except ValueError:
+            pass
+
+
+    phi_init = np.array([sens if x < sens else x for x in phi_init])
+    return z_init, phi_init
+
+def get_model_func(inputs, grid=None):
+    '''
+    function giving the model log-likelihoods and pvs of the variants in
+    rows (all if None) at their phis, exact or interpolated from the phi
+    grid (which gives no pvs)
     '''
-    clustering model using Dirichlet Process
+    def model_func(phi, rows=None):
+        if grid is not None:
+            rows = grid.rows if rows is None else rows
+            return grid.get_lls(np.zeros(len(rows)) + phi, rows), None
+        var_inputs = inputs if rows is None else inputs[rows]
+        best, pvs = get_most_likely_states(var_inputs, np.zeros(len(var_inputs)) + phi)
+        return var_inputs.calc_var_liks(pvs - 0.00000001), pvs
+    return model_func
+
+def cluster(sup,dep,cn_states,Nvar,sparams,cparams,phi_limit,norm,recluster=False,inputs=None):
+    '''
+    clustering model using Dirichlet Process, inputs are the run's
+    ModelInputs (built from the variants if not given)
     '''
     Ndp = cparams['clus_limit'] if not recluster else 1
     n_iter = cparams['n_iter'] if not recluster else cparams['merge_iter']
@@ -235,13 +569,19 @@ def cluster(sup,dep,cn_states,Nvar,sparams,cparams,phi_limit,norm,recluster=Fals
     thin, use_map = cparams['thin'], cparams['use_map']
     use_map = False if recluster else use_map
     nclus_init = cparams['nclus_init']
+    engine = cparams['engine']
 
     purity, ploidy = sparams['pi'], sparams['ploidy']
     fixed_alpha, gamma_a, gamma_b = cparams['fixed_alpha'], cparams['alpha'], cparams['beta']
     sens = 1.0 / ((purity/ float(ploidy)) * np.mean(dep))
-    pval_cutoff = cparams['clonal_cnv_pval']
+    inputs = ModelInputs(cn_states, sup, dep, purity, norm) if inputs is None else inputs
+    phi_grid = cparams['phi_grid'] if not recluster else 0
     print('phi lower limit: %f; phi upper limit: %f' % (sens, phi_limit))
 
+    grid = None
+    if phi_grid > 0:
+        grid = get_phi_grid(inputs, sens, phi_limit, phi_grid)
+
     if fixed_alpha.lower() in ("yes", "true", "t"):
         fixed = True
         fixed_alpha = 0.75 / math.log10(Nvar) if Nvar > 10 else 1
@@ -254,10 +594,29 @@ def cluster(sup,dep,cn_states,Nvar,sparams,cparams,phi_limit,norm,recluster=Fals
 
     if fixed:
         print('Dirichlet concentration fixed at %f' % fixed_alpha)
-        h = pm.Beta('h', alpha=1, beta=fixed_alpha, size=Ndp)
     else:
         beta_init = float(gamma_a) / gamma_b
         print("Dirichlet concentration gamma prior values: alpha = %f; beta= %f; init = %f" % (gamma_a, gamma_b, beta_init))
+
+    if engine == 'gibbs':
+        z_init, phi_init = get_start_values(nclus_init, Nvar, Ndp, sparams, sup, dep, inputs,
+                                            sens, phi_limit, recluster)
+        model_func = get_model_func(inputs, grid)
+        return gibbs.sample(model_func, Nvar, Ndp, z_init, phi_init, sens, phi_limit, n_iter, burn,
+                            thin, fixed_alpha, gamma_a, gamma_b, fixed, use_map)
+
+    if engine == 'vi':
+        z_init, phi_init = get_start_values(nclus_init, Nvar, Ndp, sparams, sup, dep, inputs,
+                                            sens, phi_limit, recluster)
+        grid = PhiGrid(inputs, sens, phi_limit, vi.grid_size) if grid is None else grid
+        return vi.fit(grid.lls, grid.phis, Nvar, Ndp, z_init, fixed_alpha, gamma_a, gamma_b, fixed)
+
+    if pm is None:
+        raise ImportError('pymc is required for the mcmc engine (or set engine: gibbs)')
+
+    if fixed:
+        h = pm.Beta('h', alpha=1, beta=fixed_alpha, size=Ndp)
+    else:
         alpha = pm.Gamma('alpha', gamma_a, gamma_b, value = beta_init)
         h = pm.Beta('h', alpha=1, beta=alpha, size=Ndp)
 
@@ -268,43 +627,42 @@ def cluster(sup,dep,cn_states,Nvar,sparams,cparams,phi_limit,norm,recluster=Fals
         value[-1] = 1-sum(value[:-1])
         return value
 
-    z_init = np.zeros(Nvar, dtype=np.int)
-    phi_init = np.random.rand(Ndp) * phi_limit
-
-    # use smart initialisation if nclus_init specified
-    if not nclus_init.lower() in ("no", "false", "f"):
-        try:
-            nclus_init = nclus_init if not recluster else 1
-            nclus_init = int(nclus_init)
-            nclus_init = Ndp if nclus_init > Ndp else nclus_init
-            if nclus_init == 1:
-                phi_init[0] = 1.
-            else:
-                z_init, phi_init = get_initialisation(nclus_init, Ndp, sparams, sup, dep, norm,
-                                                      cn_states, sens, phi_limit, pval_cutoff)
-        except ValueError:
-            pass
+    z_init, phi_init = get_start_values(nclus_init, Nvar, Ndp, sparams, sup, dep, inputs,
+                                        sens, phi_limit, recluster)
 
     z = pm.Categorical('z', p = p, size = Nvar, value = z_init)
-    phi_init = np.array([sens if x < sens else x for x in phi_init])
     phi_k = pm.Uniform('phi_k', lower = sens, upper = phi_limit, size = Ndp, value=phi_init)
 
-    @pm.deterministic
-    def p_var(z=z, phi_k=phi_k, z_init=z_init):
-#        if np.any(np.isnan(phi_k)):
-#            phi_k = phi_init
-        if np.any(z < 0):
-            z = z_init
-            # ^ some fmin optimization methods initialise this array with -ve numbers
-        most_lik_cn_states, pvs = \
-                get_most_likely_cn_states(cn_states, sup, dep, phi_k[z], purity, pval_cutoff, norm)
-        return np.array(pvs)-0.00000001
-
-    cbinom = pm.Binomial('cbinom', dep, p_var, observed=True, value=sup)
+    # only variants whose phi changed since the last step are recomputed
+    cache = VarLikCache(get_model_func(inputs, grid), Nvar)
+
+    if grid is None:
+        @pm.deterministic
+        def p_var(z=z, phi_k=phi_k, z_init=z_init):
+#            if np.any(np.isnan(phi_k)):
+#                phi_k = phi_init
+            if np.any(z < 0):
+                z = z_init
+                # ^ some fmin optimization methods initialise this array with -ve numbers
+            pvs = cache.update(phi_k[z]).pvs
+            return pvs-0.00000001
+
+        cbinom = pm.Binomial('cbinom', dep, p_var, observed=True, value=sup)
+        likelihood = [p_var, cbinom]
+    else:
+        # approximate model, the likelihood is interpolated from the phi grid
+        @pm.stochastic(observed=True)
+        def cbinom(value=sup, z=z, phi_k=phi_k, z_init=z_init):
+            if np.any(z < 0):
+                z = z_init
+            return cache.update(phi_k[z]).total
+
+        likelihood = [cbinom]
+
     if fixed:
-        model = pm.Model([h, p, phi_k, z, p_var, cbinom])
+        model = pm.Model([h, p, phi_k, z] + likelihood)
     else:
-        model = pm.Model([alpha, h, p, phi_k, z, p_var, cbinom])
+        model = pm.Model([alpha, h, p, phi_k, z] + likelihood)
 
     mcmc, map_ = fit_and_sample(model, n_iter, burn, thin, use_map)
 
@@ -0,0 +1,90 @@
+'''
+Per-variant candidate copy-number states, stored as a flat ragged array
+'''
+import numpy as np
+
+class CNStates(object):
+    '''
+    Candidate copy-number states of each variant in CSR form: states is an
+    (n_states x 4) float array of (ref_cn, var_total, mu_v, frac) rows,
+    grouped by variant, where the states of variant i are
+    states[offsets[i]:offsets[i+1]] and var_idx gives the variant of each
+    state. Indexing by an integer returns the (read-only) states of that
+    variant, indexing by a slice, mask or index array returns a CNStates
+    of the selected variants.
+    '''
+    def __init__(self, states=None, offsets=None):
+        self.states = np.empty((0, 4)) if states is None else states
+        self.offsets = np.zeros(1, dtype=int) if offsets is None else offsets
+        self.states.flags.writeable = False
+        self.var_idx = np.repeat(np.arange(len(self)), self.lengths)
+        self._padded = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.states[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            idx = idx + len(self) if idx < 0 else idx
+            if idx < 0 or idx >= len(self):
+                raise IndexError('variant index out of range')
+            return self.states[self.offsets[idx]:self.offsets[idx+1]]
+        return self.subset(np.arange(len(self))[idx])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def padded(self):
+        '''
+        (n x max_states x 4) array of the states of each variant, padded
+        with NaNs, and the (n x max_states) mask of the actual states
+        '''
+        if self._padded is None:
+            n_states = np.max(self.lengths) if len(self) > 0 else 0
+            pos = np.arange(len(self.states)) - self.offsets[self.var_idx]
+            states = np.full((len(self), n_states, 4), np.nan)
+            is_state = np.zeros((len(self), n_states), dtype=bool)
+            states[self.var_idx, pos] = self.states
+            is_state[self.var_idx, pos] = True
+            states.flags.writeable = False
+            self._padded = (states, is_state)
+        return self._padded
+
+    def subset(self, var_idxs):
+        '''
+        CNStates of the given variants, in the given order
+        '''
+        var_idxs = np.asarray(var_idxs, dtype=int)
+        lengths = self.lengths[var_idxs]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+        state_idxs = np.repeat(self.offsets[:-1][var_idxs] - offsets[:-1], lengths) + \
+                        np.arange(offsets[-1])
+        return CNStates(self.states[state_idxs], offsets)
+
+def from_combos(combos):
+    '''
+    CNStates from a list of per-variant (n_i x 4) state arrays or lists
+    '''
+    combos = [np.asarray(c, dtype=float).reshape(-1, 4) for c in combos]
+    lengths = [len(c) for c in combos]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+    states = np.concatenate(combos) if len(combos) > 0 else np.empty((0, 4))
+    return CNStates(states, offsets)
+
+def concat_cn_states(cn_states_list):
+    '''
+    concatenate the variants of several CNStates
+    '''
+    cn_states_list = [cn for cn in cn_states_list if len(cn) > 0]
+    if len(cn_states_list) == 0:
+        return CNStates()
+    states = np.concatenate([cn.states for cn in cn_states_list])
+    ends = np.cumsum([cn.offsets[-1] for cn in cn_states_list])
+    offsets = [cn_states_list[0].offsets[:1]] + \
+              [cn.offsets[1:] + start for cn, start in zip(cn_states_list, np.append(0, ends[:-1]))]
+    return CNStates(states, np.concatenate(offsets))
@@ -0,0 +1,193 @@
+'''
+Parsed copy-number genotypes. Genotypes are written out as strings of the
+form "major,minor,frac|major,minor,frac" (one entry per clone, '' if there
+is no copy-number call). They are parsed into numeric tables when variants
+are matched to copy-numbers, or when a step reads the filtered variants, and
+are passed along with the variant frame as a list of tables, one per
+genotype field (see gtype_fields).
+'''
+from __future__ import print_function
+
+import numpy as np
+
+# battenberg reports at most two clones per segment
+max_clones = 2
+
+class GenotypeTable(object):
+    '''
+    Fixed-width numeric genotypes: cns is an (n x max_clones x 3) float array
+    of (major, minor, frac) per clone, valid an (n x max_clones) boolean mask
+    of the clones present. Missing genotypes have no valid clones.
+    Genotypes with more than max_clones clones keep their first max_clones
+    clones, max_allele (the highest major or minor copy-number) and
+    weighted_cn (see get_weighted_cn) are taken over all clones.
+    '''
+    def __init__(self, cns=None, valid=None, max_allele=None, weighted_cn=None):
+        self.cns = np.full((0, max_clones, 3), np.nan) if cns is None else cns
+        self.valid = np.zeros((0, max_clones), dtype=bool) if valid is None else valid
+        if max_allele is None:
+            max_allele = np.max(np.where(self.valid, np.maximum(self.major, self.minor), -np.inf), axis=1)
+        if weighted_cn is None:
+            weighted_cn = np.sum(np.where(self.valid, get_weighted_cn(self.cns), 0), axis=1)
+        self.max_allele = max_allele
+        self.weighted_cn = weighted_cn
+
+    def __len__(self):
+        return len(self.cns)
+
+    def __getitem__(self, idx):
+        return GenotypeTable(self.cns[idx], self.valid[idx], self.max_allele[idx], self.weighted_cn[idx])
+
+    @property
+    def major(self):
+        return self.cns[:, :, 0]
+
+    @property
+    def minor(self):
+        return self.cns[:, :, 1]
+
+    @property
+    def frac(self):
+        return self.cns[:, :, 2]
+
+    @property
+    def total(self):
+        return self.major + self.minor
+
+    @property
+    def n_clones(self):
+        return np.sum(self.valid, axis=1)
+
+    @property
+    def missing(self):
+        return self.n_clones == 0
+
+    @property
+    def subclonal(self):
+        return self.n_clones > 1
+
+    def take(self, idx):
+        '''
+        genotypes at the row indexes idx, missing where idx is -1
+        '''
+        table = concat_gtypes([self, parse_gtypes([''])])
+        return table[np.where(idx < 0, len(self), idx)]
+
+    def clones(self, idx):
+        '''
+        list of (major, minor, frac) of the clones of genotype idx
+        '''
+        return [tuple(cn) for cn in self.cns[idx][self.valid[idx]].tolist()]
+
+    def unique(self):
+        '''
+        the distinct genotypes of the table, and the index
+        of each genotype in these
+        '''
+        if len(self) == 0:
+            return self, np.empty(0, dtype=int)
+        cns = np.where(self.valid[:, :, np.newaxis], self.cns, 0)
+        keys = np.concatenate([cns.reshape(len(self), -1), self.valid], axis=1)
+        uniq, idx, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        return self[idx], inverse
+
+    def clear(self, mask):
+        '''
+        copy of the table with the genotypes in mask set to missing
+        '''
+        valid = self.valid.copy()
+        valid[mask] = False
+        return GenotypeTable(self.cns.copy(), valid, self.max_allele.copy(), self.weighted_cn.copy())
+
+    def fill(self, mask, gtype):
+        '''
+        copy of the table with the genotypes in mask set to gtype
+        '''
+        gt = parse_gtypes([gtype])
+        cns, valid = self.cns.copy(), self.valid.copy()
+        max_allele, weighted_cn = self.max_allele.copy(), self.weighted_cn.copy()
+        cns[mask], valid[mask] = gt.cns[0], gt.valid[0]
+        max_allele[mask], weighted_cn[mask] = gt.max_allele[0], gt.weighted_cn[0]
+        return GenotypeTable(cns, valid, max_allele, weighted_cn)
+
+def concat_gtypes(tables):
+    '''
+    GenotypeTable of the rows of tables, in order
+    '''
+    return GenotypeTable(np.concatenate([gt.cns for gt in tables]),
+                         np.concatenate([gt.valid for gt in tables]),
+                         np.concatenate([gt.max_allele for gt in tables]),
+                         np.concatenate([gt.weighted_cn for gt in tables]))
+
+def gtype_fields(snvs=False):
+    return ['gtype'] if snvs else ['gtype1', 'gtype2']
+
+def parse_var_gtypes(var_df, snvs=False):
+    '''
+    GenotypeTables of the genotype fields of a variant frame
+    '''
+    return [parse_gtypes(var_df[field].values) if field in var_df else GenotypeTable()
+            for field in gtype_fields(snvs)]
+
+def take_gtypes(gts, idx):
+    '''
+    rows idx (indexes or a boolean mask) of each of the variant genotype tables gts
+    '''
+    return [gt[idx] for gt in gts]
+
+def concat_var_gtypes(var_gts):
+    '''
+    concatenate the genotype tables of several variant sets field by field
+    '''
+    return [concat_gtypes(tables) for tables in zip(*var_gts)]
+
+def repeat_gtype(gtype, n):
+    '''
+    GenotypeTable of n copies of genotype string gtype
+    '''
+    return parse_gtypes([gtype])[np.zeros(n, dtype=int)]
+
+def get_weighted_cn(cns):
+    '''
+    copy-number of (major, minor, frac) clones in the last axis of cns,
+    weighted as in the filter's read depth normalisation
+    '''
+    return np.trunc(cns[..., 0]) + np.trunc(cns[..., 1]) * cns[..., 2]
+
+def parse_gtype(gtype):
+    '''
+    list of (major, minor, frac) per clone of a genotype string
+    '''
+    if not isinstance(gtype, basestring) or gtype == '':
+        return []
+    clones = [tuple(map(float, clone.split(',')[:3])) for clone in gtype.split('|')]
+    if any([len(cn) < 3 for cn in clones]):
+        raise ValueError('Invalid copy-number genotype %s' % gtype)
+    return clones
+
+def parse_gtypes(gtypes):
+    '''
+    GenotypeTable of an array of genotype strings (missing values are
+    treated as ''), parsing each distinct genotype once
+    '''
+    gtypes = [gt if isinstance(gt, basestring) else '' for gt in gtypes]
+    if len(gtypes) == 0:
+        return GenotypeTable()
+
+    uniq, inverse = np.unique(np.array(gtypes, dtype=object), return_inverse=True)
+    cns = np.full((len(uniq), max_clones, 3), np.nan)
+    valid = np.zeros((len(uniq), max_clones), dtype=bool)
+    max_allele, weighted_cn = np.full(len(uniq), -np.inf), np.zeros(len(uniq))
+    for i, gtype in enumerate(uniq):
+        clones = parse_gtype(gtype)
+        if len(clones) > max_clones:
+            print('WARNING: genotype %s has more than %d clones, only the first %d are clustered' % \
+                    (gtype, max_clones, max_clones))
+        for j, cn in enumerate(clones[:max_clones]):
+            cns[i, j], valid[i, j] = cn, True
+        if len(clones) > 0:
+            clones = np.array(clones)
+            max_allele[i] = np.max(clones[:, :2])
+            weighted_cn[i] = np.sum(get_weighted_cn(clones))
+
+    return GenotypeTable(cns[inverse], valid[inverse], max_allele[inverse], weighted_cn[inverse])
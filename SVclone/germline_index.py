@@ -0,0 +1,141 @@
+'''
+Sorted index of germline SV break-pairs, from a germline svinfo file or a
+pre-built panel of normals
+'''
+from __future__ import print_function
+
+import os
+import numpy as np
+import pandas as pd
+
+# positions are packed below the chromosome pair code in a single sort key
+pos_bits = 40
+
+class GermlineIndex(object):
+    '''
+    Break-pairs (chr1, pos1, chr2, pos2) are stored in both orientations,
+    sorted by chromosome pair then pos1, so an SV matches a germline SV if
+    both break-ends lie within the threshold in either orientation.
+    '''
+    def __init__(self, pairs=None, keys=None, pos2=None):
+        self.pairs = [] if pairs is None else list(pairs)
+        self.pair_codes = dict([(pair, code) for code, pair in enumerate(self.pairs)])
+        self.keys = np.empty(0, dtype='int64') if keys is None else keys
+        self.pos2 = np.empty(0, dtype='int64') if pos2 is None else pos2
+
+    def __len__(self):
+        return len(self.keys)
+
+    def build(self, chr1, pos1, chr2, pos2):
+        chr1 = np.asarray(chr1).astype(str)
+        chr2 = np.asarray(chr2).astype(str)
+        pos1 = np.asarray(pos1).astype('int64')
+        pos2 = np.asarray(pos2).astype('int64')
+
+        # add the flipped orientation of each break-pair
+        pairs = np.char.add(np.char.add(np.concatenate([chr1, chr2]), '\t'),
+                            np.concatenate([chr2, chr1]))
+        first, second = np.concatenate([pos1, pos2]), np.concatenate([pos2, pos1])
+
+        self.pairs, codes = np.unique(pairs, return_inverse=True)
+        self.pairs = list(self.pairs)
+        self.pair_codes = dict([(pair, code) for code, pair in enumerate(self.pairs)])
+        keys = (codes.astype('int64') << pos_bits) + first
+
+        entries = np.unique(np.rec.fromarrays([keys, second], names='key,pos2'))
+        self.keys, self.pos2 = entries['key'], entries['pos2']
+        return self
+
+    def get_pair_codes(self, chr1, chr2):
+        pairs = np.char.add(np.char.add(np.asarray(chr1).astype(str), '\t'),
+                            np.asarray(chr2).astype(str))
+        uniq, inverse = np.unique(pairs, return_inverse=True)
+        codes = np.array([self.pair_codes.get(pair, -1) for pair in uniq], dtype='int64')
+        return codes[inverse] if len(pairs) > 0 else np.empty(0, dtype='int64')
+
+    def query(self, chr1, pos1, chr2, pos2, threshold):
+        '''
+        returns a boolean array, True where the break-pair lies within
+        threshold bp (exclusive) of a germline break-pair on both ends
+        '''
+        pos1 = np.atleast_1d(np.asarray(pos1)).astype('int64')
+        pos2 = np.atleast_1d(np.asarray(pos2)).astype('int64')
+        codes = self.get_pair_codes(np.atleast_1d(chr1), np.atleast_1d(chr2))
+        hits = np.zeros(len(pos1), dtype=bool)
+        if len(self.keys) == 0 or len(pos1) == 0:
+            return hits
+
+        base = np.where(codes >= 0, codes << pos_bits, -1)
+        lo = np.searchsorted(self.keys, base + pos1 - threshold + 1, side='left')
+        hi = np.searchsorted(self.keys, base + pos1 + threshold, side='left')
+        n_cands = np.where(codes >= 0, hi - lo, 0)
+
+        # check pos2 of each candidate within the pos1 window
+        owners = np.repeat(np.arange(len(pos1)), n_cands)
+        offsets = np.arange(len(owners)) - np.repeat(np.cumsum(n_cands) - n_cands, n_cands)
+        cands = lo[owners] + offsets
+        close = np.abs(self.pos2[cands] - pos2[owners]) < threshold
+        hits[np.unique(owners[close])] = True
+        return hits
+
+    def save(self, panel_file):
+        np.savez(panel_file, pairs=np.array(self.pairs), keys=self.keys, pos2=self.pos2)
+
+def load_panel(panel_file):
+    with np.load(panel_file) as panel:
+        return GermlineIndex(panel['pairs'].astype(str), panel['keys'], panel['pos2'])
+
+def load_germline_svs(gml_file, min_support=1):
+    df_gml = pd.DataFrame(pd.read_csv(gml_file,delimiter='\t',dtype=None,low_memory=False))
+    return df_gml[df_gml.support.values >= min_support]
+
+def load_germline_index(gml_file):
+    '''
+    load a germline panel (.npz) or index the germline SVs (with support)
+    of a svinfo file
+    '''
+    if gml_file.endswith('.npz'):
+        return load_panel(gml_file)
+    df_gml = load_germline_svs(gml_file)
+    return GermlineIndex().build(df_gml.chr1.values, df_gml.pos1.values,
+                                 df_gml.chr2.values, df_gml.pos2.values)
+
+def build_panel(args):
+    '''
+    compile the germline SVs of many normals (svinfo files) into a panel,
+    keeping break-pairs found in at least min_samples normals
+    '''
+    gml_files   = args.germline_svs
+    panel_file  = args.out
+    min_support = args.min_support
+    min_samples = args.min_samples
+
+    panel_file = panel_file if panel_file.endswith('.npz') else panel_file + '.npz'
+    out_dir = os.path.dirname(panel_file)
+    if out_dir != '' and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    sv_dtype = [('chr1', 'S50'), ('pos1', 'int64'), ('chr2', 'S50'), ('pos2', 'int64')]
+    sample_svs = []
+    for gml_file in gml_files:
+        df_gml = load_germline_svs(gml_file, min_support)
+        chr1, pos1 = df_gml.chr1.map(str).values, df_gml.pos1.values
+        chr2, pos2 = df_gml.chr2.map(str).values, df_gml.pos2.values
+
+        # list break-pairs in one break-end order, so normals reporting
+        # an SV in opposite orders count towards the same break-pair
+        flip = np.logical_or(chr1 > chr2, np.logical_and(chr1 == chr2, pos1 > pos2))
+        svs = np.empty(len(df_gml), dtype=sv_dtype)
+        svs['chr1'], svs['pos1'] = np.where(flip, chr2, chr1), np.where(flip, pos2, pos1)
+        svs['chr2'], svs['pos2'] = np.where(flip, chr1, chr2), np.where(flip, pos1, pos2)
+        # count each break-pair once per normal
+        sample_svs.append(np.unique(svs))
+        print('Loaded %d germline SVs from %s' % (len(sample_svs[-1]), gml_file))
+
+    svs = np.concatenate(sample_svs) if len(sample_svs) > 0 else np.empty(0, dtype=sv_dtype)
+    svs, n_samples = np.unique(svs, return_counts=True)
+    svs = svs[n_samples >= min_samples]
+
+    panel = GermlineIndex().build(svs['chr1'], svs['pos1'], svs['chr2'], svs['pos2'])
+    panel.save(panel_file)
+    print('Wrote germline panel of %d SVs from %d normals to %s' % (len(svs), len(gml_files), panel_file))
@@ -0,0 +1,185 @@
+'''
+Blocked Gibbs sampler for the truncated stick-breaking Dirichlet process
+mixture of cluster.cluster, using numpy only. All assignments are drawn
+at once from their full conditionals, cluster CCFs by slice sampling.
+'''
+from __future__ import print_function
+
+import numpy as np
+from scipy.special import gammaln
+
+from .lik_cache import VarLikCache
+
+# shrinkage steps allowed per slice-sampling update of a cluster phi
+max_slice_steps = 50
+
+class Trace(object):
+    '''
+    sampled values of each node after burn-in and thinning, in the shape
+    of pymc's traces, read with trace('phi_k')[:]
+    '''
+    def __init__(self, traces):
+        self.traces = traces
+
+    def trace(self, name):
+        return self.traces[name]
+
+class SampleFit(object):
+    '''
+    fit of the highest posterior sample, with the fields of a pymc MAP fit
+    '''
+    def __init__(self, lnL, logp, n_params, n_data):
+        self.lnL, self.logp, self.logp_at_max = lnL, logp, logp
+        self.len, self.data_len = n_params, n_data
+        self.AIC = 2. * (self.len - lnL)
+        self.AICc = self.AIC + ((2 * self.len * (self.len + 1)) / float(self.data_len - self.len - 1))
+        self.BIC = self.len * np.log(self.data_len) - 2. * lnL
+
+def sample_sticks(counts, alpha):
+    '''
+    stick-breaking fractions given the cluster sizes,
+    the last stick takes the remainder
+    '''
+    rest = np.cumsum(counts[::-1])[::-1] - counts
+    h = np.random.beta(1. + counts, alpha + rest)
+    h[-1] = 1.
+    return h
+
+def get_weights(h):
+    w = h * np.concatenate([[1.], np.cumprod(1. - h[:-1])])
+    w[-1] = 1. - np.sum(w[:-1])
+    return np.maximum(w, 0.)
+
+def sample_alpha(h, gamma_a, gamma_b):
+    '''
+    DP concentration from its conditional given the sticks (Gamma prior
+    with shape gamma_a and rate gamma_b)
+    '''
+    log_rest = np.log1p(-np.minimum(h[:-1], 1. - 1e-12))
+    alpha = np.random.gamma(gamma_a + len(h) - 1, 1. / (gamma_b - np.sum(log_rest)))
+    return max(alpha, 1e-10)
+
+def sample_slice(log_f, x0, lower, upper, f0=None):
+    '''
+    slice-sampling update of x0 under log_f, shrinking from the full
+    support [lower, upper]; keeps x0 if no point is accepted. f0 is
+    log_f(x0) if already known.
+    '''
+    f0 = log_f(x0) if f0 is None else f0
+    y = f0 + np.log(np.random.rand())
+    for i in range(max_slice_steps):
+        x1 = lower + np.random.rand() * (upper - lower)
+        if log_f(x1) > y:
+            return x1
+        if x1 < x0:
+            lower = x1
+        else:
+            upper = x1
+    return x0
+
+def sample_assignments(lls, log_w):
+    '''
+    draw each variant's cluster from its (n x K) log-probabilities, variants
+    that are impossible under every cluster are drawn from the weights
+    '''
+    logits = lls + log_w
+    row_max = np.max(logits, axis=1)
+    impossible = ~np.isfinite(row_max)
+    logits[impossible] = log_w
+    row_max[impossible] = np.max(log_w)
+
+    probs = np.exp(logits - row_max[:, np.newaxis])
+    cum = np.cumsum(probs, axis=1)
+    u = np.random.rand(len(cum)) * cum[:, -1]
+    z = np.sum(cum < u[:, np.newaxis], axis=1)
+    return np.minimum(z, lls.shape[1] - 1)
+
+def get_logp(lnL, z, w, h, phi_range, alpha, gamma_a, gamma_b, fixed):
+    '''
+    log-posterior of a sample of the model
+    '''
+    with np.errstate(divide='ignore'):
+        logp = lnL + np.sum(np.log(w[z]))
+        logp += np.sum(np.log(alpha) + (alpha - 1) * np.log1p(-h[:-1]))
+        logp -= len(h) * np.log(phi_range)
+    if not fixed:
+        logp += gamma_a * np.log(gamma_b) - gammaln(gamma_a) + \
+                (gamma_a - 1) * np.log(alpha) - gamma_b * alpha
+    return logp
+
+def sample(model_func, Nvar, Ndp, z_init, phi_init, sens, phi_limit, n_iter, burn, thin,
+           alpha, gamma_a, gamma_b, fixed, use_map):
+    '''
+    model_func(phi, rows) gives the log-likelihoods (and pvs) of the variants
+    in rows (all if None) at a phi, see VarLikCache. Returns the Trace of the
+    retained iterations, and if use_map the SampleFit of the highest
+    posterior retained sample.
+    '''
+    z = np.asarray(z_init, dtype=int).copy()
+    phi_k = np.asarray(phi_init, dtype=float).copy()
+    alpha = float(gamma_a) / gamma_b if not fixed else alpha
+
+    keep = [i for i in range(burn, n_iter) if (i - burn) % thin == 0]
+    z_trace = np.empty((len(keep), Nvar), dtype=int)
+    phi_trace = np.empty((len(keep), Ndp))
+    h_trace, p_trace = np.empty((len(keep), Ndp)), np.empty((len(keep), Ndp))
+    alpha_trace = np.empty(len(keep))
+    best_fit = None
+
+    # log-likelihoods of all variants under each cluster, at its current phi
+    caches = [VarLikCache(model_func, Nvar).update(np.full(Nvar, phi)) for phi in phi_k]
+
+    n_kept = 0
+    for it in range(n_iter):
+        counts = np.bincount(z, minlength=Ndp).astype(float)
+        h = sample_sticks(counts, alpha)
+        if not fixed:
+            alpha = sample_alpha(h, gamma_a, gamma_b)
+            h[:-1] = np.minimum(h[:-1], 1. - 1e-12)
+        w = get_weights(h)
+
+        for k in range(Ndp):
+            members = np.where(z == k)[0]
+            if len(members) == 0:
+                phi_k[k] = sens + np.random.rand() * (phi_limit - sens)
+                caches[k].update(np.full(Nvar, phi_k[k]))
+                continue
+
+            # keep the members' log-likelihoods at each phi tried, so
+            # only the other variants are recomputed at the new phi
+            member_lls = {}
+            def log_f(phi):
+                member_lls[phi] = model_func(phi, members)[0]
+                return np.sum(member_lls[phi])
+
+            f0 = np.sum(caches[k].lls[members])
+            phi_k[k] = sample_slice(log_f, phi_k[k], sens, phi_limit, f0)
+            if phi_k[k] in member_lls:
+                caches[k].set(members, phi_k[k], member_lls[phi_k[k]])
+            caches[k].update(np.full(Nvar, phi_k[k]))
+
+        lls = np.column_stack([cache.lls for cache in caches])
+        with np.errstate(divide='ignore'):
+            z = sample_assignments(lls, np.log(w))
+
+        if (it + 1) % max(1, n_iter // 10) == 0:
+            print('Gibbs sampler: %d of %d iterations complete' % (it + 1, n_iter))
+
+        if it < burn or (it - burn) % thin != 0:
+            continue
+
+        z_trace[n_kept], phi_trace[n_kept] = z, phi_k
+        h_trace[n_kept], p_trace[n_kept], alpha_trace[n_kept] = h, w, alpha
+        n_kept += 1
+
+        if use_map:
+            lnL = np.sum(lls[np.arange(Nvar), z])
+            logp = get_logp(lnL, z, w, h, phi_limit - sens, alpha, gamma_a, gamma_b, fixed)
+            if best_fit is None or logp > best_fit.logp:
+                n_params = 2 * Ndp + Nvar + (0 if fixed else 1)
+                best_fit = SampleFit(lnL, logp, n_params, Nvar)
+
+    traces = {'z': z_trace, 'phi_k': phi_trace, 'h': h_trace, 'p': p_trace}
+    if not fixed:
+        traces['alpha'] = alpha_trace
+    return Trace(traces), best_fit
@@ -0,0 +1,147 @@
+'''
+Binary cache of parsed input tables (SNVs, CNVs and SVs), so re-running
+the filter or post-assign steps does not re-parse unchanged inputs
+'''
+from __future__ import print_function
+
+import os
+import glob
+import hashlib
+import ConfigParser
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+
+# part of every entry's key, bump when a loader changes the table it returns
+# so that entries written by older loaders are no longer used
+cache_version = '1'
+
+def string_to_bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+def get_file_hash(in_file, block_size=2**20):
+    md5 = hashlib.md5()
+    with open(in_file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def get_fingerprint(in_file, content_hash=True):
+    '''
+    (path, size, mtime, md5) of the input file, the md5 is only
+    computed if content_hash is set
+    '''
+    stat = os.stat(in_file)
+    md5 = get_file_hash(in_file) if content_hash else ''
+    return [os.path.abspath(in_file), str(stat.st_size), repr(stat.st_mtime), md5]
+
+def column_to_array(values):
+    # store string columns as fixed-width byte strings, other objects are pickled
+    if values.dtype == object and all([isinstance(v, str) for v in values]):
+        return values.astype(str)
+    return values
+
+def array_to_column(values):
+    if values.dtype.kind == 'S':
+        return values.astype(object)
+    return values
+
+class InputCache(object):
+    '''
+    Parsed tables are saved as one .npz file per input (one array per column),
+    keyed by cache version, input path, loader name and loader parameters.
+    Entries store the input's fingerprint (path, size, mtime and md5) and are
+    re-parsed if the input changed. Once the cache exceeds max_size_mb, the
+    least recently used entries are removed. Set refresh to ignore (and
+    overwrite) existing entries.
+    '''
+    def __init__(self, cache_dir, max_size_mb=2048, enabled=True, refresh=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 2**20
+        self.enabled = enabled
+        self.refresh = refresh
+
+    def get_entry_file(self, in_file, name, params=()):
+        key = '\t'.join([cache_version, os.path.abspath(in_file), name] + [str(p) for p in params])
+        return '%s/%s_%s.npz' % (self.cache_dir, name, hashlib.md5(key).hexdigest())
+
+    def load(self, in_file, name, params, load_func):
+        '''
+        return the cached table for in_file if its fingerprint matches,
+        otherwise run load_func() and cache its result
+        '''
+        if not self.enabled:
+            return load_func()
+
+        entry_file = self.get_entry_file(in_file, name, params)
+        if not self.refresh and os.path.exists(entry_file):
+            df = self.read_entry(entry_file, in_file)
+            if df is not None:
+                print('Loaded %s from cache %s' % (name, entry_file))
+                os.utime(entry_file, None)
+                return df
+
+        df = load_func()
+        self.write_entry(entry_file, in_file, df)
+        self.evict()
+        return df
+
+    def read_entry(self, entry_file, in_file):
+        try:
+            with np.load(entry_file, allow_pickle=True) as entry:
+                cached = [str(f) for f in entry['__fingerprint__']]
+                fingerprint = get_fingerprint(in_file, content_hash=False)
+                if cached[:3] != fingerprint[:3] or cached[3] != get_file_hash(in_file):
+                    return None
+
+                columns = [str(col) for col in entry['__columns__']]
+                index = array_to_column(entry['__index__'])
+                data = OrderedDict([(col, array_to_column(entry['col_%d' % i])) \
+                                    for i, col in enumerate(columns)])
+        except (IOError, ValueError, KeyError):
+            print('WARNING: could not read cache entry %s, re-parsing input' % entry_file)
+            return None
+
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def write_entry(self, entry_file, in_file, df):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        arrays = {'col_%d' % i: column_to_array(df[col].values) for i, col in enumerate(df.columns)}
+        arrays['__columns__'] = np.array([str(col) for col in df.columns])
+        arrays['__index__'] = column_to_array(df.index.values)
+        arrays['__fingerprint__'] = np.array(get_fingerprint(in_file))
+
+        # write to a temporary file first so an interrupted run leaves no partial entry
+        tmp_file = entry_file[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_file, **arrays)
+        os.rename(tmp_file, entry_file)
+
+    def evict(self):
+        entries = [(os.path.getmtime(f), os.path.getsize(f), f) \
+                    for f in glob.glob('%s/*.npz' % self.cache_dir)]
+        total_size = sum([size for mtime, size, f in entries])
+        for mtime, size, entry_file in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(entry_file)
+            total_size -= size
+
+def get_input_cache(cfg, out, refresh=False):
+    '''
+    set up the input cache in <out>/input_cache from the config file's
+    (optional) InputCacheParameters, the cache is off if these are not set
+    '''
+    Config = ConfigParser.ConfigParser()
+    Config.read(cfg)
+    try:
+        enabled = string_to_bool(Config.get('InputCacheParameters', 'use_cache'))
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        enabled = False
+    try:
+        max_size_mb = int(Config.get('InputCacheParameters', 'max_size_mb'))
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        max_size_mb = 2048
+    return InputCache('%s/input_cache' % out, max_size_mb, enabled, refresh)
@@ -0,0 +1,52 @@
+'''
+Per-variant likelihood cache for the samplers. A sampler step changes only
+some variants' phis (one cluster's phi, or some assignments), so only
+those variants are recomputed.
+'''
+import numpy as np
+
+# above this fraction of dirty variants, recomputing all of them is
+# cheaper than selecting the dirty ones
+max_dirty_fraction = 0.5
+
+class VarLikCache(object):
+    '''
+    Model log-likelihood and pv of each variant at the phi it was last
+    computed for, and the running total of the log-likelihoods.
+    model_func(phi, rows) gives the log-likelihoods and pvs (or None) of
+    the variants in rows (all if None) at their phis.
+    '''
+    def __init__(self, model_func, n):
+        self.model_func = model_func
+        self.phi = np.full(n, np.nan)
+        self.lls = np.zeros(n)
+        self.pvs = np.zeros(n)
+        self.total = 0.
+
+    def __len__(self):
+        return len(self.phi)
+
+    def set(self, rows, phi, lls, pvs=None):
+        '''
+        store values already computed for the variants in rows
+        '''
+        self.total += np.sum(lls) - np.sum(self.lls[rows])
+        self.phi[rows], self.lls[rows] = phi, lls
+        if pvs is not None:
+            self.pvs[rows] = pvs
+        if not np.isfinite(self.total):
+            # running totals can't recover from infinities
+            self.total = np.sum(self.lls)
+
+    def update(self, phi):
+        '''
+        bring the cache up to date with each variant's phi, recomputing
+        only the variants whose phi changed (the dirty variants)
+        '''
+        phi = np.asarray(phi, dtype=float)
+        dirty = np.where(phi != self.phi)[0]
+        if len(dirty) > max_dirty_fraction * len(self):
+            self.set(slice(None), phi, *self.model_func(phi, None))
+        elif len(dirty) > 0:
+            self.set(dirty, phi[dirty], *self.model_func(phi[dirty], dirty))
+        return self
@@ -3,10 +3,13 @@ from __future__ import print_function
 import pandas as pd
 import numpy as np
 import vcf
+import pysam
 import ConfigParser
 import os
+import multiprocessing
 
 from . import cluster
+from .cn_states import concat_cn_states
 from SVprocess import svp_load_data as svp_load
 
 def get_normal_copynumber(chrom, male):
@@ -17,11 +20,12 @@ def get_normal_copynumber(chrom, male):
     else:
         return 2.
 
-def get_sv_vals(sv_df, adjusted, male, cparams):
-    combos = sv_df.apply(cluster.get_sv_allele_combos, axis=1, args=(cparams,)).values
+def get_sv_vals(sv_df, var_gts, adjusted, male, cparams):
+    gts1, gts2 = var_gts
     sides = sv_df.preferred_side.map(int).values
-    cn_states = [cn[side] for cn,side in zip(combos, sides)]
-    cn_states = pd.DataFrame([[sv] for sv in cn_states])[0].values
+    cn_states = concat_cn_states([cluster.get_cn_states(gts1, cparams),
+                                  cluster.get_cn_states(gts2, cparams)])
+    cn_states = cn_states[np.arange(len(sv_df)) + np.where(sides == 0, 0, len(sv_df))]
     chroms = [c1 if side == 0 else c2 for c1,c2,side in zip(sv_df.chr1.values, sv_df.chr2.values, sides)]
     norm = [get_normal_copynumber(c, male) for c in chroms]
 
@@ -38,12 +42,11 @@ def get_sv_vals(sv_df, adjusted, male, cparams):
         Nvar = len(sv_df)
         return sup,dep,cn_states,Nvar,norm
 
-def get_snv_vals(df, male, cparams):
+def get_snv_vals(df, var_gts, male, cparams):
     n = df['ref'].map(float).values
     b = df['var'].map(float).values
 
-    cn_states = [cluster.get_allele_combos(gtype.split('|'), cparams) for gtype in df.gtype]
-    cn_states = pd.DataFrame([[cn] for cn in cn_states])[0].values
+    cn_states = cluster.get_cn_states(var_gts[0], cparams)
 
     norm = [get_normal_copynumber(c, male) for c in df.chrom.values]
     return b,(n+b),cn_states,len(b),norm
@@ -167,167 +170,241 @@ def load_snvs_mutect_callstats(snvs):
     snv_out = snv_out[['chrom','pos','gtype','ref','var']]
     return snv_out
 
-def load_snvs_multisnv(snvs, sample):
-    snv_dtype = [('chrom','S50'),('pos',int),('gtype','S50'),('ref',float),('var',float)]
-    snv_df = np.empty([0,5],dtype=snv_dtype)
+snv_dtype = [('chrom','S50'),('pos',int),('gtype','S50'),('ref',float),('var',float)]
+snv_batch_size = 100000
 
-    vcf_reader = vcf.Reader(filename=snvs)
-    samples = vcf_reader.samples
-    if sample not in samples:
-        raise Exception('VCF SNV file is of invalid format: sample %s not present in VCF samples.' % sample)
-
-    for record in vcf_reader:
-        if record.FILTER is not None:
-            if len(record.FILTER)>0:
-                continue
-
-        allele_counts = record.genotype(sample)['BCOUNT']
-        tumor_reads = {
-            'A': allele_counts[0],
-            'C': allele_counts[1],
-            'G': allele_counts[2],
-            'T': allele_counts[3],
-        }
-
-        ref_reads     = tumor_reads[record.REF]
-        variant_reads = tumor_reads[str(record.ALT[0])]
-        total_reads   = ref_reads + variant_reads
+def parse_snv_multisnv(record, sample):
+    if record.FILTER is not None:
+        if len(record.FILTER)>0:
+            return None
 
-        if variant_reads != 0:
-            tmp = np.array((record.CHROM, record.POS, '', ref_reads, variant_reads), dtype=snv_dtype)
-            snv_df = np.append(snv_df, tmp)
+    allele_counts = record.genotype(sample)['BCOUNT']
+    tumor_reads = {
+        'A': allele_counts[0],
+        'C': allele_counts[1],
+        'G': allele_counts[2],
+        'T': allele_counts[3],
+    }
 
-    return pd.DataFrame(snv_df)
+    ref_reads     = tumor_reads[record.REF]
+    variant_reads = tumor_reads[str(record.ALT[0])]
+    return ref_reads, variant_reads
 
-def load_snvs_consensus(snvs):
+def parse_snv_consensus(record):
+    try:
+        return record.INFO['t_ref_count'], record.INFO['t_alt_count']
+    except KeyError:
+        print('WARNING: missing count field(s) in record %s:%d' % (record.CHROM, record.POS))
+        return None
+
+def parse_snv_mutect(record, sample):
+    if record.FILTER is not None:
+        if len(record.FILTER)>0:
+            return None
+    try:
+        if record.genotype('normal')['AD'][1]>0:
+            print('Removing variant %s:%d as it contains reads in the germline.' % (record.CHROM, record.POS))
+            return None
+    except KeyError:
+        pass
+    ad = record.genotype(sample)['AD']
+    return float(ad[0]), float(ad[1])
+
+def parse_snv_sanger(record):
+    # get most likely genotypes
+    genotypes = []
+    broad_syn = False
+    if 'TG' in record.INFO and 'SG' in record.INFO:
+      genotypes = [record.INFO['TG'], record.INFO['SG']]
+    else:
+      genotypes = [x for x in record.INFO.keys() if "/" in x ]
+      broad_syn = True
+
+    if len(genotypes)==0:
+        print('Warning: no valid genotypes for variant %s:%d; skipping.'%(record.CHROM,record.POS))
+        return None
+    if record.FILTER is not None:
+        if len(record.FILTER)>0:
+            return None
+
+    variant_set = set()
+    reference_nt = ''
+    while len(variant_set) == 0:
+        if len(genotypes) == 0:
+            break
+            #raise Exception('No more genotypes to find variant_nt in for %s' % variant)
+        if broad_syn:
+            gt = [x for x in genotypes if x.split("/")[0] != x.split("/")[1]][0]
+            tumour_gt, normal_gt = gt.split('/')
+        else:
+            gt = genotypes.pop(0)
+            normal_gt, tumour_gt = gt.split('/')
+        if normal_gt[0] == normal_gt[1]:
+            reference_nt = normal_gt[0]
+            variant_set = set(tumour_gt) - set(reference_nt)
+    variant_nt = variant_set.pop() if len(variant_set)!=0 else ''
+
+    if variant_nt=='':
+        print('Warning: no valid genotypes for variant %s:%d; skipping.'%(record.CHROM,record.POS))
+        return None
+
+    normal = record.genotype('NORMAL')
+    tumour = record.genotype('TUMOUR')
+
+    tumor_reads = {
+      'forward': {
+        'A': int(tumour['FAZ']),
+        'C': int(tumour['FCZ']),
+        'G': int(tumour['FGZ']),
+        'T': int(tumour['FTZ']),
+      },
+      'reverse': {
+        'A': int(tumour['RAZ']),
+        'C': int(tumour['RCZ']),
+        'G': int(tumour['RGZ']),
+        'T': int(tumour['RTZ']),
+      },
+    }
+
+    ref_reads = tumor_reads['forward'][reference_nt] + tumor_reads['reverse'][reference_nt]
+    variant_reads = tumor_reads['forward'][variant_nt] + tumor_reads['reverse'][variant_nt]
+    return ref_reads, variant_reads
+
+def check_snv_samples(samples, snv_format, sample=''):
+    '''
+    check the VCF's samples for the given format, returns the sample to
+    take counts from
+    '''
+    if snv_format == 'sanger':
+        #code adapted from: https://github.com/morrislab/phylowgs/blob/master/parser/create_phylowgs_inputs.py
+        if samples[0].lower()!='normal' or (samples[1].lower()!='tumour' and samples[1].lower()!='tumor'):
+            raise Exception('VCF SNV file is of invalid format. Expected "NORMAL" and "TUMOUR" samples.')
+    elif snv_format == 'mutect':
+        if len(samples)==0:
+            raise Exception('No samples found in VCF!')
+        elif not np.any(np.array(samples)==sample):
+            print('Warning, sample not found in VCF, selecting first sample')
+            sample = samples[0]
+    elif snv_format == 'multisnv':
+        if sample not in samples:
+            raise Exception('VCF SNV file is of invalid format: sample %s not present in VCF samples.' % sample)
+    elif snv_format != 'consensus':
+        raise ValueError('SNV VCF format %s not recognised.' % snv_format)
+    return sample
+
+def get_snv_parser(snv_format, sample=''):
+    '''
+    returns the function extracting (ref_reads, variant_reads) from a
+    record (None to skip), sample must already be checked
+    '''
+    if snv_format == 'sanger':
+        return parse_snv_sanger
+    elif snv_format == 'mutect':
+        return lambda record: parse_snv_mutect(record, sample)
+    elif snv_format == 'multisnv':
+        return lambda record: parse_snv_multisnv(record, sample)
+    else:
+        return parse_snv_consensus
+
+def batch_snv_records(records, parse_record, batch_size=snv_batch_size):
+    '''
+    parse VCF records in batches of at most batch_size SNVs (structured arrays),
+    keeping only variants with supporting reads
+    '''
+    batch = []
+    for record in records:
+        counts = parse_record(record)
+        if counts is None:
+            continue
+        ref_reads, variant_reads = counts
+        if variant_reads != 0:
+            batch.append((record.CHROM, record.POS, '', ref_reads, variant_reads))
+        if len(batch) == batch_size:
+            yield np.array(batch, dtype=snv_dtype)
+            batch = []
+    if len(batch) > 0:
+        yield np.array(batch, dtype=snv_dtype)
+
+def iter_snv_arrays(snvs, snv_format, sample='', batch_size=snv_batch_size):
     vcf_reader = vcf.Reader(filename=snvs)
-    snv_dtype = [('chrom','S50'),('pos',int),('gtype','S50'),('ref',float),('var',float)]
-    snv_df = np.empty([0,5],dtype=snv_dtype)
+    sample = check_snv_samples(vcf_reader.samples, snv_format, sample)
+    return batch_snv_records(vcf_reader, get_snv_parser(snv_format, sample), batch_size)
 
-    for record in vcf_reader:
-        try:
-            ref_reads, variant_reads = record.INFO['t_ref_count'], record.INFO['t_alt_count']
-            total_reads = ref_reads + variant_reads
-            if variant_reads != 0:
-                tmp = np.array((record.CHROM, record.POS, '', ref_reads, variant_reads), dtype=snv_dtype)
-                snv_df = np.append(snv_df,tmp)
-        except KeyError:
-            print('WARNING: missing count field(s) in record %s:%d' % (record.CHROM, record.POS))
+def iter_snv_batches(snvs, snv_format, sample='', batch_size=snv_batch_size):
+    '''
+    stream an SNV VCF as DataFrames of at most batch_size SNVs
+    '''
+    for snv_array in iter_snv_arrays(snvs, snv_format, sample, batch_size):
+        yield pd.DataFrame(snv_array)
 
-    return pd.DataFrame(snv_df)
+def concat_snv_arrays(snv_arrays):
+    snv_arrays = [arr for arr in snv_arrays if len(arr) > 0]
+    if len(snv_arrays) == 0:
+        return np.empty(0, dtype=snv_dtype)
+    return np.concatenate(snv_arrays)
 
-def load_snvs_mutect(snvs,sample):
+def load_snv_contig(job):
+    '''
+    parse the SNVs of one contig of a tabix-indexed VCF (pool worker)
+    '''
+    snvs, snv_format, sample, contig = job
     vcf_reader = vcf.Reader(filename=snvs)
-    snv_dtype = [('chrom','S50'),('pos',int),('gtype','S50'),('ref',float),('var',float)]
-    snv_df = np.empty([0,5],dtype=snv_dtype)
-
-    samples = vcf_reader.samples
-    if len(samples)==0:
-        raise Exception('No samples found in VCF!')
-    elif not np.any(np.array(samples)==sample):
-        print('Warning, sample not found in VCF, selecting first sample')
-        sample = samples[0]
-
-    for record in vcf_reader:
-        if record.FILTER is not None:
-            if len(record.FILTER)>0:
-                continue
-        try:
-            if record.genotype('normal')['AD'][1]>0:
-                print('Removing variant %s:%d as it contains reads in the germline.' % (record.CHROM, record.POS))
-                continue
-        except KeyError:
-            pass
-        ad = record.genotype(sample)['AD']
-        ref_reads, variant_reads = float(ad[0]), float(ad[1])
-        total_reads = ref_reads + variant_reads
-        if variant_reads!=0:
-            tmp = np.array((record.CHROM,record.POS,'',ref_reads,variant_reads),dtype=snv_dtype)
-            snv_df = np.append(snv_df,tmp)
-
-    return pd.DataFrame(snv_df)
+    records = vcf_reader.fetch(contig)
+    return concat_snv_arrays(batch_snv_records(records, get_snv_parser(snv_format, sample)))
 
-def load_snvs_sanger(snvs):
+def load_snv_vcf_parallel(snvs, snv_format, sample, threads):
+    '''
+    load a bgzipped, tabix-indexed SNV VCF one contig per task over a
+    pool of processes, results are returned in file order (the order of
+    the contigs in the index), as when loading in a single process
+    '''
     vcf_reader = vcf.Reader(filename=snvs)
-    snv_dtype = [('chrom','S50'),('pos',int),('gtype','S50'),('ref',float),('var',float)]
-    snv_df = np.empty([0,5],dtype=snv_dtype)
-
-    #code adapted from: https://github.com/morrislab/phylowgs/blob/master/parser/create_phylowgs_inputs.py
-    samples = vcf_reader.samples
-    if samples[0].lower()!='normal' or (samples[1].lower()!='tumour' and samples[1].lower()!='tumor'):
-        raise Exception('VCF SNV file is of invalid format. Expected "NORMAL" and "TUMOUR" samples.')
-
-    for record in vcf_reader:
-        # get most likely genotypes
-        genotypes = []
-        broad_syn = False
-        if 'TG' in record.INFO and 'SG' in record.INFO:
-          genotypes = [record.INFO['TG'], record.INFO['SG']]
-        else:
-          genotypes = [x for x in record.INFO.keys() if "/" in x ]
-          broad_syn = True
+    sample = check_snv_samples(vcf_reader.samples, snv_format, sample)
 
-        if len(genotypes)==0:
-            print('Warning: no valid genotypes for variant %s:%d; skipping.'%(record.CHROM,record.POS))
-            continue
-        if record.FILTER is not None:
-            if len(record.FILTER)>0:
-                continue
-
-        variant_set = set()
-        reference_nt = ''
-        while len(variant_set) == 0:
-            if len(genotypes) == 0:
-                break
-                #raise Exception('No more genotypes to find variant_nt in for %s' % variant)
-            if broad_syn:
-                gt = [x for x in genotypes if x.split("/")[0] != x.split("/")[1]][0]
-                tumour_gt, normal_gt = gt.split('/')
-            else:
-                gt = genotypes.pop(0)
-                normal_gt, tumour_gt = gt.split('/')
-            if normal_gt[0] == normal_gt[1]:
-                reference_nt = normal_gt[0]
-                variant_set = set(tumour_gt) - set(reference_nt)
-        variant_nt = variant_set.pop() if len(variant_set)!=0 else ''
-
-        if variant_nt=='':
-            print('Warning: no valid genotypes for variant %s:%d; skipping.'%(record.CHROM,record.POS))
-            continue
+    with pysam.TabixFile(snvs) as tbx:
+        contigs = list(tbx.contigs)
+    jobs = [(snvs, snv_format, sample, contig) for contig in contigs]
+    if len(jobs) == 0:
+        return np.empty(0, dtype=snv_dtype)
+
+    pool = multiprocessing.Pool(min(threads, len(jobs)))
+    try:
+        snv_arrays = pool.map(load_snv_contig, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return concat_snv_arrays(snv_arrays)
+
+def is_tabix_indexed(vcf_file):
+    return vcf_file.endswith('.gz') and os.path.exists(vcf_file + '.tbi')
+
+def load_snv_vcf(snvs, snv_format, sample='', threads=1):
+    if threads > 1:
+        if is_tabix_indexed(snvs):
+            return pd.DataFrame(load_snv_vcf_parallel(snvs, snv_format, sample, threads))
+        print('SNV VCF is not bgzipped and tabix-indexed, loading SNVs in a single process')
+    return pd.DataFrame(concat_snv_arrays(iter_snv_arrays(snvs, snv_format, sample)))
+
+def load_snvs(snvs, snv_format, sample='', threads=1):
+    '''
+    load SNVs of any supported input format, VCFs are loaded per-contig
+    in parallel if threads > 1 and the VCF is tabix-indexed
+    '''
+    if snv_format == 'mutect_callstats':
+        return load_snvs_mutect_callstats(snvs)
+    return load_snv_vcf(snvs, snv_format, sample, threads)
+
+def load_snvs_multisnv(snvs, sample):
+    return load_snv_vcf(snvs, 'multisnv', sample)
+
+def load_snvs_consensus(snvs):
+    return load_snv_vcf(snvs, 'consensus')
+
+def load_snvs_mutect(snvs,sample):
+    return load_snv_vcf(snvs, 'mutect', sample)
 
-        normal = record.genotype('NORMAL')
-        tumour = record.genotype('TUMOUR')
-
-        tumor_reads = {
-          'forward': {
-            'A': int(tumour['FAZ']),
-            'C': int(tumour['FCZ']),
-            'G': int(tumour['FGZ']),
-            'T': int(tumour['FTZ']),
-          },
-          'reverse': {
-            'A': int(tumour['RAZ']),
-            'C': int(tumour['RCZ']),
-            'G': int(tumour['RGZ']),
-            'T': int(tumour['RTZ']),
-          },
-        }
-
-        ref_reads = tumor_reads['forward'][reference_nt] + tumor_reads['reverse'][reference_nt]
-        variant_reads = tumor_reads['forward'][variant_nt] + tumor_reads['reverse'][variant_nt]
-        total_reads = ref_reads + variant_reads
-
-        if variant_reads!=0:
-            tmp = np.array((record.CHROM,record.POS,'',ref_reads,variant_reads),dtype=snv_dtype)
-            snv_df = np.append(snv_df,tmp)
-
-    #import matplotlib.pyplot as plt
-    #fig, axes = plt.subplots(1, 1, sharex=False, sharey=False)
-    #dep = snv_df['ref']+snv_df['var']
-    #sup = map(float,snv_df['var'])
-    #axes.hist(sup/dep);plt.savefig('/home/mcmero/Desktop/test')
-
-    return pd.DataFrame(snv_df)
+def load_snvs_sanger(snvs):
+    return load_snv_vcf(snvs, 'sanger')
 
 def string_to_bool(v):
   return v.lower() in ("yes", "true", "t", "1")
@@ -382,10 +459,30 @@ def get_params_cluster_step(sample, cfg, out, pp_file, param_file, XX, XY):
         merge_iter = int(round(n_iter / 4))
         merge_burn = int(round(burn / 4))
 
-    if burn == 0 and use_map:
+    try:
+        phi_grid        = int(Config.get('ClusterParameters', 'phi_grid'))
+    except ConfigParser.NoOptionError:
+        phi_grid = 0
+
+    if phi_grid == 1 or phi_grid < 0:
+        raise ValueError('phi_grid must be 0 (exact likelihood) or at least 2 points')
+
+    try:
+        engine          = Config.get('ClusterParameters', 'engine').lower()
+    except ConfigParser.NoOptionError:
+        engine = 'mcmc'
+
+    if engine not in ('mcmc', 'gibbs', 'vi'):
+        raise ValueError('engine must be mcmc, gibbs or vi')
+
+    if burn == 0 and use_map and engine != 'vi':
         print('No burn-in period specified, setting MAP to false.')
         use_map = False
 
+    if engine == 'vi' and not use_map:
+        print('Fit metrics are always computed by the vi engine, setting MAP to true.')
+        use_map = True
+
     if XX:
         male = False
     if XY:
@@ -402,7 +499,8 @@ def get_params_cluster_step(sample, cfg, out, pp_file, param_file, XX, XY):
                        'clus_limit': clus_limit, 'subclone_diff': subclone_diff, 'cocluster': cocluster ,
                        'clonal_cnv_pval': cnv_pval, 'adjust_phis': adjust_phis, 'sv_to_sim': sv_to_sim,
                        'threads': threads, 'ccf_reject': ccf_reject, 'nclus_init': nclus_init,
-                       'restrict_cnss': restrict_cnss, 'merge_iter': merge_iter, 'merge_burn': merge_burn }
+                       'restrict_cnss': restrict_cnss, 'merge_iter': merge_iter, 'merge_burn': merge_burn,
+                       'phi_grid': phi_grid, 'engine': engine }
     output_params  = { 'plot': plot, 'smc_het': smc_het, 'cluster_penalty': cluster_penalty, 'fit_metric': fit_metric }
 
     return sample_params, cluster_params, output_params
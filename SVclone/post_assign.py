@@ -15,6 +15,9 @@ from . import run_filter as filt
 from . import dtypes
 from . import write_output
 from SVprocess import svp_load_data as svp_load
+from .input_cache import get_input_cache
+from .genotypes import parse_var_gtypes, take_gtypes, concat_var_gtypes, repeat_gtype
+from .cn_states import from_combos, concat_cn_states
 
 def get_var_ids(var_df, snvs):
     var_ids = np.array([])
@@ -29,23 +32,30 @@ def get_var_ids(var_df, snvs):
 
     return(var_ids)
 
-def get_var_to_assign(var_df, var_filt_df, snvs = False):
+def get_var_to_assign(var_df, var_gts, var_filt_df, snvs = False):
+    '''
+    variants (and their genotype tables) with read support and copy-number
+    states that are not among the filtered (clustered) variants
+    '''
     vartype = 'SNVs' if snvs else 'SVs'
 
     n = int(len(var_df))
     if snvs:
         var_df['support'] = map(float, var_df['var'].values)
-    var_df = var_df[var_df.support.values > 0]
+    has_support = var_df.support.values > 0
+    var_df, var_gts = var_df[has_support], take_gtypes(var_gts, has_support)
     n_filt_out = int(n - len(var_df))
     if n_filt_out > 0:
         print('Filtered out %d %s with no read support' % (n_filt_out, vartype))
 
     if not snvs:
-        var_df['gtype1'] = np.array(map(filt.remove_zero_copynumbers, var_df.gtype1.values))
-        var_df['gtype2'] = np.array(map(filt.remove_zero_copynumbers, var_df.gtype2.values))
+        gts1, gts2 = var_gts
+        var_df['gtype1'], gts1 = filt.remove_zero_copynumbers(var_df.gtype1.values, gts1)
+        var_df['gtype2'], gts2 = filt.remove_zero_copynumbers(var_df.gtype2.values, gts2)
 
         n = int(len(var_df))
-        var_df = var_df[np.logical_or(var_df.gtype1.values!='', var_df.gtype2.values!='')]
+        has_cn = np.invert(np.logical_and(gts1.missing, gts2.missing))
+        var_df, var_gts = var_df[has_cn], [gts1[has_cn], gts2[has_cn]]
         n_filt_out = int(n - len(var_df))
         if n_filt_out > 0:
             print('Filtered out %d %s with missing copy-number states' % (int(n - len(var_df)), vartype))
@@ -55,29 +65,38 @@ def get_var_to_assign(var_df, var_filt_df, snvs = False):
         ids = get_var_ids(var_df, snvs)
         filt_ids = get_var_ids(var_filt_df, snvs)
 
-        var_to_assign = var_to_assign[[fid not in filt_ids for fid in ids]]
+        not_filt = [fid not in filt_ids for fid in ids]
+        var_to_assign = var_to_assign[not_filt]
+        var_gts = take_gtypes(var_gts, np.array(not_filt, dtype=bool))
 
-    return var_to_assign
+    return var_to_assign, var_gts
 
-def get_ll_probs(s, d, n, cn, purity, scs):
-    lls = np.array([np.max(cluster.calc_lik(cn, s, d, scs.phi.values[0], purity, n)[1])])
-    for j in range(1, len(scs)):
-        ll = cluster.calc_lik(cn, s, d, scs.phi.values[j], purity, n)[1]
-        lls = np.append(lls, np.max(ll))
+def get_cluster_lls(inputs, scs):
+    '''
+    log-likelihood of the most likely copy-number state of
+    each variant under each cluster's phi (variants x clusters)
+    '''
+    return np.array([inputs.get_max_lls(phi) for phi in scs.phi.values]).T
+
+def get_ll_probs(lls):
+    '''
+    cluster probabilities of a variant from its cluster log-likelihoods
+    '''
     if len(lls) > 1:
         lls_conv = [math.e ** ll for ll in lls]
         ll_probs = [float(lc) / sum(lls_conv) for lc in lls_conv]
     else:
         ll_probs = [1.]
 
-    return lls, ll_probs
+    return ll_probs
 
-def fix_variant_number_discrepancy(var_df, var_filt_df, filt_ids, ccert_ids, ccert, snvs):
+def fix_variant_number_discrepancy(var_df, var_gts, var_filt_df, filt_gts, filt_ids, ccert_ids, ccert, snvs):
     n_to_assign = len(var_df)
     var_df = pd.concat([var_df, var_filt_df])
+    var_gts = concat_var_gtypes([var_gts, filt_gts])
 
     var_in_ccert = np.array([var_id in ccert_ids for var_id in filt_ids])
-    var_filt_df = var_filt_df[var_in_ccert]
+    var_filt_df, filt_gts = var_filt_df[var_in_ccert], take_gtypes(filt_gts, var_in_ccert)
 
     filt_ids = get_var_ids(var_filt_df, snvs)
     ccert_in_df = np.array([cc_id in filt_ids for cc_id in ccert_ids])
@@ -87,8 +106,8 @@ def fix_variant_number_discrepancy(var_df, var_filt_df, filt_ids, ccert_ids, cce
                                  np.invert(var_in_ccert) ])
 
     var_df.index = range(len(var_df))
-    var_df = var_df[to_assign]
-    return(var_df, var_filt_df, ccert)
+    var_df, var_gts = var_df[to_assign], take_gtypes(var_gts, to_assign)
+    return(var_df, var_gts, var_filt_df, filt_gts, ccert)
 
 
 def filter_clusters(scs, clus_th):
@@ -106,28 +125,27 @@ def filter_clusters(scs, clus_th):
 
     return(scs, orig_scs)
 
-def get_sv_ll_probs(sup, dep, norm_cn, cns, purity, scs, af):
-
-    cns1, cns2 = cns[0], cns[1]
-    dep1, dep2 = ((dep[0] - sup) * af) + sup, ((dep[1] - sup) * af) + sup
-
-    if len(cns1) > 0 and len(cns2) > 0:
-        lls0, ll_probs0 = get_ll_probs(sup, dep1, norm_cn, cns1, purity, scs)
-        lls1, ll_probs1 = get_ll_probs(sup, dep2, norm_cn, cns2, purity, scs)
-
-        max_lls = np.array([max(lls0), max(lls1)])
-        side = np.where(max_lls == max(max_lls))[0][0]
-
-        lls = lls0 if side == 0 else lls1
-        ll_probs = ll_probs0 if side == 0 else ll_probs1
-    elif len(cns1) > 0:
-        lls, ll_probs = get_ll_probs(sup, dep1, norm_cn, cns1, purity, scs)
-        side = 0
-    else:
-        lls, ll_probs = get_ll_probs(sup, dep2, norm_cn, cns2, purity, scs)
-        side = 1
-
-    return(lls, ll_probs, side)
+def get_sv_cluster_lls(sup, dep_sides, combos, norm_cn, purity, scs, af):
+    '''
+    cluster log-likelihoods of each SV (as get_cluster_lls) from the
+    break-end whose most likely cluster fits best, and the selected sides
+    '''
+    af = np.array(af, dtype=float)
+    side_lls, has_cns = [], []
+    for side in [0, 1]:
+        dep = np.array([ds[side] for ds in dep_sides], dtype=float)
+        dep = ((dep - sup) * af) + sup
+        cn_states = from_combos([cn[side] for cn in combos])
+        inputs = cluster.ModelInputs(cn_states, sup, dep, purity, norm_cn)
+        side_lls.append(get_cluster_lls(inputs, scs))
+        has_cns.append(cn_states.lengths > 0)
+
+    lls0, lls1 = side_lls
+    best1 = np.max(lls1, axis=1) > np.max(lls0, axis=1)
+    sides = np.where(np.logical_and(has_cns[0], has_cns[1]), best1, np.invert(has_cns[0])).astype(int)
+    lls = np.where(sides[:, np.newaxis] == 0, lls0, lls1)
+
+    return(lls, sides)
 
 def assign_snvs(scs, Nvar, sup, dep, norm_cn, cn_states, purity):
     '''
@@ -137,11 +155,10 @@ def assign_snvs(scs, Nvar, sup, dep, norm_cn, cn_states, purity):
     clus_probs = np.array([])
 
     if len(scs) > 1 and Nvar > 0:
-        for i in range(Nvar):
-            lls, ll_probs = get_ll_probs(sup[i], dep[i], norm_cn[i], cn_states[i], purity, scs)
-            clus_probs = np.concatenate([clus_probs, [ll_probs]], axis=0) if len(clus_probs)>0 else np.array([ll_probs])
-            best_clus = np.where(np.max(lls)==lls)[0][0]
-            best_clus_list = np.append(best_clus_list, [best_clus])
+        inputs = cluster.ModelInputs(cn_states, sup, dep, purity, norm_cn)
+        lls = get_cluster_lls(inputs, scs)
+        clus_probs = np.array([get_ll_probs(ll) for ll in lls])
+        best_clus_list = np.argmax(lls, axis=1)
     elif Nvar > 0:
         best_clus_list = [0] * Nvar
         clus_probs     = np.array([[1.]] * Nvar)
@@ -156,17 +173,9 @@ def assign_svs(scs, sup, dep, combos, norm_cn, purity, af):
     Assign post-assign SVs to most liklely clusters
     '''
     Nvar = len(sup)
-    best_clus_list = np.array([])
-    clus_probs = np.array([])
-
-    sides = np.empty(0, dtype=int)
-    for i in range(Nvar):
-        lls, ll_probs, side = get_sv_ll_probs(sup[i], dep[i], norm_cn[i], combos[i], purity, scs, af[i])
-        sides = np.append(sides, side)
-
-        clus_probs = np.concatenate([clus_probs, [ll_probs]], axis=0) if len(clus_probs) > 0 else np.array([ll_probs])
-        best_clus = np.where(np.max(lls)==lls)[0][0]
-        best_clus_list = np.append(best_clus_list, [best_clus])
+    lls, sides = get_sv_cluster_lls(sup, dep, combos, norm_cn, purity, scs, af)
+    clus_probs = np.array([get_ll_probs(ll) for ll in lls])
+    best_clus_list = np.argmax(lls, axis=1)
 
     best_clus_list = np.array(map(int, best_clus_list))
     phis = scs.phi.values[best_clus_list] if Nvar > 0 else None
@@ -194,6 +203,14 @@ def reclassify_vars(scs, orig_scs, probs, ccert, fsup, fdep, fNvar, fcn_states,
 
     sides = np.empty(0, dtype=int)
     if len(which_reclass) > 0:
+        # cluster phis are fixed, so the likelihoods are computed once
+        if len(af) > 0:
+            lls_all, sides_all = get_sv_cluster_lls(fsup, fdep, fcn_states, fnorm_cn, purity, scs, af)
+            sides = sides_all[which_reclass]
+        else:
+            inputs = cluster.ModelInputs(fcn_states, fsup, fdep, purity, fnorm_cn)
+            lls_all = get_cluster_lls(inputs, scs)
+
         if reclassify_all:
             for idx in scs.index.values:
                 scs = scs.set_value(idx, 'size', 0)
@@ -203,11 +220,8 @@ def reclassify_vars(scs, orig_scs, probs, ccert, fsup, fdep, fNvar, fcn_states,
 
         for i in which_reclass:
             # find most likely cluster for variant
-            if len(af) > 0:
-                lls, ll_probs, side = get_sv_ll_probs(fsup[i], fdep[i], fnorm_cn[i], fcn_states[i], purity, scs, af[i])
-                sides = np.append(sides, side)
-            else:
-                lls, ll_probs = get_ll_probs(fsup[i], fdep[i], fnorm_cn[i], fcn_states[i], purity, scs)
+            lls = lls_all[i]
+            ll_probs = get_ll_probs(lls)
 
             # pos refers to index position, while array_idx is the array's index (this may differ)
             best_clus_pos = np.where(np.max(lls)==lls)[0][0]
@@ -282,7 +296,7 @@ def collate_variant_output(var_df, var_filt_df, Nvar, ccert, probs, clus_probs,
 
     return(df, ccert, probs)
 
-def get_sv_dual_end_data(sv_df, sup, cdefs, purity, ploidy, cparams, adjusted):
+def get_sv_dual_end_data(sv_df, sv_gts, sup, cdefs, purity, ploidy, cparams, adjusted):
     '''
     Get required SV info for both break-ends for SV cluster re-assignment
     '''
@@ -294,7 +308,8 @@ def get_sv_dual_end_data(sv_df, sup, cdefs, purity, ploidy, cparams, adjusted):
     dep_side0 = sv_df.norm1.map(float).values + sup
     dep_side1 = sv_df.norm2.map(float).values + sup
     dep_sides  = zip(dep_side0, dep_side1)
-    combos = sv_df.apply(cluster.get_sv_allele_combos, axis=1, args=(cparams,)).values
+    gts1, gts2 = sv_gts
+    combos = cluster.get_sv_allele_combos(gts1, gts2, cparams)
 
     classes = sv_df.classification.values
     dna_gain_class = cdefs['dna_gain_class']
@@ -312,8 +327,7 @@ def update_sv_df_sides(sv_df, sides, sup, dep_sides, combos, af):
     dep = np.array([ds[0] if side == 0 else ds[1] for ds, side in zip(dep_sides, sides)])
     norm = (dep - sup) * af
     dep  = norm + sup
-    cn_states = [cn[side] for cn, side in zip(combos, sides)]
-    cn_states = pd.DataFrame([[sv] for sv in cn_states])[0].values
+    cn_states = from_combos([cn[side] for cn, side in zip(combos, sides)])
 
     sv_df.preferred_side = sides
     sv_df.adjusted_norm  = norm
@@ -322,7 +336,7 @@ def update_sv_df_sides(sv_df, sides, sup, dep_sides, combos, af):
 
     return sv_df, dep, cn_states
 
-def post_assign_vars(var_df, var_filt_df, rundir, sample, sparams, cparams, clus_th, rc_all, cdefs, snvs = False):
+def post_assign_vars(var_df, var_gts, var_filt_df, filt_gts, rundir, sample, sparams, cparams, clus_th, rc_all, cdefs, snvs = False):
     pa_outdir = '%s_post_assign/' % rundir
     if not os.path.exists(pa_outdir):
         os.makedirs(pa_outdir)
@@ -355,7 +369,8 @@ def post_assign_vars(var_df, var_filt_df, rundir, sample, sparams, cparams, clus
 
     if not (np.all(vid_in_ccert) and np.all(ccert_in_vid)):
         # discrepancy due to subsampling
-        var_df, var_filt_df, ccert = fix_variant_number_discrepancy(var_df, var_filt_df, filt_ids, ccert_ids, ccert, snvs)
+        var_df, var_gts, var_filt_df, filt_gts, ccert = \
+                fix_variant_number_discrepancy(var_df, var_gts, var_filt_df, filt_gts, filt_ids, ccert_ids, ccert, snvs)
         filt_ids          = get_var_ids(var_filt_df, snvs)
         ccert_ids         = get_var_ids(ccert, snvs)
         var_filt_df.index = range(len(var_filt_df))
@@ -372,24 +387,26 @@ def post_assign_vars(var_df, var_filt_df, rundir, sample, sparams, cparams, clus
     matched_order = np.array([np.where(np.array(filt_ids)==x)[0][0] for x in ccert_ids])
     var_filt_df.index = range(len(var_filt_df))
     var_filt_df = var_filt_df.loc[matched_order]
+    filt_gts = take_gtypes(filt_gts, matched_order)
 
     if snvs:
         if len(var_df) > 0:
-            sup, dep, cn_states, Nvar, norm_cn = load_data.get_snv_vals(var_df, male, cparams)
+            sup, dep, cn_states, Nvar, norm_cn = load_data.get_snv_vals(var_df, var_gts, male, cparams)
         if len(var_filt_df) > 0:
-            fsup, fdep, fcn_states, fNvar, fnorm_cn = load_data.get_snv_vals(var_filt_df, male, cparams)
+            fsup, fdep, fcn_states, fNvar, fnorm_cn = load_data.get_snv_vals(var_filt_df, filt_gts, male, cparams)
     else:
         if len(var_df) > 0:
-            sup, dep, cn_states, Nvar, norm_cn = load_data.get_sv_vals(var_df, adjusted, male, cparams)
+            sup, dep, cn_states, Nvar, norm_cn = load_data.get_sv_vals(var_df, var_gts, adjusted, male, cparams)
         if len(var_filt_df) > 0:
-            fsup, fdep, fcn_states, fNvar, fnorm_cn = load_data.get_sv_vals(var_filt_df, adjusted, male, cparams)
+            fsup, fdep, fcn_states, fNvar, fnorm_cn = load_data.get_sv_vals(var_filt_df, filt_gts, adjusted,
+                                                                            male, cparams)
 
     if Nvar:
-        no_cn_state = np.array([len(cn)==0 for cn in cn_states])
+        no_cn_state = cn_states.lengths == 0
         if np.any(no_cn_state):
             keep = np.invert(no_cn_state)
             sup, dep, norm_cn, cn_states = sup[keep], dep[keep], np.array(norm_cn)[keep], cn_states[keep]
-            var_df = var_df[keep]
+            var_df, var_gts = var_df[keep], take_gtypes(var_gts, keep)
             Nvar = Nvar - sum(no_cn_state)
 
     best_clus_list = np.empty(0)
@@ -398,13 +415,14 @@ def post_assign_vars(var_df, var_filt_df, rundir, sample, sparams, cparams, clus
         if snvs:
             best_clus_list, clus_probs, phis = assign_snvs(scs, Nvar, sup, dep, norm_cn, cn_states, purity)
         else:
-            dep_sides, combos, af = get_sv_dual_end_data(var_df, sup, cdefs, purity, ploidy, cparams, adjusted)
+            dep_sides, combos, af = get_sv_dual_end_data(var_df, var_gts, sup, cdefs, purity, ploidy, cparams, adjusted)
             best_clus_list, clus_probs, phis, sides = assign_svs(scs, sup, dep_sides, combos, norm_cn, purity, af)
             var_df, dep, cn_states = update_sv_df_sides(var_df, sides, sup, dep_sides, combos, af)
 
     if (len(scs) != len(orig_scs) and len(var_filt_df) > 0) or (rc_all and len(var_filt_df) > 0):
         if not snvs:
-            fdep_sides, combos, af = get_sv_dual_end_data(var_filt_df, fsup, cdefs, purity, ploidy, cparams, adjusted)
+            fdep_sides, combos, af = get_sv_dual_end_data(var_filt_df, filt_gts, fsup, cdefs, purity, ploidy,
+                                                          cparams, adjusted)
             scs, probs, ccert, sides = reclassify_vars(scs, orig_scs, probs, ccert, fsup, fdep_sides,
                                                        fNvar, combos, fnorm_cn, purity, rc_all, af)
             var_filt_df, fdep, fcn_states = update_sv_df_sides(var_filt_df, sides, fsup, fdep_sides, combos, af)
@@ -427,13 +445,14 @@ def post_assign_vars(var_df, var_filt_df, rundir, sample, sparams, cparams, clus
     if Nvar > 0:
         df, ccert, probs = collate_variant_output(var_df, var_filt_df, Nvar, ccert, probs, \
                                                   clus_probs, phis, scs, best_clus_list, snvs)
+        gts = concat_var_gtypes([filt_gts, var_gts])
         sup = np.append(fsup, sup) if len(var_filt_df) > 0 else sup
         dep = np.append(fdep, dep) if len(var_filt_df) > 0 else dep
         norm_cn = np.append(fnorm_cn, norm_cn) if len(var_filt_df) > 0 else norm
-        cn_states = np.append(fcn_states, cn_states) if len(var_filt_df) > 0 else cn_states
+        cn_states = concat_cn_states([fcn_states, cn_states]) if len(var_filt_df) > 0 else cn_states
     else:
         sup, dep, norm_cn, cn_states = fsup, fdep, fnorm_cn, fcn_states
-        df = var_filt_df
+        df, gts = var_filt_df, filt_gts
 
     # retrieve traces for input to write_output func
     z_trace = np.loadtxt('%s/z_trace.txt.gz' % rundir)
@@ -459,7 +478,7 @@ def post_assign_vars(var_df, var_filt_df, rundir, sample, sparams, cparams, clus
     ccert.index = range(len(ccert))
     probs.index = range(len(probs))
     clus_members = np.array([np.where(ccert.most_likely_assignment.values==i)[0] for i in scs.clus_id.values])
-    write_output.write_out_files(df, scs, clus_members, probs, ccert,
+    write_output.write_out_files(df, gts, scs, clus_members, probs, ccert,
                                  pa_outdir, sample, purity, sup, dep,
                                  norm_cn, cn_states, fit, False, cnv_pval, z_phi, are_snvs = snvs)
 
@@ -508,6 +527,8 @@ def run_post_assign(args):
     gml             = args.germline
     XX              = args.XX
     XY              = args.XY
+    threads         = args.threads
+    refresh         = args.refresh_cache
 
     if out == '':
         out = sample
@@ -572,6 +593,9 @@ def run_post_assign(args):
         snv_filt_df = pd.DataFrame(snv_filt_df).fillna('')
         snv_filt_df['support'] = map(float, snv_filt_df['var'].values)
 
+    sv_filt_gts = parse_var_gtypes(sv_filt_df)
+    snv_filt_gts = parse_var_gtypes(snv_filt_df, snvs=True)
+
     if len(sv_filt_df) == 0 and len(snv_filt_df) == 0:
         raise ValueError('Output directory filtered variant files do not exist or are empty!')
 
@@ -584,41 +608,37 @@ def run_post_assign(args):
     purity = sample_params['pi']
     ploidy = sample_params['ploidy']
 
+    cache = get_input_cache(cfg, out, refresh)
+
     sv_df  = pd.DataFrame()
     snv_df = pd.DataFrame()
 
     if snv_file != '':
-        if snv_format == 'sanger':
-            snv_df = load_data.load_snvs_sanger(snv_file)
-        elif snv_format == 'mutect':
-            snv_df = load_data.load_snvs_mutect(snv_file, sample)
-        elif snv_format == 'mutect_callstats':
-            snv_df = load_data.load_snvs_mutect_callstats(snv_file)
-        elif snv_format == 'consensus':
-            snv_df = load_data.load_snvs_consensus(snv_file)
-        elif snv_format == 'multisnv':
-            snv_df = load_data.load_snvs_multisnv(snv_file, sample)
+        snv_df = cache.load(snv_file, 'snvs', (snv_format, sample), \
+                            lambda: load_data.load_snvs(snv_file, snv_format, sample, threads))
 
     if sv_file != "":
-        sv_df = load_data.load_svs(sv_file)
+        sv_df = cache.load(sv_file, 'svs', (), lambda: load_data.load_svs(sv_file))
         if gml!="":
             sv_df = filt.filter_germline(gml, sv_df, rlen, insert, gl_th)
 
     if cnv_file != "":
-        cnv_df = load_data.load_cnvs(cnv_file)
+        cnv_df = cache.load(cnv_file, 'cnvs', (), lambda: load_data.load_cnvs(cnv_file))
 
         if len(sv_df)>0:
             print('Matching copy-numbers for SVs...')
-            sv_df = filt.match_copy_numbers(sv_df,cnv_df,strict_cf,sv_offset)
-            sv_df = filt.match_copy_numbers(sv_df,cnv_df,strict_cf,sv_offset,\
-                    ['chr2','pos2','dir2','classification','pos1'],'gtype2')
+            sv_df, gts1 = filt.match_copy_numbers(sv_df,cnv_df,strict_cf,sv_offset)
+            sv_df, gts2 = filt.match_copy_numbers(sv_df,cnv_df,strict_cf,sv_offset,\
+                          ['chr2','pos2','dir2','classification','pos1'],'gtype2')
+            sv_gts = [gts1, gts2]
 
         if len(snv_df)>0:
             print('Matching copy-numbers for SNVs...')
-            snv_df = filt.match_snv_copy_numbers(snv_df,cnv_df)
+            snv_df, snv_gts = filt.match_snv_copy_numbers(snv_df,cnv_df)
             n = len(snv_df)
-            snv_df['gtype'] = np.array(map(filt.remove_zero_copynumbers, snv_df.gtype.values))
-            snv_df = snv_df[snv_df.gtype != '']
+            snv_df['gtype'], gts = filt.remove_zero_copynumbers(snv_df.gtype.values, snv_gts[0])
+            has_cn = np.invert(gts.missing)
+            snv_df, snv_gts = snv_df[has_cn], [gts[has_cn]]
             print('Filtered out %d SNVs with no copy-numbers' % (n-len(snv_df)))
     else:
         print('No CNV input defined, assuming all loci major/minor allele copy-numbers are ploidy/2')
@@ -630,23 +650,25 @@ def run_post_assign(args):
         if len(sv_df)>0:
             sv_df['gtype1'] = default_gtype
             sv_df['gtype2'] = default_gtype
+            sv_gts = [repeat_gtype(default_gtype, len(sv_df))] * 2
 
         if len(snv_df)>0:
             snv_df['gtype'] = default_gtype
+            snv_gts = [repeat_gtype(default_gtype, len(snv_df))]
 
     copied_dir = False
     pa_outdir = '%s_post_assign/' % rundir
     if len(sv_df) > 0:
-        sv_to_assign = get_var_to_assign(sv_df, sv_filt_df)
-        sv_to_assign = filt.adjust_sv_read_counts(sv_to_assign, purity, ploidy, 0, rlen, Config)
+        sv_to_assign, sv_assign_gts = get_var_to_assign(sv_df, sv_gts, sv_filt_df)
+        sv_to_assign = filt.adjust_sv_read_counts(sv_to_assign, sv_assign_gts, purity, ploidy, 0, rlen, Config)
 
-        post_assign_vars(sv_to_assign, sv_filt_df, rundir, sample, sample_params,
+        post_assign_vars(sv_to_assign, sv_assign_gts, sv_filt_df, sv_filt_gts, rundir, sample, sample_params,
                          cluster_params, clus_th, rc_all, cdefs)
 
     if len(snv_df) > 0:
-        snv_to_assign = get_var_to_assign(snv_df, snv_filt_df, snvs = True)
+        snv_to_assign, snv_assign_gts = get_var_to_assign(snv_df, snv_gts, snv_filt_df, snvs = True)
 
-        post_assign_vars(snv_to_assign, snv_filt_df, rundir, sample, sample_params,
+        post_assign_vars(snv_to_assign, snv_assign_gts, snv_filt_df, snv_filt_gts, rundir, sample, sample_params,
                          cluster_params, clus_th, rc_all, cdefs, snvs = True)
 
     if len(sv_df) > 0 and len(snv_df) > 0:
@@ -14,17 +14,17 @@ import IPython
 import multiprocessing
 import time
 import shutil
-import pymc as pm
 import random
 
 from distutils.dir_util import copy_tree
 from collections import OrderedDict
 from IPython.core.pylabtools import figsize
-from pymc.utils import hpd
 
 from . import cluster
 from . import load_data
 from . import write_output
+from .cn_states import concat_cn_states
+from .genotypes import parse_var_gtypes, take_gtypes
 from SVprocess import svp_load_data as svp_load
 
 import numpy as np
@@ -95,6 +95,20 @@ def plot_clusters(trace, clusters, assignments, sup, dep, clus_out_dir, cparams)
 def index_max(values):
     return max(xrange(len(values)),key=values.__getitem__)
 
+def hpd(trace, alpha):
+    '''
+    highest posterior density (minimum width) interval of a 1-D trace
+    containing 1 - alpha of the samples, as pymc.utils.hpd
+    '''
+    x = np.sort(trace)
+    n_inc = int(np.floor((1.0 - alpha) * len(x)))
+    widths = x[n_inc:] - x[:len(x) - n_inc]
+    if len(widths) == 0:
+        print('Too few elements for interval calculation')
+        return np.array([None, None])
+    min_idx = np.argmin(widths)
+    return np.array([x[min_idx], x[min_idx + n_inc]])
+
 def mean_confidence_interval(phi_trace, alpha):
     n = len(phi_trace)
     m = np.mean(phi_trace)
@@ -239,15 +253,10 @@ def get_adjusted_phis(clus_info, center_trace, cparams):
 
 def get_per_variant_phi(z_trace, phi_trace):
 
-    z_phi = np.array(z_trace.copy(), dtype=float)
-    for i in range(len(z_trace)):
-        for j in range(len(z_trace[0])):
-            clus = int(z_trace[i,j])
-            z_phi[i,j] = phi_trace[i, clus]
-
+    z_phi = phi_trace[np.arange(len(z_trace))[:, np.newaxis], np.asarray(z_trace, dtype=int)]
     return z_phi.mean(axis=0)
 
-def post_process_clusters(mcmc,sv_df,snv_df,clus_out_dir,sup,dep,norm,cn_states,sparams,cparams,output_params,map_):
+def post_process_clusters(mcmc,sv_df,sv_gts,snv_df,snv_gts,clus_out_dir,sup,dep,norm,cn_states,sparams,cparams,output_params,map_,inputs=None):
 
     merge_clusts  = cparams['merge_clusts']
     subclone_diff = cparams['subclone_diff']
@@ -261,11 +270,13 @@ def post_process_clusters(mcmc,sv_df,snv_df,clus_out_dir,sup,dep,norm,cn_states,
     plot          = output_params['plot']
 
     try:
-        sv_df = sv_df[sv_df.classification.values!='SIMU_SV']
+        is_real = sv_df.classification.values!='SIMU_SV'
+        sv_df, sv_gts = sv_df[is_real], take_gtypes(sv_gts, is_real)
     except AttributeError:
         pass
     npoints = len(snv_df) + len(sv_df)
     sup, dep, norm, cn_states = sup[:npoints], dep[:npoints], norm[:npoints], cn_states[:npoints]
+    inputs = cluster.ModelInputs(cn_states, sup, dep, sparams['pi'], norm) if inputs is None else inputs[:npoints]
 
     z_trace = mcmc.trace('z')[:]
 
@@ -366,15 +377,16 @@ def post_process_clusters(mcmc,sv_df,snv_df,clus_out_dir,sup,dep,norm,cn_states,
         nclus = len(clus_info)
         # bic = -2 * map_.lnL + (1 + npoints + nclus * 2) + (nclus * clus_penalty) * np.log(npoints)
         phis = ccert.average_ccf.values
-        cns, pvs = cluster.get_most_likely_cn_states(cn_states, sup, dep, phis, sparams['pi'], cnv_pval, norm)
-        lls = []
-        for si, di, pvi in zip(sup, dep, pvs):
-            lls.append(pm.binomial_like(si, di, pvi))
+        cns, pvs = cluster.get_most_likely_cn_states(inputs, phis, cnv_pval)
+        lls = inputs.calc_var_liks(pvs)
         svc_ic = -2 * np.sum(lls) + (npoints + nclus * clus_penalty) * np.log(npoints)
 
-        run_fit = pd.DataFrame([['svc_IC', svc_ic], ['BIC', map_.BIC], ['AIC', map_.AIC], ['AICc', map_.AICc],
-                                ['lnL', map_.lnL], ['logp', map_.logp], ['logp_at_max', map_.logp_at_max],
-                                ['param_len', map_.len], ['data_len', map_.data_len]])
+        fit_stats = [['svc_IC', svc_ic], ['BIC', map_.BIC], ['AIC', map_.AIC], ['AICc', map_.AICc],
+                     ['lnL', map_.lnL], ['logp', map_.logp], ['logp_at_max', map_.logp_at_max],
+                     ['param_len', map_.len], ['data_len', map_.data_len]]
+        if hasattr(map_, 'ELBO'):
+            fit_stats.append(['ELBO', map_.ELBO])
+        run_fit = pd.DataFrame(fit_stats)
 
     if len(snv_df)>0:
         snv_pos = ['chrom','pos']
@@ -392,9 +404,10 @@ def post_process_clusters(mcmc,sv_df,snv_df,clus_out_dir,sup,dep,norm,cn_states,
         snv_norm      = norm[:len(snv_df)]
         snv_cn_states = cn_states[:len(snv_df)]
         snv_z_phi     = z_phi[:len(snv_df)]
-        write_output.write_out_files(snv_df,clus_info.copy(),snv_members,
+        write_output.write_out_files(snv_df,snv_gts,clus_info.copy(),snv_members,
                 snv_probs,snv_ccert,clus_out_dir,sparams['sample'],sparams['pi'],snv_sup,
-                snv_dep,snv_norm,snv_cn_states,run_fit,smc_het,cnv_pval,snv_z_phi,are_snvs=True)
+                snv_dep,snv_norm,snv_cn_states,run_fit,smc_het,cnv_pval,snv_z_phi,are_snvs=True,
+                inputs=inputs[:len(snv_df)])
 
     sv_probs = pd.DataFrame()
     sv_ccert = pd.DataFrame()
@@ -419,11 +432,12 @@ def post_process_clusters(mcmc,sv_df,snv_df,clus_out_dir,sup,dep,norm,cn_states,
         sv_norm      = norm[lb:lb+len(sv_df)]
         sv_cn_states = cn_states[lb:lb+len(sv_df)]
         sv_z_phi     = z_phi[lb:lb+len(sv_df)]
-        write_output.write_out_files(sv_df,clus_info.copy(),sv_members,
+        write_output.write_out_files(sv_df,sv_gts,clus_info.copy(),sv_members,
                     sv_probs,sv_ccert,clus_out_dir,sparams['sample'],sparams['pi'],sv_sup,
-                    sv_dep,sv_norm,sv_cn_states,run_fit,smc_het,cnv_pval,sv_z_phi)
+                    sv_dep,sv_norm,sv_cn_states,run_fit,smc_het,cnv_pval,sv_z_phi,
+                    inputs=inputs[lb:lb+len(sv_df)])
 
-def cluster_and_process(sv_df, snv_df, run, out_dir, sample_params, cluster_params, output_params, seeds):
+def cluster_and_process(sv_df, sv_gts, snv_df, snv_gts, run, out_dir, sample_params, cluster_params, output_params, seeds):
     male = cluster_params['male']
     np.random.seed(seeds[run])
     print('Random seed for run %d is %d' % (run, seeds[run]))
@@ -435,36 +449,39 @@ def cluster_and_process(sv_df, snv_df, run, out_dir, sample_params, cluster_para
     Nvar, sup, dep, cn_states, norm = None, None, None, None, None
     if cluster_params['cocluster'] and len(sv_df)>0 and len(snv_df)>0:
         # coclustering
-        sup, dep, cn_states, Nvar, norm = load_data.get_snv_vals(snv_df, male, cluster_params)
-        sv_sup, sv_dep, sv_cn_states, sv_Nvar, sv_norm = load_data.get_sv_vals(sv_df,
+        sup, dep, cn_states, Nvar, norm = load_data.get_snv_vals(snv_df, snv_gts, male, cluster_params)
+        sv_sup, sv_dep, sv_cn_states, sv_Nvar, sv_norm = load_data.get_sv_vals(sv_df, sv_gts,
                                                 cluster_params['adjusted'], male, cluster_params)
         sup = np.append(sup, sv_sup)
         dep = np.append(dep, sv_dep)
         norm = np.append(norm, sv_norm)
-        cn_states = pd.concat([pd.DataFrame(cn_states),pd.DataFrame(sv_cn_states)])[0].values
+        cn_states = concat_cn_states([cn_states, sv_cn_states])
         Nvar = Nvar + sv_Nvar
+        inputs = cluster.ModelInputs(cn_states, sup, dep, sample_params['pi'], norm)
         mcmc, map_ = cluster.cluster(sup, dep, cn_states, Nvar, sample_params,
-                                     cluster_params, cluster_params['phi_limit'], norm)
-        post_process_clusters(mcmc, sv_df, snv_df, clus_out_dir, sup, dep, norm, cn_states,
-                          sample_params, cluster_params, output_params, map_)
+                                     cluster_params, cluster_params['phi_limit'], norm, inputs=inputs)
+        post_process_clusters(mcmc, sv_df, sv_gts, snv_df, snv_gts, clus_out_dir, sup, dep, norm, cn_states,
+                          sample_params, cluster_params, output_params, map_, inputs)
 
     elif len(sv_df) > 0 or len(snv_df) > 0:
         # no coclustering
         if len(snv_df) > 0:
             if not os.path.exists('%s/snvs'%clus_out_dir):
                 os.makedirs('%s/snvs'%clus_out_dir)
-            sup, dep, cn_states, Nvar, norm = load_data.get_snv_vals(snv_df, male, cluster_params)
+            sup, dep, cn_states, Nvar, norm = load_data.get_snv_vals(snv_df, snv_gts, male, cluster_params)
+            inputs = cluster.ModelInputs(cn_states, sup, dep, sample_params['pi'], norm)
             mcmc, map_ = cluster.cluster(sup, dep, cn_states, Nvar, sample_params,
-                                         cluster_params, cluster_params['phi_limit'], norm)
-            post_process_clusters(mcmc, pd.DataFrame(), snv_df, clus_out_dir, sup, dep, norm,
-                                  cn_states,sample_params, cluster_params, output_params, map_)
+                                         cluster_params, cluster_params['phi_limit'], norm, inputs=inputs)
+            post_process_clusters(mcmc, pd.DataFrame(), None, snv_df, snv_gts, clus_out_dir, sup, dep, norm,
+                                  cn_states,sample_params, cluster_params, output_params, map_, inputs)
         if len(sv_df) > 0:
-            sup, dep, cn_states, Nvar, norm = load_data.get_sv_vals(sv_df,
+            sup, dep, cn_states, Nvar, norm = load_data.get_sv_vals(sv_df, sv_gts,
                                                 cluster_params['adjusted'], male, cluster_params)
+            inputs = cluster.ModelInputs(cn_states, sup, dep, sample_params['pi'], norm)
             mcmc, map_ = cluster.cluster(sup, dep, cn_states, Nvar, sample_params,
-                                         cluster_params, cluster_params['phi_limit'], norm)
-            post_process_clusters(mcmc, sv_df, pd.DataFrame(), clus_out_dir, sup, dep, norm,
-                                  cn_states, sample_params, cluster_params, output_params, map_)
+                                         cluster_params, cluster_params['phi_limit'], norm, inputs=inputs)
+            post_process_clusters(mcmc, sv_df, sv_gts, pd.DataFrame(), None, clus_out_dir, sup, dep, norm,
+                                  cn_states, sample_params, cluster_params, output_params, map_, inputs)
 
     else:
         raise ValueError("No valid variants to cluster!")
@@ -482,6 +499,9 @@ def pick_best_run(n_runs, out, sample, ccf_reject, cocluster, fit_metric, cluste
         except IndexError:
             raise ValueError('Invalid fit metric specified or fit metric does not exist in run.')
     ics = np.array(ics)
+    if fit_metric == 'ELBO':
+        # higher is better
+        ics = -ics
 
     min_ic = -1
     ic_sort = np.argsort(ics)
@@ -565,19 +585,20 @@ def get_seeds(seeds, n_runs):
 
     return(seeds)
 
-def subsample_snvs(snv_df, subsample, run, ss_seeds, sample, out):
+def subsample_snvs(snv_df, snv_gts, subsample, run, ss_seeds, sample, out):
     print('Subsampling %d SNVs for run%d' % (subsample, run))
     print('Random seed for sampling is %d' % ss_seeds[run])
 
     np.random.seed(ss_seeds[run])
     keep = np.random.choice(snv_df.index, size=subsample, replace=False)
     snv_run_df = snv_df.loc[keep]
+    snv_run_gts = take_gtypes(snv_gts, snv_df.index.get_indexer(keep))
 
     snv_run_df.index = range(len(snv_run_df)) #re-index
     snv_outname = '%s/%s_filtered_snvs_%d_subsampled_run%d.tsv' % (out, sample, subsample, run)
     snv_run_df.to_csv(snv_outname, sep='\t', index=False, na_rep='')
 
-    return(snv_run_df)
+    return snv_run_df, snv_run_gts
 
 def run_clustering(args):
 
@@ -633,6 +654,9 @@ def run_clustering(args):
             for j in range(sv_to_sim):
                 sv_df.loc[len(sv_df)] = simu_sv(sv_df.loc[i])
 
+    sv_gts = parse_var_gtypes(sv_df)
+    snv_gts = parse_var_gtypes(snv_df, snvs=True)
+
     threads = cluster_params['threads']
     use_map = cluster_params['use_map']
     ccf_reject = cluster_params['ccf_reject']
@@ -650,10 +674,11 @@ def run_clustering(args):
 
     if threads == 1:
         for run in range(n_runs):
-            snv_run_df = snv_df
+            snv_run_df, snv_run_gts = snv_df, snv_gts
             if subsample > 0 and subsample < len(snv_df):
-                snv_run_df = subsample_snvs(snv_df, subsample, run, ss_seeds, sample, out)
-            cluster_and_process(sv_df,snv_run_df,run,out,sample_params,cluster_params,output_params,seeds)
+                snv_run_df, snv_run_gts = subsample_snvs(snv_df, snv_gts, subsample, run, ss_seeds, sample, out)
+            cluster_and_process(sv_df,sv_gts,snv_run_df,snv_run_gts,run,out,sample_params,cluster_params,
+                                output_params,seeds)
         # select the best run based on min BIC
         if use_map and n_runs > 1:
             if len(sv_df) > 0:
@@ -668,11 +693,13 @@ def run_clustering(args):
                 run = j + (i * threads)
                 if not run > n_runs-1:
                     print("Thread %d; cluster run: %d" % (j, run))
-                    snv_run_df = snv_df
+                    snv_run_df, snv_run_gts = snv_df, snv_gts
                     if subsample > 0 and subsample < len(snv_df):
-                        snv_run_df = subsample_snvs(snv_df, subsample, run, ss_seeds, sample, out)
-                    process = multiprocessing.Process(target=cluster_and_process,args=(sv_df,snv_run_df,run,out,
-                                                      sample_params,cluster_params,output_params,seeds))
+                        snv_run_df, snv_run_gts = subsample_snvs(snv_df, snv_gts, subsample, run, ss_seeds,
+                                                                 sample, out)
+                    process = multiprocessing.Process(target=cluster_and_process,args=(sv_df,sv_gts,snv_run_df,
+                                                      snv_run_gts,run,out,sample_params,cluster_params,
+                                                      output_params,seeds))
                     jobs.append(process)
             for j in jobs:
                 j.start()
@@ -10,8 +10,11 @@ import re
 import pandas as pd
 import vcf
 
-from operator import methodcaller
 from SVprocess import svp_load_data as svp_load
+from SVprocess.bed_index import load_blacklist_index
+from .input_cache import get_input_cache
+from .germline_index import load_germline_index
+from .genotypes import parse_gtypes, repeat_gtype
 from . import run_clus
 from . import cluster
 from . import load_data
@@ -60,20 +63,8 @@ def run_simple_filter(df,rlen,insert,minsplit,minspan,sizefilter,min_dep,filter_
 
     if len(blist) > 0:
         n = len(df_flt)
-        keep = []
-        for idx,sv in df_flt.iterrows():
-            pos_olap1 = np.logical_and(sv['pos1'] >= blist.f1, sv['pos1'] <= blist.f2)
-            olap1 = np.logical_and(sv['chr1'] == blist.f0, pos_olap1)
-
-            pos_olap2 = np.logical_and(sv['pos2'] >= blist.f1, sv['pos2'] <= blist.f2)
-            olap2 = np.logical_and(sv['chr2'] == blist.f0, pos_olap2)
-
-            olaps = blist[np.logical_or(olap1, olap2)]
-            if len(olaps) > 0:
-                keep.append(False)
-            else:
-                keep.append(True)
-
+        keep = np.logical_not(blist.query_breakpoints(df_flt.chr1.values, df_flt.pos1.values,
+                                                      df_flt.chr2.values, df_flt.pos2.values))
         df_flt = df_flt[keep]
         print('Filtered out %d SVs found in the supplied blacklist' % (n - len(df_flt)))
 
@@ -93,78 +84,51 @@ def run_simple_snv_filter(snv_df, min_dep, blist, filter_chrs, valid_chrs):
         snv_df_flt = snv_df_tmp
 
     if len(blist) > 0:
-        keep = []
-        for idx,snv in snv_df.iterrows():
-            pos_olap = np.logical_and(snv['pos']>=blist.f1, snv['pos']<=blist.f2)
-            olaps = blist[np.logical_and(snv['chrom']==blist.f0, pos_olap)]
-            if len(olaps) > 0:
-                keep.append(False)
-            else:
-                keep.append(True)
+        keep = np.logical_not(blist.query_points(snv_df_flt.chrom.values, snv_df_flt.pos.values))
         snv_df_flt = snv_df_flt[keep]
         print('Filtered out %d SNVs found in the supplied blacklist' % (len(keep)-sum(keep)))
 
     return snv_df_flt
 
-def is_clonal_neutral(gtype):
-    if gtype=='': return False
-    gtype = map(methodcaller('split',','),gtype.split('|'))
-    if len(gtype)==1:
-        gt = map(float,gtype[0])
-        return (gt[0]==1 and gt[1]==1 and gt[2]==1)
-    return False
+def is_clonal_neutral(gts):
+    '''
+    True where the genotype is a single clone of
+    major and minor copy-number 1 (fraction 1)
+    '''
+    return np.logical_and(gts.n_clones == 1, np.all(gts.cns[:, 0] == 1, axis=1))
 
-def exceeds_cn_limit(gtype, max_cn):
+def exceeds_cn_limit(gts, max_cn):
     '''
     returns True if any one major or minor allele
     of any clone exceeds the max_cn threshold
     '''
-    if gtype=='': return False
-    gtype = map(methodcaller('split',','),gtype.split('|'))
-    if len(gtype)==1:
-        gt = map(float, gtype[0])
-        return (gt[0] > max_cn or gt[1] > max_cn)
-    else:
-        return np.any(np.array([float(gt[0]) > max_cn or float(gt[1]) > max_cn for gt in gtype]))
+    return np.logical_and(np.invert(gts.missing), gts.max_allele > max_cn)
 
-def remove_zero_copynumbers(gtype):
+def remove_zero_copynumbers(gtypes, gts):
     '''
-    remove any clonal or subclonal copy-numbers
-    where the total copy-number is zero
+    remove any clonal copy-numbers where the total copy-number
+    is zero (or either allele is negative), returns the genotype
+    strings and table with these set to missing
     '''
-    if gtype=='': return ''
-    gtype_tmp = map(methodcaller('split',','),gtype.split('|'))
-    if len(gtype_tmp)==1:
-        gt = map(float, gtype_tmp[0])
-        if (gt[0]==0 and gt[1]==0) or gt[0] < 0 or gt[1] < 0:
-            gtype = ''
-#    else:
-#        new_gtype = []
-#        for gt in gtype_tmp:
-#            gt = map(float,gt)
-#            if (gt[0]!=0 or gt[1]!=0):
-#                new_gtype.append(gt)
-#        if len(new_gtype) > 0:
-#            new_gtype = [map(str,g) for g in new_gtype]
-#            gtype = '|'.join([','.join(g) for g in new_gtype])
-#        else:
-#            gtype = ''
-    return gtype
-
-def get_weighted_cns(gtypes):
-    gtypes_split = [map(methodcaller("split",","),x) for x in map(methodcaller("split","|"),gtypes)]
-    cn_vals = []
-    for gtype in gtypes_split:
-        cn_val = sum([int(eval(g[0]))+int(eval(g[1]))*float(eval(g[2])) if g!=[''] else 2 for g in gtype])
-        cn_vals.append(cn_val)
-    return np.array(cn_vals)/2
-
-def normalise_wins_by_cn(df_flt):
+    major, minor = gts.major[:, 0], gts.minor[:, 0]
+    invalid = np.logical_or(np.logical_and(major == 0, minor == 0),
+                            np.logical_or(major < 0, minor < 0))
+    invalid = np.logical_and(gts.n_clones == 1, invalid)
+
+    gtypes = np.array(gtypes, dtype=object)
+    gtypes[invalid] = ''
+    return gtypes, gts.clear(invalid)
+
+def get_weighted_cns(gts):
+    cn_vals = np.where(gts.missing, 2, gts.weighted_cn)
+    return cn_vals/2
+
+def normalise_wins_by_cn(df_flt, gts1, gts2):
     win1 = df_flt.win_norm1.map(float).values
     win2 = df_flt.win_norm2.map(float).values
 
-    wcn1 = get_weighted_cns(df_flt.gtype1.values)
-    wcn2 = get_weighted_cns(df_flt.gtype2.values)
+    wcn1 = get_weighted_cns(gts1)
+    wcn2 = get_weighted_cns(gts2)
 
     nonzero1 = np.logical_not(wcn1==0)
     nonzero2 = np.logical_not(wcn2==0)
@@ -173,20 +137,21 @@ def normalise_wins_by_cn(df_flt):
 
     return win1,win2
 
-def filter_outlying_norm_wins(df_flt):
-    win1, win2 = normalise_wins_by_cn(df_flt)
+def filter_outlying_norm_wins(df_flt, gts1, gts2):
+    win1, win2 = normalise_wins_by_cn(df_flt, gts1, gts2)
     ranges1 = get_outlier_ranges(win1)
     ranges2 = get_outlier_ranges(win2)
 
     flt1 = np.logical_and(win1>ranges1[0],win1<ranges1[1])
     flt2 = np.logical_and(win2>ranges2[0],win2<ranges2[1])
-    df_flt = df_flt[np.logical_and(flt1,flt2)]
+    keep = np.logical_and(flt1,flt2)
 
-    return df_flt
+    return df_flt[keep], gts1[keep], gts2[keep]
 
-def run_cnv_filter(df_flt, cnv, ploidy, neutral, filter_outliers, strict_cnv_filt, filter_subclonal, max_cn, are_snvs=False):
+def run_cnv_filter(df_flt, var_gts, cnv, ploidy, neutral, filter_outliers, strict_cnv_filt, filter_subclonal, max_cn, are_snvs=False):
     '''
-    filter based on either CNV neutral, or presence of CNV vals
+    filter based on either CNV neutral, or presence of CNV vals,
+    var_gts are the genotype tables of df_flt, returns both filtered
     '''
     n_df = len(df_flt)
     if len(cnv)>0 and neutral:
@@ -194,9 +159,11 @@ def run_cnv_filter(df_flt, cnv, ploidy, neutral, filter_outliers, strict_cnv_fil
         # major and minor copy-numbers must be 1
         is_neutral = []
         if are_snvs:
+            gts = var_gts[0]
             df_flt = df_flt.fillna('')
-            df_flt = df_flt[df_flt.gtype.values!='']
-            is_neutral = map(is_clonal_neutral,df_flt.gtype.values)
+            has_cn = np.invert(gts.missing)
+            df_flt, gts = df_flt[has_cn], gts[has_cn]
+            is_neutral = is_clonal_neutral(gts)
             df_flt2 = df_flt[is_neutral]
             print('Filtered out %d SNVs that were not copy-number neutral' % (n_df - len(df_flt)))
 
@@ -204,123 +171,172 @@ def run_cnv_filter(df_flt, cnv, ploidy, neutral, filter_outliers, strict_cnv_fil
                 n_df = len(df_flt)
                 depths = df_flt['ref'].values+df_flt['var'].values
                 dep_ranges = get_outlier_ranges(depths)
-                df_flt = df_flt[np.logical_and(depths>dep_ranges[0],depths<dep_ranges[1])]
+                keep = np.logical_and(depths>dep_ranges[0],depths<dep_ranges[1])
+                df_flt, gts = df_flt[keep], gts[keep]
                 print('Filtered out %d SNVs which had outlying depths' % (n_df - len(df_flt)))
+            var_gts = [gts]
         else:
-            gt1_is_neutral = map(is_clonal_neutral,df_flt.gtype1.values)
-            gt2_is_neutral = map(is_clonal_neutral,df_flt.gtype2.values)
-            is_neutral = np.logical_and(gt1_is_neutral,gt2_is_neutral)
-            df_flt = df_flt[is_neutral]
+            gts1, gts2 = var_gts
+            is_neutral = np.logical_and(is_clonal_neutral(gts1), is_clonal_neutral(gts2))
+            df_flt, gts1, gts2 = df_flt[is_neutral], gts1[is_neutral], gts2[is_neutral]
             print('Filtered out %d SVs which were not copy-number neutral' % (n_df - len(df_flt)))
 
             if filter_outliers:
                 n_df = len(df_flt)
-                df_flt = filter_outlying_norm_wins(df_flt)
+                df_flt, gts1, gts2 = filter_outlying_norm_wins(df_flt, gts1, gts2)
                 print('Filtered out %d SVs which had outlying depths' % (n_df - len(df_flt)))
+            var_gts = [gts1, gts2]
     elif len(cnv)>0:
         if are_snvs:
+            gts = var_gts[0]
             df_flt = df_flt.fillna('')
-            df_flt['gtype'] = map(remove_zero_copynumbers,df_flt.gtype.values)
+            df_flt['gtype'], gts = remove_zero_copynumbers(df_flt.gtype.values, gts)
 
-            df_flt = df_flt[df_flt.gtype.values!='']
+            keep = np.invert(gts.missing)
+            df_flt, gts = df_flt[keep], gts[keep]
             print('Filtered out %d SNVs with missing or invalid copy-numbers' % (n_df - len(df_flt)))
 
             if filter_outliers:
                 # weight ranges by copy-numbers
                 depths = df_flt['ref'].values + df_flt['var'].values
-                cns = get_weighted_cns(df_flt.gtype.values)
+                cns = get_weighted_cns(gts)
                 cn_nonzero = np.logical_not(cns==0)
                 depths[cn_nonzero] = (depths[cn_nonzero]/cns[cn_nonzero])
 
                 n_df = len(df_flt)
                 dep_ranges = get_outlier_ranges(depths)
-                df_flt = df_flt[np.logical_and(depths>dep_ranges[0],depths<dep_ranges[1])]
+                keep = np.logical_and(depths>dep_ranges[0],depths<dep_ranges[1])
+                df_flt, gts = df_flt[keep], gts[keep]
                 print('Filtered out %d SNVs which had outlying depths' % (n_df - len(df_flt)))
 
             if filter_subclonal:
                 n_df = len(df_flt)
-                is_clon  = [len(x.split('|'))==1 for x in df_flt.gtype.values]
-                df_flt = df_flt.loc[is_clon]
+                is_clon = np.invert(gts.subclonal)
+                df_flt, gts = df_flt.loc[is_clon], gts[is_clon]
                 print('Filtered out %d SNVs with subclonal CNV states' % (n_df - len(df_flt)))
 
-            gt_exceeds_cn = np.array([exceeds_cn_limit(gtype, max_cn) for gtype in df_flt.gtype.values])
+            gt_exceeds_cn = exceeds_cn_limit(gts, max_cn)
             if np.any(gt_exceeds_cn):
                 n_df = len(df_flt)
-                df_flt = df_flt[np.invert(gt_exceeds_cn)]
+                keep = np.invert(gt_exceeds_cn)
+                df_flt, gts = df_flt[keep], gts[keep]
                 print('Filtered out %d SNVs where major or minor alleles exceed the CN max' % (n_df - len(df_flt)))
+            var_gts = [gts]
 
         else:
-            df_flt['gtype1'].fillna('')
-            df_flt['gtype2'].fillna('')
-            df_flt['gtype1'] = np.array(map(remove_zero_copynumbers,df_flt.gtype1.values))
-            df_flt['gtype2'] = np.array(map(remove_zero_copynumbers,df_flt.gtype2.values))
+            gts1, gts2 = var_gts
+            df_flt['gtype1'], gts1 = remove_zero_copynumbers(df_flt.gtype1.values, gts1)
+            df_flt['gtype2'], gts2 = remove_zero_copynumbers(df_flt.gtype2.values, gts2)
 
             if strict_cnv_filt:
                 # filter out if both CNV states are missing
-                df_flt = df_flt[np.logical_or(df_flt.gtype1!='', df_flt.gtype2!='')]
+                keep = np.invert(np.logical_and(gts1.missing, gts2.missing))
+                df_flt, gts1, gts2 = df_flt[keep], gts1[keep], gts2[keep]
                 print('Filtered out %d SVs with missing or invalid copy-numbers' % (n_df - len(df_flt)))
             else:
                 # assume normal copy-numbers
                 maj_allele = round(ploidy/2) if round(ploidy) > 1 else 1
                 min_allele = round(ploidy/2) if round(ploidy) > 1 else 0
                 default_gtype = '%d,%d,1.0' % (maj_allele, min_allele)
-                df_flt.gtype1[df_flt.gtype1.values==''] = default_gtype
-                df_flt.gtype2[df_flt.gtype2.values==''] = default_gtype
+                df_flt.gtype1[gts1.missing] = default_gtype
+                df_flt.gtype2[gts2.missing] = default_gtype
+                gts1 = gts1.fill(gts1.missing, default_gtype)
+                gts2 = gts2.fill(gts2.missing, default_gtype)
 
             if filter_subclonal:
                 n_df = len(df_flt)
-                gt1_is_clon  = [len(x.split('|'))==1 for x in df_flt.gtype1.values]
-                gt2_is_clon  = [len(x.split('|'))==1 for x in df_flt.gtype2.values]
-                is_clonal  = np.logical_and(gt1_is_clon, gt2_is_clon)
-                df_flt = df_flt.loc[is_clonal]
+                is_clonal = np.invert(np.logical_or(gts1.subclonal, gts2.subclonal))
+                df_flt, gts1, gts2 = df_flt.loc[is_clonal], gts1[is_clonal], gts2[is_clonal]
                 print('Filtered out %d SVs with any subclonal CNV states.' % (n_df - len(df_flt)))
 
             if filter_outliers:
                 n_df = len(df_flt)
-                df_flt = filter_outlying_norm_wins(df_flt)
+                df_flt, gts1, gts2 = filter_outlying_norm_wins(df_flt, gts1, gts2)
                 print('Filtered out %d SVs which had outlying depths' % (n_df - len(df_flt)))
 
-            gt1_exceeds_cn = np.array([exceeds_cn_limit(gtype, max_cn) for gtype in df_flt.gtype1.values])
-            gt2_exceeds_cn = np.array([exceeds_cn_limit(gtype, max_cn) for gtype in df_flt.gtype2.values])
+            gt1_exceeds_cn = exceeds_cn_limit(gts1, max_cn)
+            gt2_exceeds_cn = exceeds_cn_limit(gts2, max_cn)
 
             if np.any(gt1_exceeds_cn) or np.any(gt2_exceeds_cn):
                 n_df = len(df_flt)
-                df_flt = df_flt[np.invert(np.logical_or(gt1_exceeds_cn, gt2_exceeds_cn))]
+                keep = np.invert(np.logical_or(gt1_exceeds_cn, gt2_exceeds_cn))
+                df_flt, gts1, gts2 = df_flt[keep], gts1[keep], gts2[keep]
                 print('Filtered out %d SVs where major or minor alleles exceed the CN max' % (n_df - len(df_flt)))
+            var_gts = [gts1, gts2]
 
-    return df_flt
+    return df_flt, var_gts
+
+def find_nearest_bound(bounds, positions):
+    '''
+    distance from each position to the nearest of the (unsorted) segment
+    bounds, and the index of that segment (the first listed, for ties)
+    '''
+    uniq, first_idx = np.unique(bounds, return_index=True)
+    right = np.clip(np.searchsorted(uniq, positions), 0, len(uniq)-1)
+    left = np.clip(right-1, 0, len(uniq)-1)
+    left_dist, right_dist = np.abs(uniq[left]-positions), np.abs(uniq[right]-positions)
+
+    dists = np.minimum(left_dist, right_dist)
+    idxs = np.where(left_dist < right_dist, first_idx[left],
+                    np.where(right_dist < left_dist, first_idx[right],
+                             np.minimum(first_idx[left], first_idx[right])))
+    return dists, idxs
+
+def find_overlapping_segment(starts, ends, positions, chunk_size=10000):
+    '''
+    index of the first listed segment containing each position (-1 if none)
+    '''
+    order = np.argsort(starts, kind='mergesort')
+    sorted_starts, sorted_ends = starts[order], ends[order]
+
+    if np.all(sorted_starts[1:] > sorted_ends[:-1]):
+        # disjoint segments, bisect on the sorted starts
+        k = np.searchsorted(sorted_starts, positions, side='right') - 1
+        k_valid = np.maximum(k, 0)
+        hits = np.logical_and(k >= 0, positions <= sorted_ends[k_valid])
+        return np.where(hits, order[k_valid], -1)
+
+    idxs = np.empty(len(positions), dtype=int)
+    for i in range(0, len(positions), chunk_size):
+        pos = positions[i:i+chunk_size, np.newaxis]
+        overlaps = np.logical_and(pos >= starts, pos <= ends)
+        idxs[i:i+chunk_size] = np.where(np.any(overlaps, axis=1), np.argmax(overlaps, axis=1), -1)
+    return idxs
 
 def match_snv_copy_numbers(snv_df, cnv_df):
+    '''
+    set the SNV genotypes from the CNV segments they fall in, returns
+    the SNVs and the genotype tables of their genotype fields
+    '''
     bp_chroms = np.unique(snv_df['chrom'].values)
     bp_chroms = sorted(bp_chroms, key=lambda item: (int(item) if item.isdigit() else str(item)))
 
+    cnv_gts = parse_gtypes(cnv_df.gtype.values)
+    gt_idx = np.full(len(snv_df), -1, dtype=int)
     for bchr in bp_chroms:
-        gtypes = []
         current_chr = snv_df['chrom'].values==bchr
         var_tmp = snv_df[current_chr]
-        cnv_tmp = cnv_df[cnv_df['chr']==bchr]
+        cnv_chr = cnv_df['chr'].values==bchr
+        cnv_tmp = cnv_df[cnv_chr]
 
         if len(cnv_tmp)==0:
             continue
 
-        for pos in var_tmp['pos']:
-            cnv_start_list = cnv_tmp.startpos.values
-            cnv_end_list   = cnv_tmp.endpos.values
-            overlaps = np.logical_and(pos >= cnv_start_list, pos <= cnv_end_list)
-            match = cnv_tmp[overlaps]
-
-            if len(match)==0:
-                gtypes.append('')
-            else:
-                gtype = match.loc[match.index[0]].gtype
-                gtypes.append(gtype)
+        cnv_gtypes = cnv_tmp.gtype.values
+        match_idx = find_overlapping_segment(cnv_tmp.startpos.values, cnv_tmp.endpos.values,
+                                             var_tmp['pos'].values)
+        gtypes = np.where(match_idx >= 0, cnv_gtypes[np.maximum(match_idx, 0)], '')
+        gt_idx[current_chr] = np.where(match_idx >= 0, np.flatnonzero(cnv_chr)[np.maximum(match_idx, 0)], -1)
 
         snv_indexes = snv_df[current_chr].index.values
         snv_df.loc[snv_indexes,'gtype'] = gtypes
-    return snv_df
+    return snv_df, [cnv_gts.take(gt_idx)]
 
 def match_copy_numbers(var_df, cnv_df, strict_cnv_filt, sv_offset, bp_fields=['chr1','pos1','dir1','classification','pos2'], gtype_field='gtype1'):
-
+    '''
+    set the genotype of one break-end of each SV from the CNV segments,
+    returns the SVs and the genotype table of gtype_field
+    '''
     chrom_field, pos_field, dir_field, class_field, other_pos_field = bp_fields
 
     var_df[chrom_field] = map(str,var_df[chrom_field].values)
@@ -336,152 +352,95 @@ def match_copy_numbers(var_df, cnv_df, strict_cnv_filt, sv_offset, bp_fields=['c
     adj_cnv_field   = '%s_adjacent' % gtype_field
     cnv_dist_field  = '%s_cnv_boundary_dist' % gtype_field
 
+    cnv_gts = parse_gtypes(cnv_df.gtype.values)
+    gt_idx = np.full(len(var_df), -1, dtype=int)
     for bchr in bp_chroms:
-        gtypes, cnv_dists, adj_cnvs = [],[],[]
         current_chr = var_df[chrom_field].values==bchr
         var_tmp = var_df[current_chr]
-        cnv_tmp = cnv_df[cnv_df['chr']==bchr]
+        cnv_chr = cnv_df['chr'].values==bchr
+        cnv_tmp = cnv_df[cnv_chr]
+        var_indexes = var_df[current_chr].index.values
 
         if len(cnv_tmp)==0:
-            var_indexes = var_df[current_chr].index.values
             var_df.loc[var_indexes,gtype_field] = ''
             var_df.loc[var_indexes,adj_cnv_field] = ''
             var_df.loc[var_indexes,cnv_dist_field] = float('nan')
             continue
 
-        sv_info = zip(var_tmp[pos_field],var_tmp[dir_field],var_tmp[class_field],var_tmp[other_pos_field])
-        for pos,direct,classification,otherpos in sv_info:
-            cnv_gtype,adj_cnv = '',''
-
-            if classification == 'INTRX':
-                adjpos = pos - sv_offset if direct == '+' else pos + sv_offset
-            else:
-                adjpos = pos - sv_offset if gtype_field == 'gtype1' else pos + sv_offset
-
-            adjpos = -1 if direct=='.' else adjpos
-            cnv_start_list = cnv_tmp.startpos.values
-            cnv_end_list   = cnv_tmp.endpos.values
-
-            closest_start  = min(abs(cnv_start_list-pos))
-            closest_end    = min(abs(cnv_end_list-pos))
-            cnv_dist       = closest_start if closest_start < closest_end else closest_end
-
-            cnv_dists.append(cnv_dist)
-
-            #print("Checking overlaps for pos %d\n" %adjpos)
-            overlaps = np.logical_and(adjpos >= cnv_start_list, adjpos <= cnv_end_list)
-
-            #print(overlaps)
-            match = cnv_tmp[overlaps]
-            if len(match)==0 and strict_cnv_filt:
-                gtypes.append('')
-                # add closest CNV to adjacent
-                if closest_start < closest_end:
-                    start_match = closest_start==abs(cnv_start_list-pos)
-                    cnv_gtype   = cnv_tmp[start_match].gtype.values[0]
-                else:
-                    end_match   = closest_end==abs(cnv_end_list-pos)
-                    cnv_gtype   = cnv_tmp[end_match].gtype.values[0]
-                adj_cnvs.append(cnv_gtype)
-            elif len(match)==0:
-                # assign closest CNV state with closest boundary to SNV
-                if closest_start < closest_end:
-                    start_match = closest_start==abs(cnv_start_list-pos)
-                    cnv_gtype   = cnv_tmp[start_match].gtype.values[0]
-                    cnv_pos     = cnv_tmp[start_match].startpos.values[0]
-                    adj_cnv     = get_adjacent_cnv(cnv_tmp,start_match,pos,cnv_pos,False).gtype.values[0]
-                else:
-                    end_match   = closest_end==abs(cnv_end_list-pos)
-                    cnv_gtype   = cnv_tmp[end_match].gtype.values[0]
-                    cnv_pos     = cnv_tmp[end_match].endpos.values[0]
-                    adj_cnv     = get_adjacent_cnv(cnv_tmp,end_match,pos,cnv_pos).gtype.values[0]
-
-                gtypes.append(cnv_gtype)
-                adj_cnvs.append(adj_cnv)
-            else:
-                cnv_gtype = match.loc[match.index[0]].gtype
-                gtypes.append(cnv_gtype)
-
-                cnv_pos = match.loc[match.index[0]].startpos
-                next_cnv = closest_start > closest_end
-                if next_cnv:
-                    cnv_pos = match.loc[match.index[0]].endpos
-
-                cnv_match = match.index[0]==cnv_tmp.index.values
-                adj_cnv = get_adjacent_cnv(cnv_tmp,cnv_match,pos,cnv_pos,next_cnv).gtype.values[0]
-                adj_cnvs.append(adj_cnv)
+        pos = var_tmp[pos_field].values
+        direct = var_tmp[dir_field].values
+        is_intrx = var_tmp[class_field].values == 'INTRX'
+
+        # CNV state is taken sv_offset bp away from the break, on the side of the break-end
+        upstream = np.where(is_intrx, direct == '+', gtype_field == 'gtype1')
+        adjpos = np.where(upstream, pos - sv_offset, pos + sv_offset)
+        adjpos[direct == '.'] = -1
+
+        cnv_start_list = cnv_tmp.startpos.values
+        cnv_end_list   = cnv_tmp.endpos.values
+        cnv_gtypes     = cnv_tmp.gtype.values
+        n_cnvs         = len(cnv_tmp)
+
+        closest_start, start_idx = find_nearest_bound(cnv_start_list, pos)
+        closest_end, end_idx     = find_nearest_bound(cnv_end_list, pos)
+        start_is_closest = closest_start < closest_end
+        cnv_dists   = np.where(start_is_closest, closest_start, closest_end)
+        closest_idx = np.where(start_is_closest, start_idx, end_idx)
+
+        match_idx = find_overlapping_segment(cnv_start_list, cnv_end_list, adjpos)
+        matched = match_idx >= 0
+
+        # the adjacent CNV is the previous listed segment when the closest boundary
+        # is a start, otherwise the next (or the segment itself at either end)
+        cnv_idx = np.where(matched, match_idx, closest_idx)
+        next_cnv = np.where(matched, closest_start > closest_end, np.invert(start_is_closest))
+        adj_idx = cnv_idx + np.where(next_cnv, 1, -1)
+        adj_idx = np.where(np.logical_or(adj_idx < 0, adj_idx >= n_cnvs), cnv_idx, adj_idx)
+
+        gtypes = cnv_gtypes[cnv_idx]
+        adj_cnvs = cnv_gtypes[adj_idx]
+        gt_idx[current_chr] = np.flatnonzero(cnv_chr)[cnv_idx]
+        if strict_cnv_filt:
+            # no CNV state, but record the closest CNV as adjacent
+            gtypes = np.where(matched, gtypes, '')
+            adj_cnvs = np.where(matched, adj_cnvs, cnv_gtypes[closest_idx])
+            gt_idx[current_chr] = np.where(matched, gt_idx[current_chr], -1)
 
-        var_indexes = var_df[current_chr].index.values
         var_df.loc[var_indexes,gtype_field]   = gtypes
         var_df.loc[var_indexes,adj_cnv_field] = adj_cnvs
         var_df.loc[var_indexes,cnv_dist_field] = cnv_dists
 
-    return var_df
-
-
-def get_adjacent_cnv(cnv,match,pos,cnv_pos,next_cnv=True):
-
-    if not np.any(match):
-        return np.empty(0)
-
-    match = match.copy()
-    offset = 1 if next_cnv else -1
-    where_match = np.where(match)[0][0]
+    return var_df, cnv_gts.take(gt_idx)
 
-    if where_match+offset<0 or where_match+offset>=len(cnv):
-        cnv[match]
-    else:
-        match[where_match] = False
-        match[where_match+offset] = True
-
-    return cnv[match]
-
-def gtypes_match(gtype1,gtype2):
-    if gtype1=='' or gtype2=='':
-        return False
-    gtype1 = [map(float,x.split(',')[:2]) for x in gtype1.split('|')]
-    gtype2 = [map(float,x.split(',')[:2]) for x in gtype2.split('|')]
-    return np.all(np.array(gtype1)==np.array(gtype2))
-
-def is_same_sv_germline(sv1,sv2,gl_th):
-    sv1_chr1, sv1_bp1, sv1_chr2, sv1_bp2 = sv1
-    sv2_chr1, sv2_bp1, sv2_chr2, sv2_bp2 = sv2
-
-    if sv1_chr1==sv2_chr1 and sv1_chr2==sv2_chr2:
-        if abs(sv1_bp1-sv2_bp1)<gl_th and abs(sv1_bp2-sv2_bp2)<gl_th:
-            return True
-    if sv1_chr2==sv2_chr1 and sv1_chr1==sv2_chr2:
-        if abs(sv1_bp2-sv2_bp1)<gl_th and abs(sv1_bp1-sv2_bp2)<gl_th:
-            return True
-    return False
+def gtypes_match(gts1, gts2):
+    '''
+    True where both genotypes are present and have the
+    same major and minor copy-numbers for each clone
+    '''
+    same_alleles = np.logical_and(gts1.major == gts2.major, gts1.minor == gts2.minor)
+    same_alleles = np.all(np.logical_or(same_alleles, np.invert(gts1.valid)), axis=1)
+    same_clones = np.logical_and(gts1.n_clones == gts2.n_clones, np.invert(gts1.missing))
+    return np.logical_and(same_clones, same_alleles)
 
 def filter_germline(gml_file,sv_df,rlen,insert,gl_th):
     print("Filtering out germline SVs...")
-    df_gml = pd.DataFrame(pd.read_csv(gml_file,delimiter='\t',dtype=None,low_memory=False))
-    germline = []
-
-    for idx_sv,sv in sv_df.iterrows():
-        sv_loc = [str(sv.chr1),int(sv.pos1),str(sv.chr2),int(sv.pos2)]
-        same_chrs = np.logical_and(df_gml.chr1.values==sv_loc[0],df_gml.chr2.values==sv_loc[2])
-        df_gml_tmp = df_gml[same_chrs]
-        for idx_gml,sv_gml in df_gml_tmp.iterrows():
-            sv_loc_gml = [str(sv_gml.chr1),int(sv_gml.pos1),str(sv_gml.chr2),int(sv_gml.pos2)]
-            if sv_gml.support>0 and is_same_sv_germline(sv_loc,sv_loc_gml,gl_th):
-                germline.append(idx_sv)
-                break
-
-    print("Filtered out %d SVs that were found in the germline!" % len(germline))
-    return sv_df.drop(germline,axis=0)
-
-def adjust_sv_read_counts(sv_df,pi,pl,min_dep,rlen,Config):
+    gml_index = load_germline_index(gml_file)
+    germline = gml_index.query(sv_df.chr1.map(str).values, sv_df.pos1.values,
+                               sv_df.chr2.map(str).values, sv_df.pos2.values, gl_th)
+
+    print("Filtered out %d SVs that were found in the germline!" % np.sum(germline))
+    return sv_df[np.invert(germline)]
+
+def adjust_sv_read_counts(sv_df,var_gts,pi,pl,min_dep,rlen,Config):
     dna_gain_class = Config.get('SVclasses', 'dna_gain_class').split(',')
     dna_loss_class = Config.get('SVclasses', 'dna_loss_class').split(',')
     support_adjust_factor = float(Config.get('FilterParameters', 'support_adjust_factor'))
     filter_subclonal_cnvs = string_to_bool(Config.get('FilterParameters', 'filter_subclonal_cnvs'))
     restrict_cnss = string_to_bool(Config.get('ClusterParameters', 'restrict_cnv_search_space'))
 
-    gt1_sc  = [float(x.split('|')[0].split(',')[2])<1 if x!='' else False for x in sv_df.gtype1.values]
-    gt2_sc  = [float(x.split('|')[0].split(',')[2])<1 if x!='' else False for x in sv_df.gtype2.values]
+    gts1, gts2 = var_gts
+    gt1_sc  = np.logical_and(gts1.valid[:, 0], gts1.frac[:, 0] < 1)
+    gt2_sc  = np.logical_and(gts2.valid[:, 0], gts2.frac[:, 0] < 1)
     one_sc  = np.logical_xor(gt1_sc,gt2_sc)
 
     n = zip(np.array(sv_df.norm1.values),np.array(sv_df.norm2.values))
@@ -497,18 +456,15 @@ def adjust_sv_read_counts(sv_df,pi,pl,min_dep,rlen,Config):
 
     if not filter_subclonal_cnvs:
         # prefer sides with clonal genotype data
-        exclusive_subclones = zip(sv_df.gtype1.values[one_sc],sv_df.gtype2.values[one_sc])
-        sides[one_sc] = [1 if len(gt1.split('|'))>1 else 0 for gt1,gt2 in exclusive_subclones]
+        sides[one_sc] = np.where(gts1.subclonal[one_sc], 1, 0)
 
     # if one side doesn't have CNV data, pick the other side
-    if np.any(sv_df.gtype1.values==''):
-        sides[sv_df.gtype1.values==''] = 1
-    if np.any(sv_df.gtype2.values==''):
-        sides[sv_df.gtype2.values==''] = 0
+    sides[gts1.missing] = 1
+    sides[gts2.missing] = 0
 
     norm = np.array([float(ni[si]) for ni,si in zip(n, sides)])
     cparams = {'restrict_cnss': restrict_cnss} #fake cparams dic for compatibility
-    combos = sv_df.apply(cluster.get_sv_allele_combos, axis=1, args=(cparams,))
+    combos = cluster.get_sv_allele_combos(gts1, gts2, cparams)
     cn_states = [cn[side] for cn,side in zip(combos, sides)]
 
     try:
@@ -574,6 +530,8 @@ def run(args):
     pp_file     = args.pp_file
     cfg         = args.cfg
     blist_file  = args.blist
+    threads     = args.threads
+    refresh     = args.refresh_cache
 
     Config = ConfigParser.ConfigParser()
     cfg_file = Config.read(cfg)
@@ -611,9 +569,8 @@ def run(args):
     pi, ploidy = svp_load.get_purity_ploidy(pp_file, sample, out)
     rlen, insert, insert_std = svp_load.get_read_params(param_file, sample, out)
 
-    blist = pd.DataFrame()
-    if blist_file != '' and blist_file.lower() != 'none':
-        blist = pd.DataFrame(svp_load.load_blacklist(blist_file))
+    blist = load_blacklist_index(blist_file)
+    cache = get_input_cache(cfg, out, refresh)
 
     if pi < 0 or pi > 1:
         raise ValueError("Tumour purity value not between 0 and 1!")
@@ -623,41 +580,33 @@ def run(args):
     snv_df = pd.DataFrame()
 
     if snvs!="":
-        if snv_format == 'sanger':
-            snv_df = load_data.load_snvs_sanger(snvs)
-        elif snv_format == 'mutect':
-            snv_df = load_data.load_snvs_mutect(snvs,sample)
-        elif snv_format == 'mutect_callstats':
-            snv_df = load_data.load_snvs_mutect_callstats(snvs)
-        elif snv_format == 'consensus':
-            snv_df = load_data.load_snvs_consensus(snvs)
-        elif snv_format == 'multisnv':
-            snv_df = load_data.load_snvs_multisnv(snvs, sample)
+        snv_df = cache.load(snvs, 'snvs', (snv_format, sample), \
+                            lambda: load_data.load_snvs(snvs, snv_format, sample, threads))
         snv_df = run_simple_snv_filter(snv_df, min_dep, blist, filter_chrs, valid_chrs)
 
     if svs!="":
-        sv_df = load_data.load_svs(svs)
+        sv_df = cache.load(svs, 'svs', (), lambda: load_data.load_svs(svs))
         sv_df = run_simple_filter(sv_df,rlen,insert,minsplit,minspan,sizefilter, \
                                   min_dep,filter_chrs,valid_chrs,blist)
         if gml!="":
             sv_df = filter_germline(gml,sv_df,rlen,insert,gl_th)
 
     if cnvs!="":
-        cnv_df = load_data.load_cnvs(cnvs)
+        cnv_df = cache.load(cnvs, 'cnvs', (), lambda: load_data.load_cnvs(cnvs))
 
         if len(sv_df)>0:
             print('Matching copy-numbers for SVs...')
-            sv_df = match_copy_numbers(sv_df,cnv_df,strict_cnv_filt,sv_offset)
-            sv_df = match_copy_numbers(sv_df,cnv_df,strict_cnv_filt,sv_offset,\
-                    ['chr2','pos2','dir2','classification','pos1'],'gtype2')
-            sv_df = run_cnv_filter(sv_df,cnvs,ploidy,neutral,filter_otl,strict_cnv_filt,
-                                   filter_subclonal_cnvs,max_cn)
+            sv_df, gts1 = match_copy_numbers(sv_df,cnv_df,strict_cnv_filt,sv_offset)
+            sv_df, gts2 = match_copy_numbers(sv_df,cnv_df,strict_cnv_filt,sv_offset,\
+                          ['chr2','pos2','dir2','classification','pos1'],'gtype2')
+            sv_df, sv_gts = run_cnv_filter(sv_df,[gts1,gts2],cnvs,ploidy,neutral,filter_otl,
+                                           strict_cnv_filt,filter_subclonal_cnvs,max_cn)
 
         if len(snv_df)>0:
             print('Matching copy-numbers for SNVs...')
-            snv_df = match_snv_copy_numbers(snv_df,cnv_df)
-            snv_df = run_cnv_filter(snv_df,cnvs,ploidy,neutral,filter_otl,strict_cnv_filt,
-                                    filter_subclonal_cnvs,max_cn,are_snvs=True)
+            snv_df, snv_gts = match_snv_copy_numbers(snv_df,cnv_df)
+            snv_df, snv_gts = run_cnv_filter(snv_df,snv_gts,cnvs,ploidy,neutral,filter_otl,
+                                             strict_cnv_filt,filter_subclonal_cnvs,max_cn,are_snvs=True)
     else:
         print('No CNV input defined, assuming all loci major/minor allele copy-numbers are ploidy/2')
         if len(sv_df)>0:
@@ -666,23 +615,25 @@ def run(args):
             default_gtype = '%d,%d,1.0' % (maj_allele, min_allele)
             sv_df['gtype1'] = default_gtype
             sv_df['gtype2'] = default_gtype
+            sv_gts = [repeat_gtype(default_gtype, len(sv_df))] * 2
             if filter_otl:
-                sv_df = run_cnv_filter(sv_df,cnvs,ploidy,neutral,filter_otl,strict_cnv_filt,
-                                       filter_subclonal_cnvs,max_cn)
+                sv_df, sv_gts = run_cnv_filter(sv_df,sv_gts,cnvs,ploidy,neutral,filter_otl,
+                                               strict_cnv_filt,filter_subclonal_cnvs,max_cn)
         if len(snv_df)>0:
             maj_allele = round(ploidy/2) if round(ploidy) > 1 else 1
             min_allele = round(ploidy/2) if round(ploidy) > 1 else 0
             default_gtype = '%d,%d,1.0' % (maj_allele, min_allele)
             snv_df['gtype'] = default_gtype
-            snv_df = run_cnv_filter(snv_df,cnvs,ploidy,neutral,filter_otl,strict_cnv_filt,
-                                    filter_subclonal_cnvs,max_cn,are_snvs=True)
+            snv_gts = [repeat_gtype(default_gtype, len(snv_df))]
+            snv_df, snv_gts = run_cnv_filter(snv_df,snv_gts,cnvs,ploidy,neutral,filter_otl,
+                                             strict_cnv_filt,filter_subclonal_cnvs,max_cn,are_snvs=True)
 
     if len(sv_df)==0 and len(snv_df)==0:
         raise ValueError('No variants found to output!')
 
     if len(sv_df)>0:
         sv_df.index = range(len(sv_df)) #reindex
-        sv_df = adjust_sv_read_counts(sv_df,pi,ploidy,min_dep,rlen,Config)
+        sv_df = adjust_sv_read_counts(sv_df,sv_gts,pi,ploidy,min_dep,rlen,Config)
         sv_df.to_csv('%s/%s_filtered_svs.tsv'%(out,sample),sep='\t',index=False,na_rep='')
         print('Final filtered SV count: %d' % len(sv_df))
 
@@ -5,15 +5,31 @@ import ConfigParser
 import os
 import pandas as pd
 import subprocess
+import tempfile
+import shutil
+import argparse
+import pysam
+from scipy.stats import chi2
 from unittest import TestCase
 from SVprocess import bamtools
 from SVprocess import annotate
 from SVprocess import svp_load_data as load_data
 from SVprocess import count
+from SVprocess import svp_dtypes as dtypes
+from SVprocess.bp_index import BreakpointIndex
+from SVprocess.bed_index import IntervalIndex
 from SVclone import load_data as svc_load
 from SVclone import run_filter
 from SVclone import run_clus
 from SVclone import post_assign
+from SVclone import cluster
+from SVclone import gibbs
+from SVclone import vi
+from SVclone import input_cache
+from SVclone import germline_index
+from SVclone.genotypes import parse_gtypes, parse_var_gtypes, repeat_gtype
+from SVclone.cn_states import CNStates, from_combos, concat_cn_states
+from SVclone.lik_cache import VarLikCache
 
 blist = ''
 bam = 'example_data/tumour_p80_DEL_sv_extract_sorted.bam'
@@ -74,6 +90,17 @@ max_dep = ((mean_cov*(max_ins*2))/rlen)*max_cn
 
 clus_th   = {'percent': 0.01, 'absolute': 10}
 
+def two_cluster_inputs(combos=None, purity=1.):
+    '''
+    model inputs of 200 variants, half with VAF 0.45 and half with VAF 0.15
+    (CCFs 0.9 and 0.3 for the default clonal heterozygous states at purity 1)
+    '''
+    np.random.seed(3)
+    dep = np.full(200, 80.)
+    sup = np.random.binomial(80, np.repeat([0.45, 0.15], 100)).astype(float)
+    combos = [[[2, 2, 0.5, 1.]]] * 200 if combos is None else combos
+    return cluster.ModelInputs(from_combos(combos), sup, dep, purity, np.full(200, 2.))
+
 class test(unittest.TestCase):
 
     def test_01_annotate_count(self):
@@ -124,8 +151,9 @@ class test(unittest.TestCase):
         default_gtype = '%d,%d,1.0' % (maj_allele, min_allele)
         sv_df['gtype1'] = default_gtype
         sv_df['gtype2'] = default_gtype
+        sv_gts = [repeat_gtype(default_gtype, len(sv_df))] * 2
 
-        sv_df = run_filter.adjust_sv_read_counts(sv_df, pi, ploidy, min_dep, rlen, Config)
+        sv_df = run_filter.adjust_sv_read_counts(sv_df, sv_gts, pi, ploidy, min_dep, rlen, Config)
         sv_df.to_csv(sv_filt_file, sep='\t', index=False, na_rep='')
 
         sv_df_filt = pd.read_csv(sv_filt_file, delimiter='\t', dtype=None, header=0, low_memory=False)
@@ -153,6 +181,7 @@ class test(unittest.TestCase):
 
         snv_df = pd.read_csv(snv_filt_file, delimiter='\t', dtype=None, header=0, low_memory=False)
         snv_df = pd.DataFrame(snv_df).fillna('')
+        sv_gts, snv_gts = parse_var_gtypes(sv_df), parse_var_gtypes(snv_df, snvs=True)
 
         cluster_params['n_iter'] = 110
         cluster_params['burn'] = 10
@@ -161,7 +190,7 @@ class test(unittest.TestCase):
 
         # separate clustering test
         subprocess.call(['rm', '-rf', '%s/run0' % outdir])
-        run_clus.cluster_and_process(sv_df, snv_df, 0, outdir, sample_params,
+        run_clus.cluster_and_process(sv_df, sv_gts, snv_df, snv_gts, 0, outdir, sample_params,
                                      cluster_params, output_params, [1234])
 
         sv1 = pd.read_csv('%s/run0/%s' % (outdir, ass_prob_tbl),
@@ -209,7 +238,7 @@ class test(unittest.TestCase):
         subprocess.call(['rm', '-rf', '%s/run0' % outdir])
         cluster_params['cocluster'] = True
 
-        run_clus.cluster_and_process(sv_df, snv_df, 0, outdir, sample_params,
+        run_clus.cluster_and_process(sv_df, sv_gts, snv_df, snv_gts, 0, outdir, sample_params,
                                         cluster_params, output_params, [1234])
 
         snv1 = pd.read_csv('%s/run0/snvs/%s' % (outdir, ass_prob_tbl),
@@ -256,6 +285,8 @@ class test(unittest.TestCase):
 
         sv_filt_df = sv_df.head(50).copy()
         snv_filt_df = snv_df.head(250).copy()
+        sv_gts, snv_gts = parse_var_gtypes(sv_df), parse_var_gtypes(snv_df, snvs=True)
+        sv_filt_gts, snv_filt_gts = parse_var_gtypes(sv_filt_df), parse_var_gtypes(snv_filt_df, snvs=True)
 
         # rerun clustering with subset
         subprocess.call(['rm', '-rf', '%s/run0' % outdir])
@@ -267,17 +298,18 @@ class test(unittest.TestCase):
         cluster_params['cocluster'] = True
         cluster_params['use_map'] = False
 
-        run_clus.cluster_and_process(sv_filt_df, snv_filt_df, 0, outdir, sample_params,
-                                        cluster_params, output_params, [1234])
+        run_clus.cluster_and_process(sv_filt_df, sv_filt_gts, snv_filt_df, snv_filt_gts, 0, outdir,
+                                     sample_params, cluster_params, output_params, [1234])
 
         rundir = '%s/run0' % outdir
-        sv_to_assign = post_assign.get_var_to_assign(sv_df, sv_filt_df)
+        sv_to_assign, sv_assign_gts = post_assign.get_var_to_assign(sv_df, sv_gts, sv_filt_df)
 
         self.assertTrue(len(sv_to_assign) == (len(sv_df) - len(sv_filt_df)))
+        self.assertTrue(len(sv_assign_gts[0]) == len(sv_to_assign))
 
-        sv_to_assign = run_filter.adjust_sv_read_counts(sv_to_assign, pi, ploidy, 0, rlen, Config)
-        post_assign.post_assign_vars(sv_to_assign, sv_filt_df, rundir, sample, sample_params, 
-                                     cluster_params, clus_th, True, cdefs)
+        sv_to_assign = run_filter.adjust_sv_read_counts(sv_to_assign, sv_assign_gts, pi, ploidy, 0, rlen, Config)
+        post_assign.post_assign_vars(sv_to_assign, sv_assign_gts, sv_filt_df, sv_filt_gts, rundir, sample,
+                                     sample_params, cluster_params, clus_th, True, cdefs)
 
         sv1 = pd.read_csv('%s/run0_post_assign/%s' % (outdir, ass_prob_tbl),
                           delimiter='\t', dtype=None, header=0, low_memory=False)
@@ -304,9 +336,9 @@ class test(unittest.TestCase):
         self.assertTrue(len(sv8) == 1)
         self.assertTrue(len(sv9) == len(sv_df))
 
-        snv_to_assign = post_assign.get_var_to_assign(snv_df, snv_filt_df, snvs = True)
-        post_assign.post_assign_vars(snv_to_assign, snv_filt_df, rundir, sample, sample_params, cluster_params,
-                                     clus_th, True, cdefs, snvs = True)
+        snv_to_assign, snv_assign_gts = post_assign.get_var_to_assign(snv_df, snv_gts, snv_filt_df, snvs = True)
+        post_assign.post_assign_vars(snv_to_assign, snv_assign_gts, snv_filt_df, snv_filt_gts, rundir, sample,
+                                     sample_params, cluster_params, clus_th, True, cdefs, snvs = True)
 
         snv1 = pd.read_csv('%s/run0_post_assign/snvs/%s' % (outdir, ass_prob_tbl),
                            delimiter='\t', dtype=None, header=0, low_memory=False)
@@ -333,6 +365,362 @@ class test(unittest.TestCase):
         self.assertTrue(len(snv8) == 1)
         self.assertTrue(len(snv9) == len(snv_df))
 
+    def test_06_breakpoint_index(self):
+        bp_index = BreakpointIndex(svs)
+        sv = svs[0]
+        matches = bp_index.query(sv['chr1'], sv['pos1'], threshold)
+        self.assertTrue((0, 1) in matches)
+
+        # moved break-ends must be re-indexed
+        moved = sv.copy()
+        moved['pos1'] = sv['pos1'] + threshold * 10
+        bp_index.update(0, moved)
+        self.assertFalse((0, 1) in bp_index.query(sv['chr1'], sv['pos1'], threshold))
+        self.assertTrue((0, 1) in bp_index.query(sv['chr1'], moved['pos1'], threshold))
+
+        bp_index.add(len(svs), moved)
+        self.assertTrue((len(svs), 2) in bp_index.query(sv['chr2'], sv['pos2'], threshold))
+
+    def test_07_blacklist_index(self):
+        bed = np.array([('1', 100, 200), ('1', 150, 300), ('2', 10, 20)],
+                        dtype=[('f0', 'S10'), ('f1', int), ('f2', int)])
+        blist = IntervalIndex(bed)
+        self.assertTrue(len(blist) == 2) # overlapping intervals merged
+
+        hits = blist.query_points(['1', '1', '1', '2', '3'], [100, 300, 301, 15, 15])
+        self.assertTrue(list(hits) == [True, True, False, True, False])
+
+        hits = blist.query_breakpoints(['1', '2'], [50, 50], ['2', '2'], [15, 50])
+        self.assertTrue(list(hits) == [True, False])
+
+    def test_08_genotypes(self):
+        gts = parse_gtypes(['1,1,1.0', '', '3,1,0.6|2,0,0.4', np.nan, '0,0,1.0'])
+        self.assertTrue(list(gts.n_clones) == [1, 0, 2, 0, 1])
+        self.assertTrue(list(run_filter.is_clonal_neutral(gts)) == [True, False, False, False, False])
+        self.assertTrue(list(run_filter.exceeds_cn_limit(gts, 2)) == [False, False, True, False, False])
+
+        gtypes, gts = run_filter.remove_zero_copynumbers(['1,1,1.0', '', '3,1,0.6|2,0,0.4', '', '0,0,1.0'], gts)
+        self.assertTrue(list(gtypes) == ['1,1,1.0', '', '3,1,0.6|2,0,0.4', '', ''])
+        self.assertTrue(list(gts.missing) == [False, True, False, True, True])
+
+        # only the first two clones are clustered, the filter's CN limit and
+        # weighted copy-numbers take all clones into account
+        gts = parse_gtypes(['3,1,0.5|2,0,0.3|1,1,0.2', '2,1,0.5|1,1,0.3|4,0,0.2'])
+        self.assertTrue(list(gts.n_clones) == [2, 2] and gts.clones(0) == [(3., 1., 0.5), (2., 0., 0.3)])
+        self.assertTrue(list(run_filter.exceeds_cn_limit(gts, 3)) == [False, True])
+        self.assertTrue(np.allclose(run_filter.get_weighted_cns(gts), [(3.5 + 2. + 1.2) / 2, (2.5 + 1.3 + 4.) / 2]))
+        self.assertTrue(list(run_filter.exceeds_cn_limit(gts.clear([False, True]), 3)) == [False, False])
+        self.assertTrue(np.allclose(run_filter.get_weighted_cns(gts.fill([True, False], '1,1,1.0')), [1., 3.9]))
+
+        # rows by index, missing for -1
+        taken = gts.take(np.array([1, -1, 0]))
+        self.assertTrue(list(taken.missing) == [False, True, False] and taken.clones(0) == gts.clones(1))
+        self.assertTrue(np.allclose(run_filter.get_weighted_cns(taken), [3.9, 1., 3.35]))
+
+    def test_09_model_inputs(self):
+        combos = [[[2, 2, 0.5, 1.]], [], [[4, 3, 1/3., 0.6], [4, 3, 2/3., 0.6], [3, 1, 1., 0.4]]]
+        sup, dep, norm = np.array([10., 0., 7.]), np.array([40., 30., 25.]), np.array([30., 30., 18.])
+        phi = np.array([0.8, 1., 0.5])
+        inputs = cluster.ModelInputs(from_combos(combos), sup, dep, 0.9, norm)
+        pvs, lls = inputs.calc_state_liks(phi)
+        for i, combo in enumerate(combos):
+            pvs_i, lls_i = cluster.calc_lik(combo, sup[i], dep[i], phi[i], 0.9, norm[i])
+            self.assertTrue(np.allclose(pvs[i][:len(combo)], pvs_i) and np.allclose(lls[i][:len(combo)], lls_i))
+
+        sub = inputs[np.array([2, 0])]
+        self.assertTrue(np.array_equal(sub.get_max_lls(0.5), inputs.get_max_lls(0.5)[[2, 0]]))
+
+        grid = cluster.PhiGrid(inputs, 0.1, 1., 91)
+        exact, best = cluster.get_model_lls(inputs, 0.5)
+        self.assertTrue(np.allclose(grid.get_lls(np.full(3, 0.5)), exact, atol=1e-4))
+        self.assertTrue(np.array_equal(grid.get_states(np.full(3, 0.5)), best))
+        self.assertTrue(grid.validate(inputs)['max_ll_error'] < 0.05)
+
+    def test_10_gibbs_sampler(self):
+        inputs = two_cluster_inputs()
+        model_func = cluster.get_model_func(inputs)
+        trace, fit = gibbs.sample(model_func, 200, 4, np.zeros(200, dtype=int), np.array([0.5, 0.4, 0.3, 0.2]),
+                                  0.02, 1., 60, 20, 2, 0.1, 1, 1, True, True)
+        z, phi = trace.trace('z')[:], trace.trace('phi_k')[:]
+        self.assertTrue(z.shape == (20, 200) and phi.shape == (20, 4))
+        self.assertRaises(KeyError, trace.trace, 'alpha')
+        zs = [np.bincount(z[-1, i:i+100], minlength=4).argmax() for i in (0, 100)]
+        self.assertTrue(np.allclose(phi[-1, zs], [0.9, 0.3], atol=0.05))
+        self.assertTrue(fit.len == 208 and fit.data_len == 200 and np.isfinite(fit.lnL))
+
+    def test_11_variational(self):
+        inputs = two_cluster_inputs()
+        grid = cluster.PhiGrid(inputs, 0.02, 1., 99)
+        trace, fit = vi.fit(grid.lls, grid.phis, 200, 4, np.zeros(200, dtype=int), 0.1, 1, 1, True)
+        z, phi = trace.trace('z')[:], trace.trace('phi_k')[:]
+        self.assertTrue(z.shape == (vi.n_draws, 200) and phi.shape == (vi.n_draws, 4))
+        zs = [np.bincount(z[:, i:i+100].ravel(), minlength=4).argmax() for i in (0, 100)]
+        self.assertTrue(np.allclose(np.mean(phi[:, zs], axis=0), [0.9, 0.3], atol=0.05))
+        self.assertTrue(np.isfinite(fit.ELBO) and fit.ELBO < 0)
+
+    def test_12_lik_cache(self):
+        inputs = two_cluster_inputs([[[2, 2, 0.5, 1.]], [[2, 3, 1/3., 1.], [2, 3, 2/3., 1.]]] * 100, 0.8)
+        cache = VarLikCache(cluster.get_model_func(inputs), 200)
+        z, phi_k = np.random.randint(0, 3, 200), np.array([0.9, 0.5, 0.3])
+        for i in range(5):
+            phi_k[i % 3] = np.random.rand()
+            z[np.random.randint(0, 200, 5)] = np.random.randint(0, 3, 5)
+            cache.update(phi_k[z])
+            lls, best = cluster.get_model_lls(inputs, phi_k[z])
+            self.assertTrue(np.array_equal(cache.lls, lls))
+            self.assertTrue(np.array_equal(cache.pvs, cluster.get_most_likely_pvs(inputs, phi_k[z])))
+            self.assertTrue(np.isclose(cache.total, np.sum(lls)))
+
+    def test_13_input_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        in_file = '%s/input.txt' % tmp_dir
+        with open(in_file, 'w') as f:
+            f.write('chrom\tpos\n1\t100\n')
+        n_loads = []
+        def load_func():
+            n_loads.append(1)
+            return pd.read_csv(in_file, delimiter='\t', dtype={'chrom': str})
+
+        cache = input_cache.InputCache('%s/cache' % tmp_dir)
+        df = cache.load(in_file, 'snvs', (), load_func)
+        self.assertTrue(cache.load(in_file, 'snvs', (), load_func).equals(df) and len(n_loads) == 1)
+
+        # same size and modification time, but changed content
+        mtime = os.path.getmtime(in_file)
+        with open(in_file, 'w') as f:
+            f.write('chrom\tpos\n2\t200\n')
+        os.utime(in_file, (mtime, mtime))
+        self.assertTrue(list(cache.load(in_file, 'snvs', (), load_func).pos) == [200] and len(n_loads) == 2)
+
+        # changed modification time only
+        os.utime(in_file, (mtime + 10, mtime + 10))
+        cache.load(in_file, 'snvs', (), load_func)
+        cache.load(in_file, 'snvs', (), load_func)
+        self.assertTrue(len(n_loads) == 3)
+
+        input_cache.InputCache('%s/cache' % tmp_dir, refresh=True).load(in_file, 'snvs', (), load_func)
+        self.assertTrue(len(n_loads) == 4)
+
+        # entries of another cache version are not used
+        entry_file = cache.get_entry_file(in_file, 'snvs')
+        input_cache.cache_version, version = 'old', input_cache.cache_version
+        self.assertTrue(cache.get_entry_file(in_file, 'snvs') != entry_file)
+        input_cache.cache_version = version
+
+        # least recently used entries are evicted first
+        os.utime(entry_file, (0, 0))
+        cache.max_size = os.path.getsize(entry_file) + 100
+        cache.load(in_file, 'cnvs', (), load_func)
+        self.assertTrue(not os.path.exists(entry_file))
+        self.assertTrue(os.path.exists(cache.get_entry_file(in_file, 'cnvs')))
+
+        self.assertFalse(input_cache.get_input_cache('svclone_test.ini', tmp_dir).enabled)
+        shutil.rmtree(tmp_dir)
+
+    def test_14_germline_panel(self):
+        tmp_dir = tempfile.mkdtemp()
+        cols = ['chr1', 'pos1', 'chr2', 'pos2', 'support']
+        normals = [[['1', 1000, '1', 5000, 3], ['2', 100, '3', 900, 5], ['4', 50, '4', 800, 1]],
+                   [['1', 1000, '1', 5000, 2], ['3', 900, '2', 100, 4], ['4', 50, '4', 800, 4],
+                    ['5', 10, '5', 20, 9]]]
+        gml_files = ['%s/normal%d_svinfo.txt' % (tmp_dir, i) for i in range(len(normals))]
+        for gml_file, normal in zip(gml_files, normals):
+            pd.DataFrame(normal, columns=cols).to_csv(gml_file, sep='\t', index=False)
+
+        # keeps SVs with at least 2 supporting reads in 2 normals, in either break-end order
+        panel_file = '%s/panel.npz' % tmp_dir
+        germline_index.build_panel(argparse.Namespace(germline_svs=gml_files, out=panel_file,
+                                                      min_support=2, min_samples=2))
+        sv_df = pd.DataFrame([['1', 1003, '1', 4998], ['3', 905, '2', 98], ['2', 98, '3', 905],
+                              ['4', 50, '4', 800], ['5', 10, '5', 20], ['1', 1000, '1', 5100]],
+                             columns=cols[:4])
+        filt_df = run_filter.filter_germline(panel_file, sv_df, 100, 300, 10)
+        self.assertTrue(list(filt_df.index) == [3, 4, 5])
+
+        # matches the nested-loop filter over same-ordered chromosome pairs
+        np.random.seed(3)
+        def random_svs(n):
+            chr2 = np.random.choice(['1', '2'], n)
+            chr1 = np.where(chr2 == '1', '1', np.random.choice(['1', '2'], n))
+            return pd.DataFrame({'chr1': chr1, 'pos1': np.random.randint(0, 300, n),
+                                 'chr2': chr2, 'pos2': np.random.randint(0, 300, n),
+                                 'support': np.random.randint(0, 3, n)}, columns=cols)
+        df_gml, sv_df = random_svs(100), random_svs(150)
+        df_gml.to_csv(gml_files[0], sep='\t', index=False)
+
+        germline = []
+        for idx_sv, sv in sv_df.iterrows():
+            same_chrs = np.logical_and(df_gml.chr1.values == sv.chr1, df_gml.chr2.values == sv.chr2)
+            for idx_gml, sv_gml in df_gml[np.logical_and(same_chrs, df_gml.support.values > 0)].iterrows():
+                if (abs(sv.pos1 - sv_gml.pos1) < 10 and abs(sv.pos2 - sv_gml.pos2) < 10) or \
+                   (sv.chr1 == sv.chr2 and abs(sv.pos2 - sv_gml.pos1) < 10 and abs(sv.pos1 - sv_gml.pos2) < 10):
+                    germline.append(idx_sv)
+                    break
+        filt_df = run_filter.filter_germline(gml_files[0], sv_df, 100, 300, 10)
+        self.assertTrue(len(germline) > 0 and filt_df.equals(sv_df.drop(germline, axis=0)))
+        shutil.rmtree(tmp_dir)
+
+    def test_15_read_cache(self):
+        bamf = pysam.AlignmentFile(bam, 'rb')
+        read_cache = count.ReadCache(bam, 1000)
+        small_cache = count.ReadCache(bam, 1000, max_reads=50)
+        for sv in svs[:20]:
+            for chrom, pos in [(sv['chr1'], sv['pos1']), (sv['chr2'], sv['pos2'])]:
+                # the second window is cut from the first window's reads
+                for offset in [0, 150]:
+                    bp = np.array((chrom, pos + offset - 300, pos + offset + 300, '?'), dtype=dtypes.bp_dtype)
+                    reads, err_code = count.get_loc_reads(bp, bamf, 10000)
+                    for cache in [read_cache, small_cache]:
+                        cached, cached_err = cache.get_loc_reads(bp, 10000)
+                        self.assertTrue(cached_err == err_code and np.array_equal(cached, reads))
+        self.assertTrue(len(small_cache.windows) < len(read_cache.windows))
+        self.assertTrue(small_cache.n_reads <= 50 or len(small_cache.windows) == 1)
+
+        # windows too deep to cache fall back to fetching the requested window
+        bp = np.array((svs[0]['chr1'], svs[0]['pos1'] - 300, svs[0]['pos1'] + 300, '?'), dtype=dtypes.bp_dtype)
+        cache = count.ReadCache(bam, 1000)
+        self.assertTrue(np.array_equal(cache.get_loc_reads(bp, 5)[0], count.get_loc_reads(bp, bamf, 5)[0]))
+        self.assertTrue(cache.get_loc_reads(bp, 5)[1] == count.get_loc_reads(bp, bamf, 5)[1])
+        self.assertTrue(len(cache.windows) == 0)
+        for cache in [cache, read_cache, small_cache]:
+            cache.close()
+        bamf.close()
+
+    def test_16_cn_states(self):
+        combos = [[[1, 1, 0.5, 1.]], [], [[2, 1, 0.5, 1.], [2, 2, 1., 1.]], [[3, 1, 1/3., 0.6]]]
+        expected = [np.reshape(combo, (-1, 4)).tolist() for combo in combos]
+        as_lists = lambda cn_states: [states.tolist() for states in cn_states]
+        cn_states = from_combos(combos)
+        self.assertTrue(as_lists(cn_states) == expected)
+        self.assertTrue(cn_states[-1].tolist() == expected[3] and cn_states[1].tolist() == [])
+        self.assertRaises(IndexError, cn_states.__getitem__, 4)
+        self.assertRaises(IndexError, cn_states.__getitem__, -5)
+
+        mask = np.array([True, False, True, True])
+        self.assertTrue(as_lists(cn_states[mask]) == [expected[i] for i in (0, 2, 3)])
+        self.assertTrue(as_lists(cn_states[::-1]) == expected[::-1])
+        self.assertTrue(as_lists(cn_states[np.array([2, 2, 0])]) == [expected[i] for i in (2, 2, 0)])
+        self.assertTrue(len(cn_states.subset([])) == 0 and cn_states.subset([]).states.shape == (0, 4))
+
+        # variants without states
+        no_states = cn_states[np.array([1, 1])]
+        self.assertTrue(len(no_states) == 2 and len(no_states.states) == 0)
+        self.assertTrue(list(no_states.var_idx) == [])
+
+        states, is_state = cn_states.padded()
+        self.assertTrue(states.shape == (4, 2, 4))
+        self.assertTrue(is_state.tolist() == [[True, False], [False, False], [True, True], [True, False]])
+        self.assertTrue(np.array_equal(states[is_state], cn_states.states) and np.all(np.isnan(states[~is_state])))
+        self.assertTrue(no_states.padded()[0].shape == (2, 0, 4))
+        self.assertTrue(from_combos([]).padded()[0].shape == (0, 0, 4))
+
+        parts = [from_combos([]), cn_states[:2], no_states, CNStates(), cn_states[2:]]
+        self.assertTrue(as_lists(concat_cn_states(parts)) == expected[:2] + [[], []] + expected[2:])
+        self.assertTrue(list(concat_cn_states(parts).var_idx) == [0, 4, 4, 5])
+        self.assertTrue(len(concat_cn_states([from_combos([]), CNStates()])) == 0)
+
+    def test_17_clonal_llr(self):
+        np.random.seed(3)
+        pool = [[2, 2, 0.5, 1.], [2, 3, 1/3., 1.], [2, 3, 2/3., 1.], [2, 1, 1., 1.],
+                [2, 4, 0.25, 1.], [2, 4, 0.75, 1.], [1, 2, 0.5, 0.6], [2, 3, 1., 0.4]]
+        combos = [[pool[i] for i in np.random.choice(len(pool), n, replace=False)]
+                  for n in np.random.randint(0, 4, 300)]
+        dep = np.random.randint(20, 100, 300).astype(float)
+        sup = np.random.binomial(dep.astype(int), np.random.uniform(0.05, 0.6, 300)).astype(float)
+        phi, norm = np.random.uniform(0.05, 1., 300), np.full(300, 2.)
+        inputs = cluster.ModelInputs(from_combos(combos), sup, dep, 0.8, norm)
+
+        def last_max(ll):
+            return np.where(ll == np.nanmax(ll))[0][-1]
+
+        # pick the best clonal state if the LLR of the best clonal against
+        # the worst phi state is significant (p < 0.05), as a scalar test
+        n_clonal = 0
+        most_likely_cn = cluster.get_most_likely_cn_states(inputs, phi, 0.05)[0]
+        for i, combo in enumerate(combos):
+            if len(combo) < 2:
+                expected = combo[0] if len(combo) == 1 else [np.nan] * 4
+            else:
+                ll_phi = cluster.calc_lik(combo, sup[i], dep[i], phi[i], 0.8, norm[i])[1]
+                ll_cl = cluster.calc_lik(combo, sup[i], dep[i], 1., 0.8, norm[i])[1]
+                LLR = 2 * (np.nanmax(ll_cl) - np.nanmin(ll_phi))
+                p_val = chi2.sf(LLR, 1) if not np.isnan(LLR) else 1
+                clonal = p_val < 0.05 and last_max(ll_cl) != last_max(ll_phi)
+                n_clonal += clonal
+                expected = combo[last_max(ll_cl)] if p_val < 0.05 else combo[last_max(ll_phi)]
+            self.assertTrue(np.allclose(most_likely_cn[i], expected, equal_nan=True))
+        self.assertTrue(n_clonal > 0)
+
+    def test_18_annotate_count_svs(self):
+        tmp_dir = tempfile.mkdtemp()
+        cfg_nodir = '%s/config.ini' % tmp_dir
+        nodir_config = ConfigParser.ConfigParser()
+        nodir_config.read(cfg)
+        nodir_config.set('SVannotateParameters', 'use_dir', 'False')
+        with open(cfg_nodir, 'w') as f:
+            nodir_config.write(f)
+        args = argparse.Namespace(cfg=cfg_nodir, svin='example_data/tumour_p80_DEL_svs_simple.txt',
+                                  bam=bam, sample=sample, out='%s/separate' % tmp_dir, sv_format='simple',
+                                  blist='', regions='', threads=1)
+        count.count_svs(annotate.preproc_svs(args), bam, sample, args.out, cfg_nodir)
+
+        # each SV is counted from its annotation reads, one fetch per break-end
+        fetches = []
+        def get_loc_reads(bp, bamf, max_dp):
+            fetches.append(bp)
+            return loc_reads(bp, bamf, max_dp)
+        loc_reads, count.get_loc_reads = count.get_loc_reads, get_loc_reads
+        try:
+            args.out = '%s/combined' % tmp_dir
+            annotate.preproc_count_svs(args)
+        finally:
+            count.get_loc_reads = loc_reads
+        self.assertTrue(0 < len(fetches) <= 2 * len(svs))
+
+        for out_file in ['svin.txt', 'svinfo.txt']:
+            with open('%s/separate/%s_%s' % (tmp_dir, sample, out_file)) as f:
+                separate = f.read()
+            with open('%s/combined/%s_%s' % (tmp_dir, sample, out_file)) as f:
+                self.assertTrue(f.read() == separate)
+        shutil.rmtree(tmp_dir)
+
+    def test_19_match_copy_numbers(self):
+        # disjoint segments are bisected, overlapping ones take the first listed
+        starts, ends = np.array([3001, 1, 1001]), np.array([4000, 1000, 2000])
+        self.assertTrue(list(run_filter.find_overlapping_segment(starts, ends, np.array([0, 1, 1000, 2500, 3500, 4001]))) == [-1, 1, 1, -1, 0, -1])
+        starts, ends = np.array([1, 2001, 1]), np.array([5000, 3000, 8000])
+        self.assertTrue(list(run_filter.find_overlapping_segment(starts, ends, np.array([2500, 6000, 9000]), chunk_size=2)) == [0, 2, -1])
+        dists, idxs = run_filter.find_nearest_bound(np.array([3001, 1, 1001, 1]), np.array([0, 500, 1001, 2001, 2500, 5000]))
+        self.assertTrue(list(dists) == [1, 499, 0, 1000, 501, 1999] and list(idxs) == [1, 1, 2, 0, 0, 0])
+
+        def get_vars():
+            cnv_df = pd.DataFrame({'chr': ['1', '1', '1', '2', '2', '2'],
+                                   'startpos': [1, 1001, 3001, 1, 2001, 4001],
+                                   'endpos': [1000, 2000, 4000, 5000, 3000, 8000],
+                                   'gtype': ['1,1,1.0', '2,1,1.0', '3,1,1.0', '1,1,1.0', '2,2,1.0', '2,0,1.0']})
+            # chromosome 3 has no CNVs
+            sv_df = pd.DataFrame({'chr1': ['1', '1', '1', '1', '1', '2', '2', '3'],
+                                  'pos1': [500, 1005, 1005, 2500, 500, 2500, 6000, 100],
+                                  'dir1': ['+', '-', '-', '+', '.', '+', '-', '+'],
+                                  'classification': ['DEL', 'DEL', 'INTRX', 'DEL', 'DEL', 'DEL', 'INTRX', 'DEL'],
+                                  'pos2': [900, 3500, 1, 2600, 900, 2600, 100, 200]})
+            return sv_df, cnv_df
+
+        # the INTRX break-end takes the CNV downstream of a '-' direction,
+        # a '.' direction or a gap takes the CNV with the closest boundary
+        sv_df, gts = run_filter.match_copy_numbers(*get_vars(), strict_cnv_filt=False, sv_offset=10)
+        self.assertTrue(list(sv_df.gtype1) == ['1,1,1.0', '1,1,1.0', '2,1,1.0', '2,1,1.0', '1,1,1.0', '1,1,1.0', '2,0,1.0', ''])
+        self.assertTrue(list(sv_df.gtype1_adjacent) == ['1,1,1.0', '1,1,1.0', '1,1,1.0', '3,1,1.0', '1,1,1.0', '1,1,1.0', '2,0,1.0', ''])
+        self.assertTrue(np.allclose(sv_df.gtype1_cnv_boundary_dist, [499, 4, 4, 500, 499, 499, 1000, np.nan], equal_nan=True))
+        self.assertTrue(list(gts.missing) == list(parse_gtypes(sv_df.gtype1.values).missing))
+        self.assertTrue(np.allclose(run_filter.get_weighted_cns(gts), run_filter.get_weighted_cns(parse_gtypes(sv_df.gtype1.values))))
+
+        # unmatched break-ends have no CNV state, but keep the closest CNV as adjacent
+        sv_df, gts = run_filter.match_copy_numbers(*get_vars(), strict_cnv_filt=True, sv_offset=10)
+        self.assertTrue(list(sv_df.gtype1) == ['1,1,1.0', '1,1,1.0', '2,1,1.0', '', '', '1,1,1.0', '2,0,1.0', ''])
+        self.assertTrue(list(sv_df.gtype1_adjacent) == ['1,1,1.0', '1,1,1.0', '1,1,1.0', '2,1,1.0', '1,1,1.0', '1,1,1.0', '2,0,1.0', ''])
+        self.assertTrue(list(gts.missing) == [False, False, False, True, True, False, False, True])
+
     # TODO: add test for map/picking best run
     # TODO: add tests for cluster merging
 
@@ -0,0 +1,136 @@
+'''
+Mean-field variational inference for the truncated stick-breaking Dirichlet
+process mixture of cluster.cluster. The model log-likelihoods are tabulated
+on a grid of phis, q(phi_k) is a distribution over the grid points, so all
+updates are closed form. The fit is returned as draws from the variational
+posterior, in the shape of the sampler traces.
+'''
+from __future__ import print_function
+
+import numpy as np
+from scipy.special import digamma, gammaln, betaln
+
+from .gibbs import Trace, SampleFit, get_weights, get_logp
+
+# default number of grid phis if no phi_grid is configured
+grid_size = 200
+
+# coordinate ascent stops when the relative change in ELBO is below tol
+max_iter = 1000
+tol = 1e-8
+
+# draws from the variational posterior returned as the trace
+n_draws = 500
+
+log_tiny = np.log(np.finfo(float).tiny)
+
+class VIFit(SampleFit):
+    '''
+    fit metrics of the variational posterior's mode, with its ELBO
+    '''
+    def __init__(self, lnL, logp, n_params, n_data, elbo):
+        SampleFit.__init__(self, lnL, logp, n_params, n_data)
+        self.ELBO = elbo
+
+def normalise_logs(log_p):
+    '''
+    normalised probabilities and entropy of each row of log_p
+    '''
+    log_p = log_p - np.max(log_p, axis=1)[:, np.newaxis]
+    log_p -= np.log(np.sum(np.exp(log_p), axis=1))[:, np.newaxis]
+    # flush subnormal probabilities, which slow the matrix products
+    p = np.where(log_p > log_tiny, np.exp(log_p), 0.)
+    return p, -np.sum(p * np.where(p > 0, log_p, 0), axis=1)
+
+def get_stick_expectations(g1, g2):
+    '''
+    E[log pi_k] under the Beta(g1, g2) sticks, and E[log(1 - v_k)]
+    '''
+    e_log_v = digamma(g1) - digamma(g1 + g2)
+    e_log_rest = digamma(g2) - digamma(g1 + g2)
+    prev_rest = np.concatenate([[0.], np.cumsum(e_log_rest)])
+    return np.append(e_log_v, 0.) + prev_rest, e_log_rest
+
+def beta_entropy(g1, g2):
+    return betaln(g1, g2) - (g1 - 1) * digamma(g1) - (g2 - 1) * digamma(g2) + \
+           (g1 + g2 - 2) * digamma(g1 + g2)
+
+def fit(lls, phis, Nvar, Ndp, z_init, alpha, gamma_a, gamma_b, fixed):
+    '''
+    lls is the (Nvar x grid) table of model log-likelihoods at the grid phis.
+    Returns a Trace of draws from the variational posterior and its VIFit.
+    '''
+    lls = lls.astype(float)
+    resp = 0.5 * np.eye(Ndp)[np.asarray(z_init, dtype=int)] + \
+           0.5 * np.random.dirichlet(np.ones(Ndp), Nvar)
+    w1, w2 = float(gamma_a), float(gamma_b)
+    if fixed:
+        e_alpha, e_log_alpha = alpha, np.log(alpha)
+
+    elbo, prev = -np.inf, -np.inf
+    for it in range(max_iter):
+        counts = np.sum(resp, axis=0)
+        rest = np.cumsum(counts[::-1])[::-1] - counts
+        if not fixed:
+            e_alpha = w1 / w2
+        g1, g2 = 1. + counts[:-1], e_alpha + rest[:-1]
+        e_log_pi, e_log_rest = get_stick_expectations(g1, g2)
+
+        if not fixed:
+            w1, w2 = gamma_a + Ndp - 1, gamma_b - np.sum(e_log_rest)
+            e_alpha, e_log_alpha = w1 / w2, digamma(w1) - np.log(w2)
+
+        q_phi, h_phi = normalise_logs(np.dot(resp.T, lls))
+        e_lls = np.dot(lls, q_phi.T)
+        resp, h_z = normalise_logs(e_lls + e_log_pi)
+
+        elbo = np.sum(resp * (e_lls + e_log_pi)) + np.sum(h_z)
+        elbo += np.sum(e_log_alpha + (e_alpha - 1) * e_log_rest + beta_entropy(g1, g2))
+        elbo += np.sum(h_phi) - Ndp * np.log(len(phis))
+        if not fixed:
+            elbo += gamma_a * np.log(gamma_b) - gammaln(gamma_a) + \
+                    (gamma_a - 1) * e_log_alpha - gamma_b * e_alpha
+            elbo += w1 - np.log(w2) + gammaln(w1) + (1 - w1) * digamma(w1)
+
+        if np.abs(elbo - prev) < tol * np.abs(elbo):
+            break
+        prev = elbo
+
+    print('Variational inference finished after %d iterations, ELBO = %f' % (it + 1, elbo))
+    return get_draws(resp, q_phi, phis, w1, w2, fixed), \
+           get_fit(lls, resp, q_phi, phis, g1, g2, e_alpha, gamma_a, gamma_b, fixed, elbo)
+
+def get_draws(resp, q_phi, phis, w1, w2, fixed):
+    '''
+    trace of draws from the variational posterior, each variant's
+    assignments are stratified so their frequencies follow resp
+    '''
+    Nvar, Ndp = resp.shape
+    u = (np.arange(n_draws)[:, np.newaxis] + np.random.rand(Nvar)) / n_draws
+    cum = np.cumsum(resp, axis=1)
+    cum = cum / cum[:, -1][:, np.newaxis] + np.arange(Nvar)[:, np.newaxis]
+    z = np.searchsorted(cum.ravel(), (u + np.arange(Nvar)).ravel()).reshape(n_draws, Nvar)
+    z = np.clip(z - np.arange(Nvar) * Ndp, 0, Ndp - 1)
+    z = z[np.argsort(np.random.rand(n_draws, Nvar), axis=0), np.arange(Nvar)]
+
+    # jitter draws of each phi within its grid cell
+    step = phis[1] - phis[0] if len(phis) > 1 else 0.
+    idx = np.array([np.random.choice(len(phis), n_draws, p=q / np.sum(q)) for q in q_phi]).T
+    phi_k = np.clip(phis[idx] + (np.random.rand(n_draws, Ndp) - 0.5) * step, phis[0], phis[-1])
+
+    traces = {'z': z, 'phi_k': phi_k}
+    if not fixed:
+        traces['alpha'] = np.random.gamma(w1, 1. / w2, n_draws)
+    return Trace(traces)
+
+def get_fit(lls, resp, q_phi, phis, g1, g2, alpha, gamma_a, gamma_b, fixed, elbo):
+    '''
+    VIFit at the mode of the variational posterior
+    '''
+    Nvar, Ndp = resp.shape
+    z, phi_idx = np.argmax(resp, axis=1), np.argmax(q_phi, axis=1)
+    lnL = np.sum(lls[np.arange(Nvar), phi_idx[z]])
+    h = np.append(g1 / (g1 + g2), 1.)
+    logp = get_logp(lnL, z, get_weights(h), h, phis[-1] - phis[0], alpha, gamma_a, gamma_b, fixed)
+    n_params = 2 * Ndp + Nvar + (0 if fixed else 1)
+    return VIFit(lnL, logp, n_params, Nvar, elbo)
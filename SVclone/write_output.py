@@ -4,11 +4,11 @@ import os
 import gzip
 import itertools
 import math
-from operator import methodcaller
 
 from . import dtypes
 from . import cluster
 from . import load_data
+from .genotypes import take_gtypes
 
 def adjust_vafs(mlcn_vect, ccert, vafs, pi, norm):
     '''
@@ -29,7 +29,7 @@ def dump_trace(center_trace, outf):
         df_traces = pd.DataFrame(center_trace)
         df_traces.to_csv(fout, sep='\t', index=False, header=False)
 
-def write_out_files(df, clus_info, clus_members, df_probs, clus_cert, clus_out_dir, sample, pi, sup, dep, norm, cn_states, run_fit, smc_het, cnv_pval, z_phi, are_snvs=False):
+def write_out_files(df, var_gts, clus_info, clus_members, df_probs, clus_cert, clus_out_dir, sample, pi, sup, dep, norm, cn_states, run_fit, smc_het, cnv_pval, z_phi, are_snvs=False, inputs=None):
     if are_snvs:
         clus_out_dir = '%s/snvs'%clus_out_dir
         if not os.path.exists(clus_out_dir):
@@ -79,10 +79,12 @@ def write_out_files(df, clus_info, clus_members, df_probs, clus_cert, clus_out_d
     cmem      = np.hstack(clus_members)
     df        = df.loc[cmem]
     df.index  = range(len(df)) #reindex df
+    var_gts   = take_gtypes(var_gts, cmem)
     df_probs  = df_probs.loc[cmem]
     clus_cert = clus_cert.loc[cmem]
     z_phi     = z_phi[cmem]
     sup, dep, norm, cn_states = sup[cmem], dep[cmem], np.array(norm)[cmem], cn_states[cmem]
+    inputs = cluster.ModelInputs(cn_states, sup, dep, pi, norm) if inputs is None else inputs[cmem]
 
     # prepare data structures for output
     cn_vect     = np.empty((0, len(cmem)), dtype=cn_dtype)
@@ -90,22 +92,22 @@ def write_out_files(df, clus_info, clus_members, df_probs, clus_cert, clus_out_d
     mult_vect   = np.empty((0, len(cmem)), dtype=mult_dtype)
 
     phis = clus_cert.average_ccf.values
-    cns, pvs = cluster.get_most_likely_cn_states(cn_states, sup, dep, phis, pi, cnv_pval, norm)
+    cns, pvs = cluster.get_most_likely_cn_states(inputs, phis, cnv_pval)
+    state_probs = cluster.get_state_probs(inputs, phis)
+
+    #select the first clonal/major fraction copy-number state as the one to output
+    gts1 = var_gts[0]
+    tot_cns1 = np.where(gts1.valid[:, 0], gts1.total[:, 0], 0.)
+    if not are_snvs:
+        gts2 = var_gts[1]
+        tot_cns2 = np.where(gts2.valid[:, 0], gts2.total[:, 0], 0.)
 
     for idx, var in df.iterrows():
-        gtype1, gtype2 = None, None
         if not are_snvs:
             if math.isnan(var.ID):
                 continue
-            gtype1, gtype2 = var['gtype1'].split('|'), var['gtype2'].split('|')
-            gtype1, gtype2 = map(methodcaller('split', ','), gtype1), map(methodcaller('split', ','), gtype2)
-
-            #select the first clonal/major fraction copy-number state as the one to output
-            maj_cn1, min_cn1 = map(float, gtype1[0])[:2] if gtype1[0][0]!='' else [0., 0.]
-            maj_cn2, min_cn2 = map(float, gtype2[0])[:2] if gtype2[0][0]!='' else [0., 0.]
-
-            tot_cn1 = maj_cn1 + min_cn1
-            tot_cn2 = maj_cn2 + min_cn2 if not are_snvs else 0
+            tot_cn1 = tot_cns1[idx]
+            tot_cn2 = tot_cns2[idx]
 
             chr1 = str(var['chr1'])
             pos1 = int(var['pos1'])
@@ -132,7 +134,7 @@ def write_out_files(df, clus_info, clus_members, df_probs, clus_cert, clus_out_d
             var_states = cn_states[idx]
             tot_opts = ','.join(map(str,[int(x[1]) for x in var_states]))
             var_opts = ','.join(map(str,[int(round(x[1]*x[2])) for x in var_states]))
-            probs =  cluster.get_probs(var_states, sup[idx], dep[idx], phis[idx], pi, norm[idx])
+            probs = state_probs[idx]
 
             mult_new_row = np.array([(chr1, pos1, dir1, chr2, pos2, dir2, sc_cn,
                                      int(round(freq*sc_cn)), tot_opts, var_opts, probs)], dtype=mult_dtype)
@@ -143,10 +145,7 @@ def write_out_files(df, clus_info, clus_members, df_probs, clus_cert, clus_out_d
         else:
             if math.isnan(var.pos):
                 continue
-            gtype1 = map(lambda x: x.split(','), var['gtype'].split('|'))
-
-            maj_cn1, min_cn1 = map(float, gtype1[0])[:2] if gtype1[0][0]!='' else [0., 0.]
-            tot_cn1 = maj_cn1 + min_cn1
+            tot_cn1 = tot_cns1[idx]
 
             chrom = str(var['chrom'])
             pos = int(var['pos'])
@@ -162,7 +161,7 @@ def write_out_files(df, clus_info, clus_members, df_probs, clus_cert, clus_out_d
             var_states = cn_states[idx]
             tot_opts = ','.join(map(str,[int(x[1]) for x in var_states]))
             var_opts = ','.join(map(str,[int(round(x[1]*x[2])) for x in var_states]))
-            probs =  cluster.get_probs(var_states, sup[idx], dep[idx], phis[idx], pi, norm[idx])
+            probs = state_probs[idx]
 
             mult_new_row = np.array([(chrom, pos, sc_cn, int(round(freq*sc_cn)), tot_opts, var_opts, probs)],
                     dtype=mult_dtype)